@@ -1,6 +1,9 @@
 import os
+import io
+import csv
 import logging
-from flask import Flask, request, render_template, jsonify, redirect, url_for, flash, current_app
+import time
+from flask import Flask, request, render_template, jsonify, redirect, url_for, flash, current_app, abort, g
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
@@ -8,10 +11,27 @@ from flask_caching import Cache
 import json
 import hmac
 import hashlib
+import uuid
 import requests
 from datetime import datetime, timedelta
+from bounded_executor import BoundedExecutor
+from config import LOG_LEVEL
+from delivery_client import delivery_client
+from subscription_cache import (
+    get_subscription, get_subscription_index, invalidate_subscription, invalidate_subscription_index
+)
+import migrations
+from routing import matches_event_type, routing_index, subscriptions_for_event
+from signing import (
+    canonical_body, compute_signature, delivery_body, delivery_signature, read_signed_body, secret_fingerprint
+)
+import metrics
+import profiling
+import stats
+from pagination import InvalidCursor, keyset_page, page_size
+from response_capture import capture_response_body
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -19,6 +39,17 @@ app.config.from_pyfile('config.py')
 app.secret_key = os.environ.get("SESSION_SECRET", app.config['SECRET_KEY'])
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
+# Opt-in query counting and sampled profiling of requests
+profiling.init_app(app)
+
+# Background threads for deliveries made without a queue (on Render or when
+# Celery is unreachable), so ingest never waits on a customer's endpoint
+direct_executor = BoundedExecutor(
+    max_workers=app.config.get('DIRECT_DELIVERY_THREADS', 4),
+    max_queue=app.config.get('DIRECT_DELIVERY_QUEUE_SIZE', 1000),
+    name='direct-delivery'
+)
+
 cache = Cache(app, config={
     'CACHE_TYPE': 'SimpleCache',
     'CACHE_DEFAULT_TIMEOUT': 300
@@ -32,75 +63,116 @@ db.init_app(app)
 
 with app.app_context():
     from models import Subscription, WebhookDelivery, DeliveryAttempt
-    db.create_all()
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations"""
+    applied = migrations.upgrade(db.engine)
+    print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the dashboard stats rollups from the delivery tables"""
+    rows = stats.rebuild_rollups()
+    print(f"Rebuilt {rows} stats rollup rows")
 
 @app.context_processor
 def inject_context():
     """Inject common variables into all templates"""
-    context = {'now': datetime.now()}
-    
+    return {
+        'now': datetime.now()
+    }
+
+def subscription_index_or_empty():
+    """Subscription dropdown entries from the cached index, or none if it cannot be loaded"""
     try:
-        context['subscriptions'] = Subscription.query.all()
-    except:
-        context['subscriptions'] = []
-        
-    return context
+        return get_subscription_index()
+    except Exception as e:
+        logger.warning(f"Failed to load subscription index: {str(e)}")
+        return []
+
+# Endpoints whose latency is recorded in the webhook_ingest_seconds histogram
+INGEST_ENDPOINTS = ('ingest_webhook', 'ingest_webhook_batch', 'ingest_webhook_stream', 'publish_event')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_ingest_latency(response):
+    if request.endpoint in INGEST_ENDPOINTS and 'request_started' in g:
+        metrics.INGEST_LATENCY.labels(request.endpoint).observe(time.perf_counter() - g.request_started)
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus metrics for ingest and delivery"""
+    body, content_type = metrics.render_metrics()
+    return body, 200, {'Content-Type': content_type}
 
 @app.route('/')
 def index():
     """Landing page showing service overview"""
-    from sqlalchemy import func
-    
     subscriptions_count = Subscription.query.count()
     
-    total_deliveries = WebhookDelivery.query.count()
+    # All delivery counters come from the rollups in one query
+    summary = stats.summarize()
+    total_deliveries = summary['total']
     
-    status_counts = {}
+    status_counts = {status: summary[status] for status in stats.STATUSES}
     status_percentages = {}
     
-    for status in ['pending', 'processing', 'delivered', 'failed']:
-        count = WebhookDelivery.query.filter_by(status=status).count()
-        status_counts[status] = count
-    
-    total_status = sum(status_counts.values())
-    if total_status > 0:
-        for status, count in status_counts.items():
-            status_percentages[f"{status}_percent"] = round((count / total_status) * 100)
-    else:
-        for status in status_counts:
-            status_percentages[f"{status}_percent"] = 0
-    
-    successful_deliveries = status_counts.get('delivered', 0)
-    success_rate = round((successful_deliveries / total_deliveries * 100) if total_deliveries > 0 else 0)
-    
-    avg_attempts_result = db.session.query(
-        func.avg(
-            db.session.query(func.count(DeliveryAttempt.id))
-            .filter(DeliveryAttempt.delivery_id == WebhookDelivery.id)
-            .correlate(WebhookDelivery)
-            .scalar_subquery()
-        )
-    ).scalar()
+    for status, count in status_counts.items():
+        status_percentages[f"{status}_percent"] = round((count / total_deliveries) * 100) if total_deliveries > 0 else 0
     
-    avg_attempts = round(float(avg_attempts_result or 0), 1)
-    
-    stats = {
+    dashboard_stats = {
         'subscriptions': subscriptions_count,
         'total_deliveries': total_deliveries,
-        'success_rate': success_rate,
-        'avg_attempts': avg_attempts,
+        'success_rate': round(summary['success_rate']),
+        'avg_attempts': round(summary['avg_attempts'], 1),
         'status_breakdown': {**status_counts, **status_percentages}
     }
     
     recent_deliveries = WebhookDelivery.query.order_by(WebhookDelivery.created_at.desc()).limit(5).all()
     
-    return render_template('index.html', stats=stats, recent_deliveries=recent_deliveries)
+    return render_template('index.html', stats=dashboard_stats, recent_deliveries=recent_deliveries)
+
+def parse_batch_settings(values):
+    """Read batch_max_size and batch_window_ms; blank means unset, anything else must be a positive integer"""
+    settings = {}
+    limits = {'batch_max_size': app.config.get('DELIVERY_BATCH_MAX_SIZE', 500), 'batch_window_ms': None}
+    for name, maximum in limits.items():
+        value = values.get(name)
+        if value is None or value == '':
+            settings[name] = None
+            continue
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be an integer")
+        if value < 1 or (maximum is not None and value > maximum):
+            raise ValueError(f"{name} must be between 1 and {maximum}" if maximum else f"{name} must be positive")
+        settings[name] = value
+    return settings
 
 @app.route('/subscriptions')
 def list_subscriptions():
-    """List all subscriptions"""
-    subscriptions = Subscription.query.all()
-    return render_template('subscriptions.html', subscriptions=subscriptions)
+    """List subscriptions one page at a time"""
+    page = request.args.get('page', 1, type=int)
+    per_page = app.config.get('SUBSCRIPTIONS_PER_PAGE', 25)
+    
+    pagination = Subscription.query.order_by(Subscription.id).paginate(
+        page=page, per_page=per_page, error_out=False
+    )
+    subscriptions = pagination.items
+    
+    # Delivery stats for the whole page in one grouped query
+    subscription_stats = stats.summarize_many([sub.id for sub in subscriptions])
+    
+    return render_template('subscriptions.html',
+                          subscriptions=subscriptions,
+                          subscription_stats=subscription_stats,
+                          pagination=pagination)
 
 @app.route('/subscriptions/new', methods=['GET', 'POST'])
 def create_subscription():
@@ -110,11 +182,18 @@ def create_subscription():
         target_url = request.form.get('target_url')
         secret = request.form.get('secret', '')
         status = 'active' if request.form.get('status') == 'active' else 'inactive'
+        ordered = request.form.get('ordered') == 'on'
         
         if not target_url:
             flash('Target URL is required', 'danger')
             return redirect(url_for('create_subscription'))
         
+        try:
+            batch_settings = parse_batch_settings(request.form)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('create_subscription'))
+        
         event_types = request.form.getlist('event_types')
         
         subscription = Subscription(
@@ -122,11 +201,17 @@ def create_subscription():
             target_url=target_url,
             secret=secret,
             event_types=event_types if event_types else None,
-            status=status
+            status=status,
+            ordered=ordered,
+            **batch_settings
         )
         db.session.add(subscription)
         db.session.commit()
         
+        # Invalidate cache
+        invalidate_subscription_index()
+        routing_index.mark_changed(subscription.id)
+        
         flash('Subscription created successfully', 'success')
         return redirect(url_for('list_subscriptions'))
     
@@ -135,8 +220,6 @@ def create_subscription():
 @app.route('/subscriptions/<int:subscription_id>')
 def view_subscription(subscription_id):
     """View subscription details and recent deliveries"""
-    from sqlalchemy import func
-    
     subscription = Subscription.query.get_or_404(subscription_id)
     
     # Get recent deliveries for this subscription
@@ -144,42 +227,21 @@ def view_subscription(subscription_id):
                           .order_by(WebhookDelivery.created_at.desc())\
                           .limit(20).all()
     
-    # Get delivery statistics for this subscription
-    total_deliveries = WebhookDelivery.query.filter_by(subscription_id=subscription_id).count()
-    
-    # Success rate calculation
-    successful_deliveries = WebhookDelivery.query.filter_by(
-        subscription_id=subscription_id, 
-        status='delivered'
-    ).count()
-    
-    success_rate = round((successful_deliveries / total_deliveries * 100) if total_deliveries > 0 else 0)
-    
-    # Average attempts per delivery
-    avg_attempts_result = db.session.query(
-        func.avg(
-            db.session.query(func.count(DeliveryAttempt.id))
-            .join(WebhookDelivery, DeliveryAttempt.delivery_id == WebhookDelivery.id)
-            .filter(WebhookDelivery.subscription_id == subscription_id)
-            .group_by(DeliveryAttempt.delivery_id)
-            .scalar_subquery()
-        )
-    ).scalar()
-    
-    avg_attempts = round(float(avg_attempts_result or 0), 1)
+    # Get delivery statistics for this subscription from the rollups
+    summary = stats.summarize(subscription_id)
     
     # Prepare stats dictionary
-    stats = {
-        'total': total_deliveries,
-        'successful': successful_deliveries,
-        'success_rate': success_rate,
-        'avg_attempts': avg_attempts
+    subscription_stats = {
+        'total': summary['total'],
+        'successful': summary['delivered'],
+        'success_rate': round(summary['success_rate']),
+        'avg_attempts': round(summary['avg_attempts'], 1)
     }
     
     return render_template('subscription_detail.html', 
                           subscription=subscription, 
                           recent_deliveries=recent_deliveries,
-                          stats=stats)
+                          stats=subscription_stats)
 
 @app.route('/subscriptions/<int:subscription_id>/edit', methods=['GET', 'POST'])
 def edit_subscription(subscription_id):
@@ -191,11 +253,18 @@ def edit_subscription(subscription_id):
         target_url = request.form.get('target_url')
         secret = request.form.get('secret', '')
         status = 'active' if request.form.get('status') == 'active' else 'inactive'
+        ordered = request.form.get('ordered') == 'on'
         
         if not target_url:
             flash('Target URL is required', 'danger')
             return redirect(url_for('edit_subscription', subscription_id=subscription_id))
         
+        try:
+            batch_settings = parse_batch_settings(request.form)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('edit_subscription', subscription_id=subscription_id))
+        
         # Get event types from checkboxes (multiselect)
         event_types = request.form.getlist('event_types')
         
@@ -204,11 +273,15 @@ def edit_subscription(subscription_id):
         subscription.secret = secret
         subscription.event_types = event_types if event_types else None
         subscription.status = status
+        subscription.ordered = ordered
+        subscription.batch_max_size = batch_settings['batch_max_size']
+        subscription.batch_window_ms = batch_settings['batch_window_ms']
         
         db.session.commit()
         
         # Invalidate cache
-        cache.delete(f'subscription_{subscription_id}')
+        invalidate_subscription(subscription_id)
+        routing_index.mark_changed(subscription_id)
         
         flash('Subscription updated successfully', 'success')
         return redirect(url_for('view_subscription', subscription_id=subscription_id))
@@ -226,7 +299,8 @@ def delete_subscription(subscription_id):
     db.session.commit()
     
     # Invalidate cache
-    cache.delete(f'subscription_{subscription_id}')
+    invalidate_subscription(subscription_id)
+    routing_index.mark_changed(subscription_id)
     
     flash('Subscription deleted successfully', 'success')
     return redirect(url_for('list_subscriptions'))
@@ -235,7 +309,7 @@ def delete_subscription(subscription_id):
 @app.route('/deliveries/<int:subscription_id>')
 def deliveries(subscription_id=None):
     """View all deliveries with optional subscription filter"""
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = 10
     
     # Base query with optional subscription filter
@@ -243,21 +317,18 @@ def deliveries(subscription_id=None):
     if subscription_id:
         query = query.filter_by(subscription_id=subscription_id)
     
-    # Paginate results
-    pagination = query.order_by(WebhookDelivery.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-    deliveries = pagination.items
-    
-    # Get all subscriptions for the filter dropdown
-    subscriptions = Subscription.query.all()
+    # Keyset pagination on (created_at, id)
+    try:
+        deliveries, next_cursor = keyset_page(query, WebhookDelivery, cursor, per_page)
+    except InvalidCursor:
+        abort(400)
     
+    # The filter dropdown uses the cached subscription index
     return render_template('deliveries.html',
                           deliveries=deliveries,
-                          subscriptions=subscriptions,
+                          subscriptions=subscription_index_or_empty(),
                           filter_subscription=subscription_id,
-                          page=page,
-                          has_next_page=pagination.has_next)
+                          next_cursor=next_cursor)
 
 @app.route('/delivery/<uuid:delivery_id>')
 def view_delivery(delivery_id):
@@ -276,10 +347,23 @@ def view_delivery(delivery_id):
 # API Routes
 @app.route('/api/subscriptions', methods=['GET'])
 def api_list_subscriptions():
-    """API to list all subscriptions"""
-    subscriptions = Subscription.query.all()
+    """API to list subscriptions, optionally one page at a time"""
+    query = Subscription.query.order_by(Subscription.id)
+    
+    page = request.args.get('page', type=int)
+    if page is None:
+        return jsonify({
+            'subscriptions': [sub.to_dict() for sub in query.all()]
+        })
+    
+    per_page = page_size(request.args.get('per_page', 25, type=int))
+    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
     return jsonify({
-        'subscriptions': [sub.to_dict() for sub in subscriptions]
+        'subscriptions': [sub.to_dict() for sub in pagination.items],
+        'page': page,
+        'per_page': per_page,
+        'total': pagination.total,
+        'has_next': pagination.has_next
     })
 
 @app.route('/api/subscriptions', methods=['POST'])
@@ -290,17 +374,28 @@ def api_create_subscription():
     if not data or 'target_url' not in data:
         return jsonify({'error': 'Target URL is required'}), 400
     
+    try:
+        batch_settings = parse_batch_settings(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     subscription = Subscription(
         name=data.get('name', ''),
         target_url=data['target_url'],
         secret=data.get('secret', ''),
         event_types=data.get('event_types'),
-        status=data.get('status', 'active')
+        status=data.get('status', 'active'),
+        ordered=bool(data.get('ordered', False)),
+        **batch_settings
     )
     
     db.session.add(subscription)
     db.session.commit()
     
+    # Invalidate cache
+    invalidate_subscription_index()
+    routing_index.mark_changed(subscription.id)
+    
     return jsonify({
         'message': 'Subscription created successfully',
         'subscription': subscription.to_dict()
@@ -320,6 +415,11 @@ def api_update_subscription(subscription_id):
     subscription = Subscription.query.get_or_404(subscription_id)
     data = request.json
     
+    try:
+        batch_settings = parse_batch_settings(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     if 'name' in data:
         subscription.name = data['name']
     if 'target_url' in data:
@@ -330,11 +430,17 @@ def api_update_subscription(subscription_id):
         subscription.event_types = data['event_types']
     if 'status' in data:
         subscription.status = data['status']
+    if 'ordered' in data:
+        subscription.ordered = bool(data['ordered'])
+    for name, value in batch_settings.items():
+        if name in data:
+            setattr(subscription, name, value)
     
     db.session.commit()
     
     # Invalidate cache
-    cache.delete(f'subscription_{subscription_id}')
+    invalidate_subscription(subscription_id)
+    routing_index.mark_changed(subscription_id)
     
     return jsonify({
         'message': 'Subscription updated successfully',
@@ -350,166 +456,267 @@ def api_delete_subscription(subscription_id):
     db.session.commit()
     
     # Invalidate cache
-    cache.delete(f'subscription_{subscription_id}')
+    invalidate_subscription(subscription_id)
+    routing_index.mark_changed(subscription_id)
     
     return jsonify({
         'message': 'Subscription deleted successfully'
     })
 
 
+def accepts_event_type(subscription, event_type):
+    """Check an event type against the subscription's event type filter"""
+    # Only filter if subscription has event types configured and is in active status
+    if subscription.status == 'active' and subscription.event_types and event_type:
+        return matches_event_type(subscription.event_types, event_type)
+    return True
+
+def deliver_directly(delivery_id, subscription):
+    """Attempt a delivery once inside the current request"""
+    # Import helpers here to avoid circular import
+    from tasks import build_delivery_headers
+    
+    delivery = WebhookDelivery.query.get(delivery_id)
+    
+    # Update status to processing
+    delivery.status = 'processing'
+    db.session.commit()
+    
+    # Attempt to deliver the webhook
+    attempt_number = 1
+    
+    # Create a delivery attempt record
+    attempt = DeliveryAttempt(
+        delivery_id=delivery.id,
+        attempt_number=attempt_number,
+        status='failed',  # Default to failed, update on success
+    )
+    
+    try:
+        # Send the stored body bytes with the signature made at ingest
+        body = delivery_body(delivery)
+        headers = build_delivery_headers(
+            delivery.id, delivery.event_type, attempt_number,
+            delivery_signature(delivery, subscription, body)
+        )
+        
+        # Make the POST request with timeout
+        timeout = app.config.get('DELIVERY_TIMEOUT', 10)
+        metrics.observe_queue_wait(delivery.created_at)
+        with metrics.delivery_request(subscription.id):
+            response = delivery_client.post(
+                subscription.target_url,
+                data=body,
+                headers=headers,
+                timeout=timeout,
+                stream=True
+            )
+        
+        # Record the response details
+        attempt.status_code = response.status_code
+        attempt.response_body = capture_response_body(response)
+        
+        # Check if successful (2xx response)
+        if 200 <= response.status_code < 300:
+            attempt.status = 'success'
+            delivery.status = 'delivered'
+        else:
+            attempt.error_details = f"HTTP error: {response.status_code}"
+            delivery.status = 'failed'
+    
+    except requests.Timeout:
+        attempt.error_details = f"Request timed out after {timeout} seconds"
+        delivery.status = 'failed'
+    
+    except requests.ConnectionError as e:
+        attempt.error_details = f"Connection error: {str(e)}"
+        delivery.status = 'failed'
+    
+    except Exception as e:
+        attempt.error_details = f"Unexpected error: {str(e)}"
+        delivery.status = 'failed'
+    
+    # Save the attempt and update delivery
+    db.session.add(attempt)
+    delivery.attempt_count = attempt_number
+    delivery.completed_at = datetime.now()
+    db.session.commit()
+    
+    current_app.logger.info(f"Direct webhook delivery completed with status: {delivery.status}")
+
+def run_direct_delivery(delivery_id, subscription_id):
+    """Deliver on a direct delivery executor thread, outside any request"""
+    with app.app_context():
+        subscription = get_subscription(subscription_id)
+        if subscription is None:
+            logger.error(f"Subscription not found: {subscription_id}")
+            return
+        deliver_directly(delivery_id, subscription)
+
+def direct_delivery_full():
+    """503 response to send while the direct delivery executor is full"""
+    current_app.logger.warning("Direct delivery queue is full, rejecting webhook")
+    return jsonify({'error': 'Delivery queue is full, retry later'}), 503, {'Retry-After': '1'}
+
+def direct_delivery_backpressure():
+    """503 response to send while the direct delivery executor is full, otherwise None"""
+    if not direct_executor.saturated():
+        return None
+    return direct_delivery_full()
+
+def reserve_direct_delivery(count):
+    """Reserve direct delivery room for ``count`` deliveries before they are inserted.
+    
+    Any delivery may have to be delivered directly if Celery cannot be
+    reached, and one left pending would never be picked up, so ingest
+    answers 503 rather than insert deliveries there is no room for. Returns
+    None when the executor is full.
+    """
+    if app.config.get('DELIVERY_ENGINE') in ('async', 'queue'):
+        # The database engines never deliver directly
+        count = 0
+    return direct_executor.reserve(count)
+
+def dispatch_deliveries(delivery_ids, subscription, allow_direct=True, reservation=None):
+    """Hand newly committed deliveries of one subscription to the configured delivery engine"""
+    dispatch_to_subscriptions([(delivery_id, subscription) for delivery_id in delivery_ids], allow_direct,
+                              reservation)
+
+def dispatch_to_subscriptions(deliveries, allow_direct=True, reservation=None):
+    """Hand newly committed ``(delivery_id, subscription)`` pairs to the configured delivery engine.
+    
+    Without a queue they are delivered by the direct delivery executor's
+    background threads, in the room held by ``reservation`` if given. With
+    ``allow_direct=False`` such deliveries are left pending instead.
+    """
+    # Check if we're running on Render or if Celery is not available
+    # This prioritizes direct processing on Render to avoid webhooks being stuck in pending
+    process_directly = True
+    
+    # The async and queue engines claim pending deliveries straight from the
+    # database; ordered and batched subscriptions always go through Celery
+    engine = app.config.get('DELIVERY_ENGINE')
+    database_queue = engine in ('async', 'queue')
+    queued = deliveries
+    if database_queue:
+        queued = [(delivery_id, subscription) for delivery_id, subscription in deliveries
+                  if subscription.ordered or subscription.batched]
+        if len(queued) < len(deliveries):
+            current_app.logger.info(f"Left {len(deliveries) - len(queued)} webhook(s) pending for the {engine} delivery engine")
+    
+    if not queued:
+        process_directly = False
+    # If not on Render, try to use Celery
+    elif 'RENDER' not in os.environ:
+        try:
+            # Import task functions here to avoid circular import
+            from tasks import process_webhook, process_webhook_batch, schedule_batch_delivery, schedule_ordered_lane
+            
+            # Ordered and batched subscriptions are scheduled once each; the rest
+            # are queued with a single broker message regardless of how many there are
+            scheduled = set()
+            delivery_ids = []
+            for delivery_id, subscription in queued:
+                if not (subscription.ordered or subscription.batched):
+                    delivery_ids.append(delivery_id)
+                elif subscription.id not in scheduled:
+                    scheduled.add(subscription.id)
+                    if subscription.ordered:
+                        schedule_ordered_lane(subscription.id)
+                    else:
+                        schedule_batch_delivery(subscription)
+            if len(delivery_ids) == 1:
+                process_webhook.delay(str(delivery_ids[0]))
+            elif delivery_ids:
+                process_webhook_batch.delay([str(delivery_id) for delivery_id in delivery_ids])
+            process_directly = False
+            current_app.logger.info(f"Queued {len(queued)} webhook(s) for processing by Celery")
+        except Exception as e:
+            current_app.logger.warning(f"Failed to queue webhook with Celery: {str(e)}. Processing directly.")
+            process_directly = True
+    else:
+        current_app.logger.info("Running on Render. Processing webhook directly.")
+    
+    # With a database queue, a broker outage leaves deliveries pending rather
+    # than delivering them in the request; dispatch_due_retries claims them
+    # once they have been pending for RETRY_CLAIM_LEASE
+    if process_directly and (not allow_direct or database_queue):
+        current_app.logger.warning(f"Leaving {len(queued)} webhook(s) pending for the retry scheduler "
+                                   f"instead of delivering in the request")
+        return
+    
+    # Process webhooks directly if needed (on Render or if Celery failed), on
+    # background threads so the request returns without waiting for the endpoint
+    if process_directly:
+        calls = [(delivery_id, subscription.id) for delivery_id, subscription in queued]
+        submit = reservation.submit if reservation is not None else direct_executor.submit
+        if not submit(run_direct_delivery, calls):
+            current_app.logger.warning(f"Direct delivery queue is full, leaving {len(queued)} webhook(s) pending")
+
 @app.route('/api/ingest/<int:subscription_id>', methods=['POST'])
 def ingest_webhook(subscription_id):
     """Ingest a webhook for a specific subscription"""
     try:
-        # Get subscription directly from the database
-        subscription = Subscription.query.get_or_404(subscription_id)
+        # Get subscription from the cache, falling back to the database
+        subscription = get_subscription(subscription_id)
+        if subscription is None:
+            return jsonify({'error': 'Subscription not found'}), 404
         
-        # Get the webhook payload
-        payload = request.json
-        if not payload:
-            return jsonify({'error': 'No payload provided'}), 400
+        # Shed load before accepting work that could not be delivered
+        backpressure = direct_delivery_backpressure()
+        if backpressure:
+            return backpressure
         
-        # Check if event type filtering is enabled and apply it
+        # Check if event type filtering is enabled and apply it before reading the body
         event_type = request.headers.get('X-Event-Type') or request.args.get('event_type')
         
-        # Only filter if subscription has event types configured and is in active status
-        if subscription.status == 'active' and subscription.event_types and event_type:
-            if event_type not in subscription.event_types:
-                current_app.logger.warning(f"Subscription {subscription_id} does not accept events of type: {event_type}")
-                return jsonify({
-                    'message': f'Subscription does not accept events of type: {event_type}',
-                    'status': 'rejected'
-                }), 202  # Accepted but not processed
+        if not accepts_event_type(subscription, event_type):
+            current_app.logger.warning(f"Subscription {subscription_id} does not accept events of type: {event_type}")
+            return jsonify({
+                'message': f'Subscription does not accept events of type: {event_type}',
+                'status': 'rejected'
+            }), 202  # Accepted but not processed
         
-        # If secret is present, verify signature
+        # If secret is present, the signature header is required
+        signature_header = None
         if subscription.secret:
             signature_header = request.headers.get('X-Hub-Signature-256')
             if not signature_header:
                 return jsonify({'error': 'Missing signature header'}), 401
-            
-            # Calculate expected signature
-            payload_bytes = json.dumps(payload).encode('utf-8')
-            expected_signature = 'sha256=' + hmac.new(
-                subscription.secret.encode('utf-8'),
-                payload_bytes,
-                hashlib.sha256
-            ).hexdigest()
-            
-            if not hmac.compare_digest(signature_header, expected_signature):
-                return jsonify({'error': 'Invalid signature'}), 401
         
-        # Create a new webhook delivery record
+        # Hash the raw body while reading it; these exact bytes are stored and delivered
+        payload_bytes, expected_signature = read_signed_body(request.stream, subscription.secret)
+        
+        if subscription.secret and not hmac.compare_digest(signature_header, expected_signature):
+            return jsonify({'error': 'Invalid signature'}), 401
+        
+        # Parse the payload only once the request is known to be acceptable
+        try:
+            payload = json.loads(payload_bytes) if payload_bytes else None
+        except ValueError:
+            return jsonify({'error': 'Invalid JSON payload'}), 400
+        if not payload:
+            return jsonify({'error': 'No payload provided'}), 400
+        
+        # Hold room to deliver directly before accepting the delivery
+        reservation = reserve_direct_delivery(1)
+        if reservation is None:
+            return direct_delivery_full()
+        
+        # Create a new webhook delivery record, keeping the verified signature for delivery
         delivery = WebhookDelivery(
             subscription_id=subscription_id,
             payload=payload,
+            raw_body=payload_bytes,
+            signature=expected_signature,
+            signature_key=secret_fingerprint(subscription.secret) if expected_signature else None,
             event_type=event_type
         )
-        db.session.add(delivery)
-        db.session.commit()
-        
-        # Check if we're running on Render or if Celery is not available
-        # This prioritizes direct processing on Render to avoid webhooks being stuck in pending
-        process_directly = True
-        
-        # If not on Render, try to use Celery
-        if 'RENDER' not in os.environ:
-            try:
-                # Import task function here to avoid circular import
-                from tasks import process_webhook
-                
-                # Try to queue the webhook for processing using Celery
-                process_webhook.delay(str(delivery.id))
-                process_directly = False
-                current_app.logger.info(f"Queued webhook {delivery.id} for processing by Celery")
-            except Exception as e:
-                current_app.logger.warning(f"Failed to queue webhook with Celery: {str(e)}. Processing directly.")
-                process_directly = True
-        else:
-            current_app.logger.info("Running on Render. Processing webhook directly.")
-        
-        # Process webhook directly if needed (on Render or if Celery failed)
-        if process_directly:
-            # Update status to processing
-            delivery.status = 'processing'
+        with reservation:
+            db.session.add(delivery)
             db.session.commit()
             
-            # Attempt to deliver the webhook
-            attempt_number = 1
-            
-            # Create a delivery attempt record
-            attempt = DeliveryAttempt(
-                delivery_id=delivery.id,
-                attempt_number=attempt_number,
-                status='failed',  # Default to failed, update on success
-            )
-            
-            try:
-                # Prepare headers
-                headers = {
-                    'Content-Type': 'application/json',
-                    'User-Agent': 'Webhook-Delivery-Service/1.0',
-                    'X-Webhook-ID': str(delivery.id),
-                    'X-Webhook-Attempt': str(attempt_number)
-                }
-                
-                # Add event type if available
-                if delivery.event_type:
-                    headers['X-Event-Type'] = delivery.event_type
-                
-                # Add signature if secret is configured
-                if subscription.secret:
-                    payload_bytes = json.dumps(payload).encode('utf-8')
-                    signature = hmac.new(
-                        subscription.secret.encode('utf-8'),
-                        payload_bytes,
-                        hashlib.sha256
-                    ).hexdigest()
-                    headers['X-Hub-Signature-256'] = f"sha256={signature}"
-                
-                # Make the POST request with timeout
-                timeout = app.config.get('DELIVERY_TIMEOUT', 10)
-                response = requests.post(
-                    subscription.target_url,
-                    json=payload,
-                    headers=headers,
-                    timeout=timeout
-                )
-                
-                # Record the response details
-                attempt.status_code = response.status_code
-                
-                # Limit response body size to avoid storing very large responses
-                response_body = response.text[:1000]
-                if len(response.text) > 1000:
-                    response_body += '... [truncated]'
-                attempt.response_body = response_body
-                
-                # Check if successful (2xx response)
-                if 200 <= response.status_code < 300:
-                    attempt.status = 'success'
-                    delivery.status = 'delivered'
-                else:
-                    attempt.error_details = f"HTTP error: {response.status_code}"
-                    delivery.status = 'failed'
-            
-            except requests.Timeout:
-                attempt.error_details = f"Request timed out after {timeout} seconds"
-                delivery.status = 'failed'
-            
-            except requests.ConnectionError as e:
-                attempt.error_details = f"Connection error: {str(e)}"
-                delivery.status = 'failed'
-            
-            except Exception as e:
-                attempt.error_details = f"Unexpected error: {str(e)}"
-                delivery.status = 'failed'
-            
-            # Save the attempt and update delivery
-            db.session.add(attempt)
-            delivery.completed_at = datetime.now()
-            db.session.commit()
-            
-            current_app.logger.info(f"Direct webhook delivery completed with status: {delivery.status}")
+            dispatch_deliveries([delivery.id], subscription, reservation=reservation)
         
         return jsonify({
             'message': 'Webhook accepted for delivery',
@@ -523,6 +730,366 @@ def ingest_webhook(subscription_id):
             'error': f'Server error: {str(e)}'
         }), 500
 
+def parse_batch_items():
+    """Parse a batch request body into (item, error) pairs.
+    
+    The body is either a JSON array or NDJSON (one JSON object per line).
+    A malformed NDJSON line only invalidates that item.
+    """
+    content_type = (request.mimetype or '').lower()
+    body = request.get_data()
+    
+    if content_type in ('application/x-ndjson', 'application/ndjson', 'application/jsonl'):
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append((json.loads(line), None))
+            except ValueError as e:
+                items.append((None, f'Invalid JSON: {str(e)}'))
+        return items
+    
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        raise ValueError(f'Invalid JSON: {str(e)}')
+    if not isinstance(data, list):
+        raise ValueError('Batch body must be a JSON array or NDJSON')
+    return [(item, None) for item in data]
+
+def validate_batch_item(subscription, item, error, default_event_type, now):
+    """Validate one batch item, returning (delivery row or None, result)"""
+    if error is None and not (isinstance(item, dict) and item.get('payload')):
+        error = 'No payload provided'
+    if error:
+        return None, {'status': 'invalid', 'error': error}
+    
+    payload = item['payload']
+    event_type = item.get('event_type') or default_event_type
+    
+    if not accepts_event_type(subscription, event_type):
+        return None, {
+            'status': 'rejected',
+            'message': f'Subscription does not accept events of type: {event_type}'
+        }
+    
+    # Serialize once; the same bytes are verified, stored and delivered
+    payload_bytes = canonical_body(payload)
+    expected_signature = None
+    
+    # If secret is present, verify the item's signature
+    if subscription.secret:
+        signature = item.get('signature')
+        if not signature:
+            return None, {'status': 'invalid', 'error': 'Missing signature'}
+        expected_signature = compute_signature(subscription.secret, payload_bytes)
+        if not hmac.compare_digest(signature, expected_signature):
+            return None, {'status': 'invalid', 'error': 'Invalid signature'}
+    
+    delivery_id = uuid.uuid4()
+    row = {
+        'id': delivery_id,
+        'subscription_id': subscription.id,
+        'payload': payload,
+        'raw_body': payload_bytes,
+        'signature': expected_signature,
+        'signature_key': secret_fingerprint(subscription.secret) if expected_signature else None,
+        'event_type': event_type,
+        'status': 'pending',
+        'created_at': now,
+        'updated_at': now
+    }
+    return row, {'status': 'accepted', 'delivery_id': str(delivery_id)}
+
+@app.route('/api/ingest/<int:subscription_id>/batch', methods=['POST'])
+def ingest_webhook_batch(subscription_id):
+    """Ingest many webhooks for a specific subscription in one request"""
+    from sqlalchemy import insert
+    
+    try:
+        subscription = get_subscription(subscription_id)
+        if subscription is None:
+            return jsonify({'error': 'Subscription not found'}), 404
+        
+        # Shed load before accepting work that could not be delivered
+        backpressure = direct_delivery_backpressure()
+        if backpressure:
+            return backpressure
+        
+        try:
+            items = parse_batch_items()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if not items:
+            return jsonify({'error': 'No events provided'}), 400
+        
+        max_items = app.config.get('INGEST_BATCH_MAX_ITEMS', 1000)
+        if len(items) > max_items:
+            return jsonify({'error': f'Batch exceeds the maximum of {max_items} events'}), 413
+        
+        default_event_type = request.headers.get('X-Event-Type') or request.args.get('event_type')
+        now = datetime.utcnow()
+        results = []
+        rows = []
+        
+        for index, (item, error) in enumerate(items):
+            row, result = validate_batch_item(subscription, item, error, default_event_type, now)
+            if row:
+                rows.append(row)
+            results.append({'index': index, **result})
+        
+        # Insert every accepted delivery with one multi-row INSERT in one transaction
+        if rows:
+            reservation = reserve_direct_delivery(len(rows))
+            if reservation is None:
+                return direct_delivery_full()
+            with reservation:
+                db.session.execute(insert(WebhookDelivery), rows)
+                stats.record_created(db.session, rows)
+                db.session.commit()
+                dispatch_deliveries([row['id'] for row in rows], subscription, reservation=reservation)
+        
+        return jsonify({
+            'message': f'{len(rows)} of {len(items)} webhooks accepted for delivery',
+            'accepted': len(rows),
+            'results': results
+        }), 202
+    
+    except Exception as e:
+        # Catch all exceptions and return as JSON
+        current_app.logger.error(f"Error in batch webhook ingestion: {str(e)}")
+        db.session.rollback()
+        return jsonify({
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+def iter_ndjson_lines(stream, max_line_bytes):
+    """Yield (line number, item, error) for each non-empty line of an NDJSON stream.
+    
+    Lines are read one at a time so memory use does not depend on body size;
+    lines longer than ``max_line_bytes`` are skipped without being buffered.
+    """
+    line_number = 0
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            break
+        line_number += 1
+        
+        if len(line) > max_line_bytes and not line.endswith(b'\n'):
+            # Discard the rest of the oversized line
+            while True:
+                rest = stream.readline(65536)
+                if not rest or rest.endswith(b'\n'):
+                    break
+            yield line_number, None, f'Line exceeds {max_line_bytes} bytes'
+            continue
+        
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line), None
+        except ValueError as e:
+            yield line_number, None, f'Invalid JSON: {str(e)}'
+
+# Drivers whose connections copy_deliveries can COPY through
+COPY_DRIVERS = ('psycopg2', 'psycopg')
+
+def copy_deliveries(rows):
+    """Insert delivery rows, using COPY when the database is PostgreSQL via psycopg2 or psycopg 3.
+    
+    Returns the method used, 'copy' or 'insert'.
+    """
+    from sqlalchemy import insert
+    
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql' or connection.dialect.driver not in COPY_DRIVERS:
+        if connection.dialect.name == 'postgresql':
+            current_app.logger.warning(f"COPY is not supported with the {connection.dialect.driver} driver, "
+                                       f"inserting {len(rows)} deliveries instead")
+        db.session.execute(insert(WebhookDelivery), rows)
+        return 'insert'
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            row['id'], row['subscription_id'], row['raw_body'].decode('utf-8'), '\\x' + row['raw_body'].hex(),
+            row['signature'] or '', row['signature_key'] or '',
+            row['event_type'] or '', row['status'], row['created_at'].isoformat(), row['updated_at'].isoformat()
+        ])
+    buffer.seek(0)
+    
+    # Unquoted empty fields are NULL in CSV format
+    statement = ('COPY webhook_deliveries (id, subscription_id, payload, raw_body, signature, signature_key, '
+                 'event_type, status, created_at, updated_at) '
+                 'FROM STDIN WITH (FORMAT csv)')
+    cursor = connection.connection.cursor()
+    try:
+        if connection.dialect.driver == 'psycopg2':
+            cursor.copy_expert(statement, buffer)
+        else:
+            with cursor.copy(statement) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+    return 'copy'
+
+@app.route('/api/ingest/<int:subscription_id>/stream', methods=['POST'])
+def ingest_webhook_stream(subscription_id):
+    """Stream an NDJSON body of webhooks for a subscription, flushing them in batches"""
+    subscription = get_subscription(subscription_id)
+    if subscription is None:
+        return jsonify({'error': 'Subscription not found'}), 404
+    
+    batch_size = app.config.get('INGEST_STREAM_BATCH_SIZE', 1000)
+    max_line_bytes = app.config.get('INGEST_STREAM_MAX_LINE_BYTES', 1024 * 1024)
+    max_errors = app.config.get('INGEST_STREAM_MAX_ERRORS', 1000)
+    default_event_type = request.headers.get('X-Event-Type') or request.args.get('event_type')
+    
+    progress = {'lines': 0, 'accepted': 0, 'rejected': 0, 'invalid': 0, 'batches': 0}
+    errors = []
+    rows = []
+    
+    def flush():
+        method = copy_deliveries(rows)
+        stats.record_created(db.session, rows)
+        db.session.commit()
+        # Never fall back to delivering a backfill inside the request
+        dispatch_deliveries([row['id'] for row in rows], subscription, allow_direct=False)
+        progress['accepted'] += len(rows)
+        progress['batches'] += 1
+        rows.clear()
+        current_app.logger.info(f"Streaming ingest for subscription {subscription_id} ({method}): {progress}")
+    
+    try:
+        for line_number, item, error in iter_ndjson_lines(request.stream, max_line_bytes):
+            progress['lines'] = line_number
+            row, result = validate_batch_item(subscription, item, error, default_event_type, datetime.utcnow())
+            if row:
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    flush()
+                continue
+            
+            progress[result['status']] += 1
+            if len(errors) < max_errors:
+                errors.append({'line': line_number, **result})
+        
+        if rows:
+            flush()
+    
+    except Exception as e:
+        current_app.logger.error(f"Error in streaming webhook ingestion: {str(e)}")
+        db.session.rollback()
+        return jsonify({
+            'error': f'Server error: {str(e)}',
+            'progress': progress,
+            'errors': errors
+        }), 500
+    
+    return jsonify({
+        'message': f"{progress['accepted']} of {progress['lines']} lines accepted for delivery",
+        'progress': progress,
+        'errors': errors,
+        'errors_truncated': progress['rejected'] + progress['invalid'] > len(errors)
+    }), 202
+
+@app.route('/api/publish', methods=['POST'])
+def publish_event():
+    """Publish one event to every active subscription that accepts its event type"""
+    from sqlalchemy import insert
+    
+    try:
+        # Published events are re-signed with every subscription's secret, so publishing
+        # is only enabled together with a secret that authenticates the publisher
+        publish_secret = app.config.get('PUBLISH_SECRET')
+        if not publish_secret:
+            return jsonify({'error': 'Event publishing is disabled; set PUBLISH_SECRET to enable it'}), 503
+        
+        signature_header = request.headers.get('X-Hub-Signature-256')
+        if not signature_header:
+            return jsonify({'error': 'Missing signature header'}), 401
+        
+        event_type = request.headers.get('X-Event-Type') or request.args.get('event_type')
+        if not event_type:
+            return jsonify({'error': 'Missing event type'}), 400
+        
+        # Shed load before accepting work that could not be delivered
+        backpressure = direct_delivery_backpressure()
+        if backpressure:
+            return backpressure
+        
+        payload_bytes, expected_signature = read_signed_body(request.stream, publish_secret)
+        
+        if not hmac.compare_digest(signature_header, expected_signature):
+            return jsonify({'error': 'Invalid signature'}), 401
+        
+        try:
+            payload = json.loads(payload_bytes) if payload_bytes else None
+        except ValueError:
+            return jsonify({'error': 'Invalid JSON payload'}), 400
+        if not payload:
+            return jsonify({'error': 'No payload provided'}), 400
+        
+        subscriptions = []
+        for subscription_id in subscriptions_for_event(event_type):
+            subscription = get_subscription(subscription_id)
+            if subscription is None or subscription.status != 'active' or \
+                    not accepts_event_type(subscription, event_type):
+                # Changed by another process since the routing index last refreshed
+                routing_index.mark_changed(subscription_id)
+                continue
+            subscriptions.append(subscription)
+        
+        # One delivery per subscription, signed with its own secret and inserted together
+        body = bytes(payload_bytes)
+        now = datetime.utcnow()
+        rows = []
+        for subscription in subscriptions:
+            signature = compute_signature(subscription.secret, body) if subscription.secret else None
+            rows.append({
+                'id': uuid.uuid4(),
+                'subscription_id': subscription.id,
+                'payload': payload,
+                'raw_body': body,
+                'signature': signature,
+                'signature_key': secret_fingerprint(subscription.secret) if signature else None,
+                'event_type': event_type,
+                'status': 'pending',
+                'created_at': now,
+                'updated_at': now
+            })
+        
+        if rows:
+            reservation = reserve_direct_delivery(len(rows))
+            if reservation is None:
+                return direct_delivery_full()
+            with reservation:
+                db.session.execute(insert(WebhookDelivery), rows)
+                stats.record_created(db.session, rows)
+                db.session.commit()
+                dispatch_to_subscriptions([(row['id'], subscription) for row, subscription in zip(rows, subscriptions)],
+                                          reservation=reservation)
+        
+        return jsonify({
+            'message': f'Event published to {len(rows)} subscriptions',
+            'event_type': event_type,
+            'deliveries': [
+                {'subscription_id': row['subscription_id'], 'delivery_id': str(row['id'])} for row in rows
+            ]
+        }), 202
+    
+    except Exception as e:
+        # Catch all exceptions and return as JSON
+        current_app.logger.error(f"Error in event publishing: {str(e)}")
+        db.session.rollback()
+        return jsonify({
+            'error': f'Server error: {str(e)}'
+        }), 500
+
 @app.route('/api/delivery/<uuid:delivery_id>', methods=['GET'])
 def api_delivery_status(delivery_id):
     """API to get the status of a webhook delivery"""
@@ -540,17 +1107,43 @@ def api_subscription_deliveries(subscription_id):
     """API to get recent deliveries for a subscription"""
     subscription = Subscription.query.get_or_404(subscription_id)
     
-    limit = request.args.get('limit', 20, type=int)
-    if limit > 100:
-        limit = 100  # Cap the limit to prevent abuse
+    # Clamp the limit to prevent abuse
+    limit = page_size(request.args.get('limit', 20, type=int))
     
-    deliveries = WebhookDelivery.query.filter_by(subscription_id=subscription_id)\
-                  .order_by(WebhookDelivery.created_at.desc())\
-                  .limit(limit).all()
+    query = WebhookDelivery.query.filter_by(subscription_id=subscription_id)
+    try:
+        deliveries, next_cursor = keyset_page(query, WebhookDelivery, request.args.get('cursor'), limit)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
     
     return jsonify({
         'subscription_id': subscription_id,
-        'deliveries': [delivery.to_dict() for delivery in deliveries]
+        'deliveries': [delivery.to_dict() for delivery in deliveries],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/deliveries', methods=['GET'])
+def api_list_deliveries():
+    """API to page through deliveries, optionally filtered by subscription and status"""
+    # Clamp the limit to prevent abuse
+    limit = page_size(request.args.get('limit', 20, type=int))
+    
+    query = WebhookDelivery.query
+    subscription_id = request.args.get('subscription_id', type=int)
+    if subscription_id:
+        query = query.filter_by(subscription_id=subscription_id)
+    status = request.args.get('status')
+    if status:
+        query = query.filter_by(status=status)
+    
+    try:
+        deliveries, next_cursor = keyset_page(query, WebhookDelivery, request.args.get('cursor'), limit)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'deliveries': [delivery.to_dict() for delivery in deliveries],
+        'next_cursor': next_cursor
     })
 
 if __name__ == '__main__':
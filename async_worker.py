@@ -0,0 +1,385 @@
+import asyncio
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from config import (
+    ASYNC_WORKER_BATCH_SIZE,
+    ASYNC_WORKER_DB_THREADS,
+    ASYNC_WORKER_FLUSH_INTERVAL,
+    ASYNC_WORKER_FLUSH_SIZE,
+    ASYNC_WORKER_MAX_IN_FLIGHT,
+    ASYNC_WORKER_PER_SUBSCRIPTION_LIMIT,
+    ASYNC_WORKER_POLL_INTERVAL,
+    DELIVERY_TIMEOUT,
+    MAX_RETRY_ATTEMPTS,
+    RETRY_CLAIM_LEASE,
+)
+from attempt_results import AttemptResult, write_attempt_results
+from circuit_breaker import OPEN, circuit_breaker, is_failure
+from metrics import delivery_request, observe_queue_wait
+from response_capture import capture_response_body_async
+from retry_scheduler import retry_delay
+from signing import delivery_body, delivery_signature
+from subscription_cache import get_subscription
+from tasks import app_context, build_delivery_headers, drain_parked_deliveries
+from throttle import delivery_throttle, is_overloaded
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class DeliveryJob:
+    """A claimed delivery, detached from the database session"""
+
+    __slots__ = ('id', 'subscription_id', 'subscription', 'body', 'signature', 'event_type', 'created_at',
+                 'attempt_number')
+
+    def __init__(self, delivery, subscription, attempt_number):
+        self.id = delivery.id
+        self.subscription_id = delivery.subscription_id
+        self.subscription = subscription
+        self.body = delivery_body(delivery)
+        self.signature = delivery_signature(delivery, subscription, self.body)
+        self.event_type = delivery.event_type
+        self.created_at = delivery.created_at
+        self.attempt_number = attempt_number
+
+
+class AsyncDeliveryEngine:
+    """Asyncio alternative to the Celery worker for I/O bound delivery.
+
+    Pending deliveries are claimed from Postgres in batches and kept in flight
+    on a single event loop, bounded by a global and a per-subscription
+    concurrency limit. Database work runs on a small thread pool so the loop is
+    never blocked on SQLAlchemy. Attempt outcomes are buffered and written
+    in groups, so a busy engine records hundreds of attempts per transaction
+    instead of committing each one. Run with ``python async_worker.py`` and
+    ``DELIVERY_ENGINE=async`` so ingest leaves new deliveries for this engine.
+    """
+
+    def __init__(self, batch_size=ASYNC_WORKER_BATCH_SIZE, max_in_flight=ASYNC_WORKER_MAX_IN_FLIGHT,
+                 per_subscription_limit=ASYNC_WORKER_PER_SUBSCRIPTION_LIMIT,
+                 poll_interval=ASYNC_WORKER_POLL_INTERVAL, db_threads=ASYNC_WORKER_DB_THREADS,
+                 flush_size=ASYNC_WORKER_FLUSH_SIZE, flush_interval=ASYNC_WORKER_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.per_subscription_limit = per_subscription_limit
+        self.poll_interval = poll_interval
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        # Claimed deliveries may queue behind their subscription's limit, so
+        # allow a backlog of claimed work on top of what is actually in flight
+        self.max_claimed = max_in_flight * 2
+
+        self._db_executor = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix='async-worker-db')
+        self._global_limit = None
+        self._subscription_limits = {}
+        self._subscription_jobs = {}
+        self._jobs = {}
+        self._results = []
+        self._flush_now = None
+        self._stopping = None
+
+    # Database operations (run on the thread pool)
+
+    def _claim_batch(self, limit, held_ids=()):
+        """Mark up to ``limit`` pending or due deliveries as processing and return them as jobs.
+
+        ``held_ids`` are deliveries this engine already holds; they are never
+        claimed a second time, even if their lease ran out while they waited
+        for their subscription's limit.
+        """
+        with app_context() as db:
+            from sqlalchemy import and_, or_
+            from models import Subscription, WebhookDelivery
+
+            now = datetime.utcnow()
+            # New deliveries and failed ones whose retry is due (or whose claim
+            # lease ran out); ordered and batched subscriptions are delivered by Celery tasks
+            query = WebhookDelivery.query\
+                .filter(or_(WebhookDelivery.status == 'pending',
+                            and_(WebhookDelivery.status == 'processing', WebhookDelivery.next_attempt_at <= now)))\
+                .filter(WebhookDelivery.subscription_id.notin_(
+                    db.session.query(Subscription.id).filter(
+                        Subscription.ordered.is_(True) | (Subscription.batch_max_size > 1))))
+            if held_ids:
+                query = query.filter(WebhookDelivery.id.notin_(held_ids))
+            deliveries = query\
+                .order_by(WebhookDelivery.created_at)\
+                .limit(limit)\
+                .with_for_update(skip_locked=True)\
+                .all()
+            if not deliveries:
+                db.session.rollback()
+                return []
+
+            jobs = []
+            for delivery in deliveries:
+                subscription = get_subscription(delivery.subscription_id)
+                if not subscription:
+                    logger.error(f"Subscription not found: {delivery.subscription_id}")
+                    delivery.status = 'failed'
+                    continue
+                attempt_number = delivery.attempt_count + 1
+                if attempt_number > MAX_RETRY_ATTEMPTS:
+                    logger.warning(f"Maximum retry attempts reached for delivery: {delivery.id}")
+                    delivery.status = 'failed'
+                    delivery.completed_at = datetime.utcnow()
+                    delivery.next_attempt_at = None
+                    continue
+                if circuit_breaker.allow(subscription.id) == OPEN:
+                    delivery.status = 'parked'
+                    delivery.next_attempt_at = None
+                    continue
+                delivery.status = 'processing'
+                # Claimed again by any engine if this one dies before recording the attempt
+                delivery.next_attempt_at = now + timedelta(seconds=RETRY_CLAIM_LEASE)
+                # A signature made for a rotated secret is replaced and saved with the claim
+                jobs.append(DeliveryJob(delivery, subscription, attempt_number))
+
+            db.session.commit()
+            return jobs
+
+    def _renew_leases(self, jobs):
+        """Push the claim lease of held jobs ahead so no other engine claims them meanwhile"""
+        with app_context() as db:
+            from sqlalchemy import tuple_, update
+            from models import WebhookDelivery
+
+            # Skip deliveries whose attempt was already recorded
+            deliveries = WebhookDelivery.__table__
+            db.session.execute(
+                update(deliveries)
+                .where(deliveries.c.status == 'processing',
+                       tuple_(deliveries.c.id, deliveries.c.attempt_count).in_(
+                           [(job.id, job.attempt_number - 1) for job in jobs]))
+                .values(next_attempt_at=datetime.utcnow() + timedelta(seconds=RETRY_CLAIM_LEASE))
+            )
+            db.session.commit()
+
+    def _write_results(self, results):
+        """Save a group of attempt outcomes in one transaction"""
+        with app_context() as db:
+            write_attempt_results(db.session, results)
+            db.session.commit()
+
+    def _release(self, delivery_ids):
+        """Return unfinished deliveries to the pending pool on shutdown"""
+        with app_context() as db:
+            from models import WebhookDelivery
+
+            # Update through the ORM so the stats rollups follow the transition
+            deliveries = WebhookDelivery.query.filter(WebhookDelivery.id.in_(delivery_ids))\
+                .filter_by(status='processing').all()
+            for delivery in deliveries:
+                delivery.status = 'pending'
+                delivery.next_attempt_at = None
+            db.session.commit()
+
+    async def _run_db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_executor, func, *args)
+
+    # Attempt results
+
+    def _record(self, job, fields, status, next_attempt_at=None):
+        """Buffer an attempt outcome; a full buffer is flushed right away"""
+        self._results.append(AttemptResult(
+            job.id, job.subscription_id, job.created_at, job.attempt_number,
+            fields, status, next_attempt_at
+        ))
+        if len(self._results) >= self.flush_size:
+            self._flush_now.set()
+
+    async def _flush(self):
+        results, self._results = self._results, []
+        if not results:
+            return
+        try:
+            await self._run_db(self._write_results, results)
+        except Exception as e:
+            # The deliveries stay claimed and are attempted again once their lease runs out
+            logger.error(f"Failed to record {len(results)} delivery attempts: {str(e)}")
+
+    async def _flush_results(self):
+        """Write buffered results every flush_interval, or sooner once flush_size are waiting"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self._flush()
+
+    # Delivery
+
+    async def _post(self, session, job):
+        """Make one HTTP attempt, returning the DeliveryAttempt fields for it"""
+        headers = build_delivery_headers(job.id, job.event_type, job.attempt_number, job.signature)
+        try:
+            async with session.post(job.subscription.target_url, data=job.body,
+                                    headers=headers) as response:
+                fields = {
+                    'status_code': response.status,
+                    'response_body': await capture_response_body_async(response),
+                }
+                if 200 <= response.status < 300:
+                    fields['status'] = 'success'
+                else:
+                    fields['status'] = 'failed'
+                    fields['error_details'] = f"HTTP error: {response.status}"
+                return fields
+
+        except asyncio.TimeoutError:
+            return {'status': 'failed', 'error_details': f"Request timed out after {DELIVERY_TIMEOUT} seconds"}
+
+        except aiohttp.ClientConnectionError as e:
+            return {'status': 'failed', 'error_details': f"Connection error: {str(e)}"}
+
+        except Exception as e:
+            return {'status': 'failed', 'error_details': f"Unexpected error: {str(e)}"}
+
+    def _subscription_limit(self, subscription_id):
+        limit = self._subscription_limits.get(subscription_id)
+        if limit is None:
+            limit = asyncio.Semaphore(self.per_subscription_limit)
+            self._subscription_limits[subscription_id] = limit
+        return limit
+
+    async def _deliver(self, session, job):
+        """Make one attempt for a job and record its outcome or when to retry it"""
+        async with self._subscription_limit(job.subscription_id):
+            # Wait for the shared rate and concurrency limits; waiting does not use an attempt
+            decision = await asyncio.to_thread(delivery_throttle.acquire, job.subscription_id, job.id)
+            while not decision.allowed:
+                await asyncio.sleep(decision.retry_after)
+                decision = await asyncio.to_thread(delivery_throttle.acquire, job.subscription_id, job.id)
+
+            async with self._global_limit:
+                logger.info(f"Attempt {job.attempt_number} for delivery: {str(job.id)}")
+                if job.attempt_number == 1:
+                    observe_queue_wait(job.created_at)
+                started = time.monotonic()
+                with delivery_request(job.subscription_id):
+                    fields = await self._post(session, job)
+                latency = time.monotonic() - started
+
+        no_response = 'status_code' not in fields
+        overloaded = is_overloaded(fields.get('status_code'), no_response=no_response)
+        await asyncio.to_thread(delivery_throttle.release, decision.lease, latency, overloaded)
+
+        # Once a failing endpoint answers again, release the deliveries parked while it was down
+        success = not is_failure(fields.get('status_code'), no_response)
+        if await asyncio.to_thread(circuit_breaker.record, job.subscription_id, success):
+            await self._run_db(drain_parked_deliveries, job.subscription_id)
+
+        if fields['status'] == 'success':
+            self._record(job, fields, 'delivered')
+            return
+
+        if job.attempt_number >= MAX_RETRY_ATTEMPTS:
+            logger.warning(f"Maximum retry attempts reached for delivery: {job.id}")
+            self._record(job, fields, 'failed')
+            return
+
+        # The retry is stored in the database rather than held in memory;
+        # _claim_batch picks the delivery up again once it is due
+        delay = retry_delay(job.attempt_number)
+        logger.info(f"Scheduling retry {job.attempt_number + 1} for delivery {job.id} in {delay:.0f} seconds")
+        self._record(job, fields, 'processing', datetime.utcnow() + timedelta(seconds=delay))
+
+    def _job_done(self, job, task):
+        self._jobs.pop(job.id, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Delivery {job.id} crashed: {task.exception()}")
+
+        # Drop semaphores of subscriptions that have nothing in flight
+        remaining = self._subscription_jobs.get(job.subscription_id, 1) - 1
+        if remaining > 0:
+            self._subscription_jobs[job.subscription_id] = remaining
+        else:
+            self._subscription_jobs.pop(job.subscription_id, None)
+            self._subscription_limits.pop(job.subscription_id, None)
+
+    async def run(self):
+        """Claim and deliver webhooks until stopped"""
+        self._global_limit = asyncio.Semaphore(self.max_in_flight)
+        self._stopping = asyncio.Event()
+        self._flush_now = asyncio.Event()
+        flusher = asyncio.create_task(self._flush_results())
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._stopping.set)
+
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=DELIVERY_TIMEOUT)
+
+        logger.info(f"Async delivery engine started: max_in_flight={self.max_in_flight}, "
+                    f"per_subscription_limit={self.per_subscription_limit}")
+
+        # Leases of jobs that wait behind their subscription's limit are renewed at half their length
+        renew_every = RETRY_CLAIM_LEASE / 2
+        renewed_at = time.monotonic()
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            while not self._stopping.is_set():
+                if self._jobs and time.monotonic() - renewed_at >= renew_every:
+                    renewed_at = time.monotonic()
+                    try:
+                        await self._run_db(self._renew_leases, [job for job, _ in self._jobs.values()])
+                    except Exception as e:
+                        logger.error(f"Failed to renew delivery leases: {str(e)}")
+
+                free = self.max_claimed - len(self._jobs)
+                jobs = []
+                if free > 0:
+                    try:
+                        jobs = await self._run_db(self._claim_batch, min(self.batch_size, free), list(self._jobs))
+                    except Exception as e:
+                        logger.error(f"Failed to claim deliveries: {str(e)}")
+
+                for job in jobs:
+                    task = asyncio.create_task(self._deliver(session, job))
+                    self._jobs[job.id] = (job, task)
+                    self._subscription_jobs[job.subscription_id] = \
+                        self._subscription_jobs.get(job.subscription_id, 0) + 1
+                    task.add_done_callback(lambda t, job=job: self._job_done(job, t))
+
+                # Poll again right away while there is a backlog to fill free slots
+                if not jobs or len(jobs) < min(self.batch_size, free):
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+
+            flusher.cancel()
+            await self._shutdown()
+
+    async def _shutdown(self):
+        """Cancel outstanding jobs and hand their deliveries back to the queue"""
+        logger.info(f"Stopping async delivery engine with {len(self._jobs)} deliveries outstanding")
+        jobs = list(self._jobs.values())
+        for _, task in jobs:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in jobs), return_exceptions=True)
+
+        # Record the attempts that finished before handing the rest back
+        await self._flush()
+        if jobs:
+            await self._run_db(self._release, [job.id for job, _ in jobs])
+        self._db_executor.shutdown(wait=True)
+
+
+def main():
+    asyncio.run(AsyncDeliveryEngine().run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
+
+from sqlalchemy import DateTime, Integer, String, cast, column, insert, update, values
+from sqlalchemy.dialects.postgresql import UUID
+
+from metrics import ATTEMPTS_PER_DELIVERY
+from stats import apply_deltas, hour_bucket
+
+# The outcome of one attempt at a claimed ('processing') delivery. ``status``
+# is the delivery's new status: 'processing' while a retry is pending, or
+# 'delivered'/'failed' when it is done.
+AttemptResult = namedtuple('AttemptResult', [
+    'delivery_id', 'subscription_id', 'created_at', 'attempt_number',
+    'fields', 'status', 'next_attempt_at',
+])
+
+ATTEMPT_COLUMNS = ('status', 'status_code', 'error_details', 'response_body')
+
+
+def write_attempt_results(session, results):
+    """Record many attempt outcomes with one multi-row INSERT and one UPDATE.
+
+    Attempt rows go into delivery_attempts together, and every delivery's
+    status, attempt_count and next_attempt_at are set by a single
+    ``UPDATE ... FROM (VALUES ...)`` on PostgreSQL. Deliveries that are no
+    longer 'processing' (claimed again after their lease ran out) keep their
+    current state. Both statements bypass the ORM, so the stats rollup deltas
+    are applied here. Returns the number of deliveries updated; the caller
+    commits.
+    """
+    # Import models here to avoid circular imports
+    from models import WebhookDelivery, DeliveryAttempt
+
+    if not results:
+        return 0
+
+    now = datetime.utcnow()
+    session.execute(insert(DeliveryAttempt.__table__), [
+        {'delivery_id': result.delivery_id, 'attempt_number': result.attempt_number, 'created_at': now,
+         **{name: result.fields.get(name) for name in ATTEMPT_COLUMNS}}
+        for result in results
+    ])
+
+    deliveries = WebhookDelivery.__table__
+    rows = [
+        (result.delivery_id, result.status,
+         now if result.status in ('delivered', 'failed') else None,
+         result.next_attempt_at, result.attempt_number)
+        for result in results
+    ]
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        batch = values(
+            column('id', UUID(as_uuid=True)), column('status', String), column('completed_at', DateTime),
+            column('next_attempt_at', DateTime), column('attempt_count', Integer),
+            name='results'
+        ).data(rows)
+        updated = set(session.execute(
+            update(deliveries)
+            .where(deliveries.c.id == batch.c.id, deliveries.c.status == 'processing')
+            # A VALUES column holding only NULLs is typed text, so cast the timestamps back
+            .values(status=batch.c.status, completed_at=cast(batch.c.completed_at, DateTime),
+                    next_attempt_at=cast(batch.c.next_attempt_at, DateTime),
+                    attempt_count=batch.c.attempt_count, updated_at=now)
+            .returning(deliveries.c.id)
+        ).scalars())
+    else:
+        updated = set()
+        for delivery_id, status, completed_at, next_attempt_at, attempt_count in rows:
+            result = session.execute(
+                update(deliveries)
+                .where(deliveries.c.id == delivery_id, deliveries.c.status == 'processing')
+                .values(status=status, completed_at=completed_at, next_attempt_at=next_attempt_at,
+                        attempt_count=attempt_count, updated_at=now)
+            )
+            if result.rowcount:
+                updated.add(delivery_id)
+
+    deltas = defaultdict(Counter)
+    for result in results:
+        key = (result.subscription_id, hour_bucket(result.created_at))
+        deltas[key]['attempts'] += 1
+        if result.delivery_id in updated and result.status != 'processing':
+            deltas[key]['processing'] -= 1
+            deltas[key][result.status] += 1
+            ATTEMPTS_PER_DELIVERY.observe(result.attempt_number)
+    apply_deltas(connection, deltas)
+    return len(updated)
@@ -0,0 +1,43 @@
+import redis
+
+from config import REDIS_URL
+from redis_client import RedisClient
+
+
+def batch_body(bodies):
+    """Join stored delivery bodies into one JSON array without re-serializing them"""
+    return b'[' + b','.join(bodies) + b']'
+
+
+class BatchWindow:
+    """Coalescing window per subscription, shared by every process through Redis.
+
+    The first delivery ingested for a subscription opens a window of
+    ``window_ms`` and schedules one batch send for when it closes; deliveries
+    ingested while the window is open just wait to be included. When Redis is
+    unavailable every caller schedules a send, which still delivers everything
+    but in smaller batches.
+    """
+
+    def __init__(self, redis_url):
+        self.redis_url = redis_url
+
+        self._redis = RedisClient(redis_url, 'Batch window unavailable, scheduling every batch send')
+
+    @staticmethod
+    def _key(subscription_id):
+        return f"batch-window:{subscription_id}"
+
+    def open(self, subscription_id, window_ms):
+        """Open the subscription's window; returns True if the caller should schedule the send"""
+        client = self._redis.get()
+        if client is None:
+            return True
+        try:
+            return bool(client.set(self._key(subscription_id), 1, nx=True, px=max(int(window_ms), 1)))
+        except redis.RedisError as e:
+            self._redis.failed(e)
+            return True
+
+
+batch_window = BatchWindow(REDIS_URL)
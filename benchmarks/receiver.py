@@ -0,0 +1,155 @@
+"""Local stand-in for a subscriber endpoint, used by the load benchmark.
+
+Answers webhook deliveries after a configurable latency, fails a share of
+them with 500s and lets another share hang past the delivery timeout. The
+time each delivery first arrives successfully is recorded by its
+X-Webhook-ID (or X-Webhook-IDs for batches) so end-to-end latency can be
+measured against the ingest time.
+
+    python -m benchmarks.receiver --port 9100 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class FakeReceiver:
+    """Threaded HTTP receiver with injected latency, errors and timeouts"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, timeout_rate=0.0, hang_seconds=15.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+
+        # Seeded so two runs with the same settings fail the same requests
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.received = {}
+        self.counts = Counter()
+
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def _outcome(self):
+        """Pick the delay and status code for the next request"""
+        with self._lock:
+            roll = self._random.random()
+            delay = max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+        if roll < self.timeout_rate:
+            return self.hang_seconds, 'timeout', 200
+        if roll < self.timeout_rate + self.error_rate:
+            return delay, 'error', 500
+        return delay, 'ok', 200
+
+    def _record(self, headers, outcome):
+        ids = headers.get('X-Webhook-IDs') or headers.get('X-Webhook-ID') or ''
+        now = time.time()
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts[outcome] += 1
+            if outcome != 'ok':
+                return
+            for delivery_id in filter(None, ids.split(',')):
+                self.counts['deliveries'] += 1
+                # Keep the first arrival; later ones are duplicates
+                self.received.setdefault(delivery_id, now)
+
+    def _handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                delay, outcome, status = receiver._outcome()
+                if delay:
+                    time.sleep(delay)
+                receiver._record(self.headers, outcome)
+                body = b'{"ok": true}' if status == 200 else b'{"error": "injected failure"}'
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The worker gave up waiting, as it should for a timeout
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def arrival_times(self):
+        """Copy of the first successful arrival time (epoch seconds) by delivery id"""
+        with self._lock:
+            return dict(self.received)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-receiver', daemon=True)
+        self._thread.start()
+        logger.info(f"Fake receiver listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+
+def add_receiver_arguments(parser):
+    parser.add_argument('--receiver-host', default='127.0.0.1')
+    parser.add_argument('--receiver-port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before the receiver answers')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 500')
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+                        help='share of requests held for --hang-seconds')
+    parser.add_argument('--hang-seconds', type=float, default=15.0,
+                        help='how long timed-out requests hang (above DELIVERY_TIMEOUT)')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def receiver_from_args(args):
+    return FakeReceiver(
+        host=args.receiver_host, port=args.receiver_port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, timeout_rate=args.timeout_rate, hang_seconds=args.hang_seconds,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake webhook receiver for load tests')
+    add_receiver_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    receiver = receiver_from_args(args).start()
+    try:
+        while True:
+            time.sleep(10)
+            logger.info(f"Receiver counts: {dict(receiver.counts)}")
+    except KeyboardInterrupt:
+        receiver.stop()
+
+
+if __name__ == '__main__':
+    main()
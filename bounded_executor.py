@@ -0,0 +1,129 @@
+import logging
+import os
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Reservation:
+    """Room held on a BoundedExecutor's queue for calls that may be submitted later"""
+
+    def __init__(self, executor, count):
+        self.executor = executor
+        self.count = count
+
+    def submit(self, func, args_list):
+        """Queue calls into the reserved room; returns False, queueing nothing, if they do not fit"""
+        count, self.count = self.count, 0
+        return self.executor.submit(func, args_list, reserved=count)
+
+    def release(self):
+        """Give back room that was not used"""
+        count, self.count = self.count, 0
+        if count:
+            self.executor.release(count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class BoundedExecutor:
+    """Fixed pool of daemon threads working through a bounded in-memory queue.
+
+    ``submit`` either queues every call it is given or none of them, so a
+    caller can report back-pressure instead of growing memory without
+    bound. ``reserve`` holds room ahead of time, for a caller that must know
+    there is room before it commits to work. Threads start on first use and
+    again after a fork, so pre-forking servers never inherit a parent's
+    threads or queue.
+    """
+
+    def __init__(self, max_workers=4, max_queue=1000, name='executor'):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.name = name
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._active = 0
+        self._reserved = 0
+        self._pid = None
+
+    def _ensure_threads(self):
+        """Start the worker threads in this process; call with the condition held"""
+        if self._pid == os.getpid():
+            return
+        # A forked child inherits the queue but not the threads working on it
+        self._queue.clear()
+        self._active = 0
+        self._threads = [
+            threading.Thread(target=self._work, name=f'{self.name}-{n}', daemon=True)
+            for n in range(self.max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                func, args = self._queue.popleft()
+                self._active += 1
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"{self.name} task failed: {str(e)}")
+            finally:
+                with self._condition:
+                    self._active -= 1
+                    self._condition.notify_all()
+
+    @property
+    def queued(self):
+        """Number of calls waiting for a thread"""
+        return len(self._queue)
+
+    def saturated(self):
+        """Check if the queue has no room left, counting reserved room as taken"""
+        return self.queued + self._reserved >= self.max_queue
+
+    def reserve(self, count):
+        """Hold room for ``count`` calls; returns a Reservation, or None if there is not enough room"""
+        with self._condition:
+            if len(self._queue) + self._reserved + count > self.max_queue:
+                return None
+            self._reserved += count
+        return Reservation(self, count)
+
+    def release(self, count):
+        """Give back ``count`` reserved calls' worth of room"""
+        with self._condition:
+            self._reserved -= count
+
+    def submit(self, func, args_list, reserved=0):
+        """Queue ``func(*args)`` for every args tuple; returns False, queueing nothing, if they do not fit.
+
+        ``reserved`` room held by the caller counts as free, and is given back
+        whether or not the calls fit.
+        """
+        args_list = list(args_list)
+        with self._condition:
+            self._reserved -= reserved
+            if len(self._queue) + self._reserved + len(args_list) > self.max_queue:
+                return False
+            self._ensure_threads()
+            self._queue.extend((func, args) for args in args_list)
+            self._condition.notify(len(args_list))
+        return True
+
+    def join(self, timeout=None):
+        """Wait until every queued call has finished; returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and not self._active, timeout=timeout)
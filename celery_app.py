@@ -1,5 +1,7 @@
 from celery import Celery
+from celery.signals import worker_process_shutdown
 import os
+import profiling
 from config import CELERY_BROKER_URL, CELERY_RESULT_BACKEND, CELERY_BEAT_SCHEDULE
 
 celery_app = Celery('webhook_delivery_service',
@@ -18,5 +20,14 @@ celery_app.conf.update(
     beat_schedule=CELERY_BEAT_SCHEDULE,
 )
 
+# Opt-in query counting and sampled profiling of tasks such as process_webhook
+profiling.init_celery()
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid=None, **kwargs):
+    """Drop an exiting prefork child's live gauges from the aggregated metrics"""
+    import metrics
+    metrics.mark_process_dead(pid or os.getpid())
+
 if __name__ == '__main__':
     celery_app.start()
@@ -0,0 +1,176 @@
+import logging
+
+import redis
+
+from config import (
+    CIRCUIT_BREAKER_ENABLED,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_OPEN_SECONDS,
+    CIRCUIT_PROBE_TIMEOUT,
+    REDIS_URL,
+)
+from redis_client import RedisClient
+
+logger = logging.getLogger(__name__)
+
+# Idle breaker state expires after a day
+STATE_TTL = 86400
+
+# Decisions returned by CircuitBreaker.allow
+CLOSED = 'closed'
+OPEN = 'open'
+PROBE = 'probe'
+
+# KEYS: breaker hash
+# ARGV: open duration (ms), probe timeout (ms)
+# Returns {decision, ms until a probe is due}
+ALLOW_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'state', 'opened_at', 'probe_until')
+if not state[1] or state[1] == 'closed' then
+    return {'closed', 0}
+end
+
+if state[1] == 'open' then
+    local reopen_at = tonumber(state[2]) + tonumber(ARGV[1])
+    if now < reopen_at then
+        return {'open', reopen_at - now}
+    end
+elseif now < tonumber(state[3]) then
+    -- Half-open with a probe still in flight
+    return {'open', tonumber(state[3]) - now}
+end
+
+redis.call('HSET', KEYS[1], 'state', 'half_open', 'probe_until', now + tonumber(ARGV[2]))
+return {'probe', 0}
+"""
+
+# KEYS: breaker hash
+# ARGV: success (0/1), failure threshold
+# Returns 1 if the circuit closed again after being open
+RECORD_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+
+local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+
+if ARGV[1] == '1' then
+    if state ~= 'closed' then
+        redis.call('DEL', KEYS[1])
+        return 1
+    end
+    redis.call('HDEL', KEYS[1], 'failures')
+    return 0
+end
+
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+if state == 'half_open' or failures >= tonumber(ARGV[2]) then
+    redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', now, 'failures', 0)
+end
+redis.call('EXPIRE', KEYS[1], %(state_ttl)d)
+return 0
+""" % {'state_ttl': STATE_TTL}
+
+
+def is_failure(status_code=None, no_response=False):
+    """Whether an attempt outcome (a timeout, connection error, 4xx or 5xx) counts against the circuit.
+
+    Unlike the throttle, the breaker also counts client errors: an endpoint
+    answering 401, 404 or 410 rejects every delivery until it is fixed.
+    """
+    if no_response:
+        return True
+    return status_code is not None and status_code >= 400
+
+
+class CircuitBreaker:
+    """Per-subscription circuit breaker shared by every worker through Redis.
+
+    ``failure_threshold`` consecutive failed attempts open the circuit. While
+    it is open, deliveries are parked without making HTTP requests. After
+    ``open_seconds`` a single probe is let through (half-open): success closes
+    the circuit, so parked deliveries can be drained, and failure opens it
+    again. A probe that never reports back is replaced after ``probe_timeout``
+    seconds. When Redis is unavailable the circuit is treated as closed.
+    """
+
+    def __init__(self, redis_url, failure_threshold=5, open_seconds=60, probe_timeout=20, enabled=True):
+        self.redis_url = redis_url
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.probe_timeout = probe_timeout
+        self.enabled = enabled
+
+        self._redis = RedisClient(redis_url, 'Circuit breaker unavailable, treating circuits as closed')
+
+    @staticmethod
+    def _key(subscription_id):
+        return f"circuit:{subscription_id}"
+
+    def allow(self, subscription_id):
+        """Return CLOSED or PROBE if an attempt may be made now, otherwise OPEN"""
+        if not self.enabled or self._redis.get() is None:
+            return CLOSED
+        try:
+            decision, _ = self._redis.script(ALLOW_SCRIPT)(
+                keys=[self._key(subscription_id)],
+                args=[int(self.open_seconds * 1000), int(self.probe_timeout * 1000)]
+            )
+        except redis.RedisError as e:
+            self._redis.failed(e)
+            return CLOSED
+
+        decision = decision.decode() if isinstance(decision, bytes) else decision
+        if decision == PROBE:
+            logger.info(f"Circuit for subscription {subscription_id} is half-open, sending a probe")
+        return decision
+
+    def record(self, subscription_id, success):
+        """Record an attempt outcome; returns True when it closed an open circuit"""
+        if not self.enabled or self._redis.get() is None:
+            return False
+        try:
+            recovered = self._redis.script(RECORD_SCRIPT)(
+                keys=[self._key(subscription_id)],
+                args=[int(bool(success)), self.failure_threshold]
+            )
+        except redis.RedisError as e:
+            self._redis.failed(e)
+            return False
+
+        if recovered:
+            logger.info(f"Circuit for subscription {subscription_id} closed, endpoint recovered")
+        return bool(recovered)
+
+    def state(self, subscription_id):
+        """Return ``(state, probe_due)`` for a circuit without changing it"""
+        client = self._redis.get() if self.enabled else None
+        if client is None:
+            return 'closed', False
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.hmget(self._key(subscription_id), 'state', 'opened_at', 'probe_until')
+            pipe.time()
+            (state, opened_at, probe_until), (seconds, microseconds) = pipe.execute()
+        except redis.RedisError as e:
+            self._redis.failed(e)
+            return 'closed', False
+
+        if not state:
+            return 'closed', False
+        state = state.decode()
+        now = seconds * 1000 + microseconds // 1000
+        if state == 'open':
+            return state, now >= int(opened_at) + int(self.open_seconds * 1000)
+        return state, now >= int(probe_until or 0)
+
+
+circuit_breaker = CircuitBreaker(
+    REDIS_URL,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+    open_seconds=CIRCUIT_OPEN_SECONDS,
+    probe_timeout=CIRCUIT_PROBE_TIMEOUT,
+    enabled=CIRCUIT_BREAKER_ENABLED,
+)
@@ -3,6 +3,22 @@ from datetime import timedelta
 
 SECRET_KEY = os.environ.get("SESSION_SECRET", "webhook-delivery-service-secret-key")
 DEBUG = os.environ.get("DEBUG", "True").lower() in ("true", "1", "t")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# Prometheus metrics (/metrics on the web and worker apps). Set
+# PROMETHEUS_MULTIPROC_DIR to a directory shared by every process on the host
+# (gunicorn workers, Celery prefork children, engines) to aggregate them.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# Opt-in instrumentation (profiling.py). QUERY_STATS_ENABLED counts SQL
+# statements and database time per request and Celery task, exposed as
+# X-DB-Query-Count / X-DB-Time-Ms headers and webhook_db_queries metrics.
+# A PROFILE_SAMPLE_RATE share of requests and tasks runs under cProfile and is
+# saved to PROFILE_DIR when it takes at least PROFILE_SLOW_SECONDS.
+QUERY_STATS_ENABLED = os.environ.get("QUERY_STATS_ENABLED", "False").lower() in ("true", "1", "t")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_SECONDS = float(os.environ.get("PROFILE_SLOW_SECONDS", "1.0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
 
 SQLALCHEMY_DATABASE_URI = os.environ.get(
     "DATABASE_URL", "postgresql://postgres:postgres@db:5432/webhookdb"
@@ -25,16 +41,147 @@ MAX_RETRY_ATTEMPTS = 5
 RETRY_DELAYS = [10, 30, 60, 300, 900]  # in seconds (10s, 30s, 1m, 5m, 15m)
 DELIVERY_TIMEOUT = 10  # seconds
 
+# Retries are stored as next_attempt_at on the delivery and handed to workers
+# by the dispatch-due-retries beat task, instead of waiting in the broker as
+# countdown tasks. Each delay is RETRY_DELAYS scaled by 1 +/- RETRY_JITTER.
+RETRY_JITTER = 0.2
+RETRY_SCHEDULER_INTERVAL = 5  # seconds between polls for due retries
+RETRY_SCHEDULER_BATCH_SIZE = int(os.environ.get("RETRY_SCHEDULER_BATCH_SIZE", "500"))
+RETRY_SCHEDULER_MAX_BATCHES = 20  # per poll, so one run cannot starve the beat schedule
+RETRY_CLAIM_LEASE = 600  # seconds before a claimed retry nobody attempted is claimed again
+
 # Log retention period (in hours)
 LOG_RETENTION_PERIOD = 72  # 72 hours = 3 days
 
+# Retention cleanup deletes expired deliveries in chunks, throttled so it
+# does not starve ingest and delivery of database I/O (0 = unthrottled)
+RETENTION_CHUNK_SIZE = int(os.environ.get("RETENTION_CHUNK_SIZE", "5000"))  # deliveries per transaction
+RETENTION_MAX_ROWS_PER_SECOND = int(os.environ.get("RETENTION_MAX_ROWS_PER_SECOND", "20000"))
+RETENTION_MAX_SECONDS = 50 * 60  # stop before the next hourly run starts
+
+# Range-partition webhook_deliveries and delivery_attempts by day of created_at.
+# Only applied when the schema is first created on PostgreSQL.
+DELIVERY_PARTITIONING = os.environ.get("DELIVERY_PARTITIONING", "False").lower() in ("true", "1", "t")
+DELIVERY_PARTITIONS_AHEAD = 3  # days of partitions created in advance
+
 # Celery beat schedule for log cleanup
 CELERY_BEAT_SCHEDULE = {
     'cleanup-delivery-logs': {
         'task': 'tasks.cleanup_old_delivery_logs',
         'schedule': timedelta(hours=1),  # Run every hour
     },
+    'dispatch-due-retries': {
+        'task': 'tasks.dispatch_due_retries',
+        'schedule': timedelta(seconds=RETRY_SCHEDULER_INTERVAL),
+    },
+    'probe-parked-deliveries': {
+        'task': 'tasks.probe_parked_deliveries',
+        'schedule': timedelta(seconds=30),
+    },
+    'maintain-delivery-partitions': {
+        'task': 'tasks.maintain_delivery_partitions',
+        'schedule': timedelta(hours=6),
+    },
 }
 
 # Cache configuration
-CACHE_DEFAULT_TIMEOUT = 300  # 5 minutes
\ No newline at end of file
+CACHE_DEFAULT_TIMEOUT = 300  # 5 minutes
+
+# Subscription cache: in-process LRU in front of the shared Redis cache.
+# The local TTL bounds how long other processes may serve a stale subscription
+# after it was updated or deleted.
+SUBSCRIPTION_CACHE_ENABLED = os.environ.get("SUBSCRIPTION_CACHE_ENABLED", "True").lower() in ("true", "1", "t")
+SUBSCRIPTION_CACHE_LOCAL_SIZE = int(os.environ.get("SUBSCRIPTION_CACHE_LOCAL_SIZE", "1024"))
+SUBSCRIPTION_CACHE_LOCAL_TTL = int(os.environ.get("SUBSCRIPTION_CACHE_LOCAL_TTL", "5"))  # seconds
+SUBSCRIPTION_CACHE_REDIS_TTL = CACHE_DEFAULT_TIMEOUT
+# Cached subscriptions hold their signing secret, stored in plain JSON in the
+# Redis tier, so that Redis must be trusted like the database. Set to false to
+# keep subscriptions that have a secret out of Redis (cached in-process only).
+SUBSCRIPTION_CACHE_REDIS_SECRETS = os.environ.get("SUBSCRIPTION_CACHE_REDIS_SECRETS", "True").lower() in ("true", "1", "t")
+
+# Event publishing (/api/publish): one event fans out to every active
+# subscription whose event types match, found through an in-process routing
+# index that polls for subscriptions changed by other processes
+ROUTING_INDEX_REFRESH = 5  # seconds
+ROUTING_INDEX_CACHE_SIZE = int(os.environ.get("ROUTING_INDEX_CACHE_SIZE", "1024"))  # event types whose matches are cached
+# /api/publish is disabled (503) unless set; publishers must sign events with it
+PUBLISH_SECRET = os.environ.get("PUBLISH_SECRET")
+
+# Outbound delivery connection pools (one keep-alive pool per target host)
+DELIVERY_POOL_MAXSIZE = int(os.environ.get("DELIVERY_POOL_MAXSIZE", "10"))  # connections per host
+DELIVERY_POOL_MAX_HOSTS = int(os.environ.get("DELIVERY_POOL_MAX_HOSTS", "100"))
+DELIVERY_POOL_IDLE_TIMEOUT = int(os.environ.get("DELIVERY_POOL_IDLE_TIMEOUT", "60"))  # seconds
+
+# Receiver response bodies are streamed and at most RESPONSE_CAPTURE_BYTES are
+# read; the connection is dropped rather than downloading the rest. Bodies of
+# failed attempts are always stored, those of successful attempts for a
+# RESPONSE_CAPTURE_SUCCESS_RATE share (0 = failed attempts only).
+RESPONSE_CAPTURE_BYTES = int(os.environ.get("RESPONSE_CAPTURE_BYTES", "1000"))
+RESPONSE_CAPTURE_SUCCESS_RATE = float(os.environ.get("RESPONSE_CAPTURE_SUCCESS_RATE", "1.0"))
+
+# Per-subscription delivery throttling, shared by all workers through Redis.
+# A token bucket caps the request rate; an AIMD limit caps concurrent requests,
+# growing while the endpoint is healthy and halving on timeouts, 429s and 5xx.
+DELIVERY_THROTTLE_ENABLED = os.environ.get("DELIVERY_THROTTLE_ENABLED", "True").lower() in ("true", "1", "t")
+DELIVERY_RATE_LIMIT = float(os.environ.get("DELIVERY_RATE_LIMIT", "20"))  # requests per second
+DELIVERY_RATE_BURST = int(os.environ.get("DELIVERY_RATE_BURST", "40"))
+DELIVERY_CONCURRENCY_INITIAL = 4
+DELIVERY_CONCURRENCY_MIN = 1
+DELIVERY_CONCURRENCY_MAX = int(os.environ.get("DELIVERY_CONCURRENCY_MAX", "50"))
+DELIVERY_LATENCY_TARGET = 2.0  # seconds; slower responses count as overload
+DELIVERY_CONCURRENCY_DECREASE_COOLDOWN = 1.0  # seconds between decreases
+DELIVERY_THROTTLE_RETRY_DELAY = 1.0  # seconds to defer when no slot is free
+DELIVERY_THROTTLE_LEASE_TTL = DELIVERY_TIMEOUT * 3  # seconds before a crashed worker's slot is reclaimed
+
+# Per-subscription circuit breaker: after CIRCUIT_FAILURE_THRESHOLD consecutive
+# failed attempts, deliveries are parked without HTTP requests until a single
+# probe sent every CIRCUIT_OPEN_SECONDS succeeds, then the backlog is drained
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "True").lower() in ("true", "1", "t")
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = int(os.environ.get("CIRCUIT_OPEN_SECONDS", "60"))
+CIRCUIT_PROBE_TIMEOUT = DELIVERY_TIMEOUT * 2  # seconds before a lost probe is replaced
+CIRCUIT_DRAIN_BATCH_SIZE = 500  # parked deliveries re-queued per batch on recovery
+
+# Ordered (FIFO) subscriptions are delivered one at a time, oldest first, by a
+# lane task. Subscriptions are hashed onto ORDERED_LANE_COUNT Celery queues
+# ("ordered.lane<n>") so lanes can be spread over worker nodes with
+# WORKER_LANES, and a Redis lease keeps each subscription on one worker at a time.
+ORDERED_LANE_COUNT = int(os.environ.get("ORDERED_LANE_COUNT", "8"))
+ORDERED_LANE_BATCH_SIZE = 100  # deliveries sent per lane task before yielding to other subscriptions
+ORDERED_LANE_LOCK_TTL = DELIVERY_TIMEOUT * 3  # seconds; renewed after every delivery
+
+# Batched delivery: subscriptions with batch_max_size > 1 receive up to that
+# many deliveries in one JSON array POST, collected over batch_window_ms
+DELIVERY_BATCH_MAX_SIZE = 500  # upper bound for a subscription's batch_max_size
+DELIVERY_BATCH_WINDOW_MS = 1000  # default coalescing window
+
+# Delivery engine used by workers: "celery" (one delivery per prefork process),
+# "async" (async_worker.py keeps many deliveries in flight per process) or
+# "queue" (queue_worker.py threads claim deliveries from PostgreSQL, no broker)
+DELIVERY_ENGINE = os.environ.get("DELIVERY_ENGINE", "celery").lower()
+ASYNC_WORKER_BATCH_SIZE = int(os.environ.get("ASYNC_WORKER_BATCH_SIZE", "200"))
+ASYNC_WORKER_MAX_IN_FLIGHT = int(os.environ.get("ASYNC_WORKER_MAX_IN_FLIGHT", "1000"))
+ASYNC_WORKER_PER_SUBSCRIPTION_LIMIT = int(os.environ.get("ASYNC_WORKER_PER_SUBSCRIPTION_LIMIT", "50"))
+ASYNC_WORKER_POLL_INTERVAL = 1.0  # seconds between polls when the queue is empty
+ASYNC_WORKER_DB_THREADS = int(os.environ.get("ASYNC_WORKER_DB_THREADS", "8"))
+ASYNC_WORKER_FLUSH_SIZE = int(os.environ.get("ASYNC_WORKER_FLUSH_SIZE", "200"))  # attempt results written per transaction
+ASYNC_WORKER_FLUSH_INTERVAL = 0.2  # seconds buffered attempt results may wait before being written
+QUEUE_WORKER_THREADS = int(os.environ.get("QUEUE_WORKER_THREADS", "8"))
+QUEUE_WORKER_BATCH_SIZE = int(os.environ.get("QUEUE_WORKER_BATCH_SIZE", "10"))  # deliveries claimed per thread
+QUEUE_WORKER_POLL_INTERVAL = 1.0  # seconds between polls when the queue is empty
+
+# Deliveries made without a queue (on Render or when Celery is unreachable)
+# run on background threads; ingest answers 503 while the queue is full
+DIRECT_DELIVERY_THREADS = int(os.environ.get("DIRECT_DELIVERY_THREADS", "4"))
+DIRECT_DELIVERY_QUEUE_SIZE = int(os.environ.get("DIRECT_DELIVERY_QUEUE_SIZE", "1000"))
+
+# Maximum number of events accepted by the batch ingest endpoint
+INGEST_BATCH_MAX_ITEMS = int(os.environ.get("INGEST_BATCH_MAX_ITEMS", "1000"))
+
+# Streaming NDJSON ingest: rows are flushed every INGEST_STREAM_BATCH_SIZE lines
+INGEST_STREAM_BATCH_SIZE = int(os.environ.get("INGEST_STREAM_BATCH_SIZE", "1000"))
+INGEST_STREAM_MAX_LINE_BYTES = 1024 * 1024  # 1 MB per event
+INGEST_STREAM_MAX_ERRORS = 1000  # per-line errors reported in the response
+
+# Subscriptions shown per page on the subscriptions list
+SUBSCRIPTIONS_PER_PAGE = 25
@@ -0,0 +1,198 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import DELIVERY_POOL_IDLE_TIMEOUT, DELIVERY_POOL_MAX_HOSTS, DELIVERY_POOL_MAXSIZE
+
+logger = logging.getLogger(__name__)
+
+# Log a pool usage summary every N requests
+STATS_LOG_INTERVAL = 1000
+
+
+class DeliveryClient:
+    """Keep-alive HTTP client with one bounded connection pool per target host.
+
+    Sessions are created lazily per ``scheme://host:port`` and reused across
+    every delivery made by the process. Hosts that have been idle longer than
+    ``idle_timeout`` seconds, or that fall off the end of the LRU once more than
+    ``max_hosts`` are in use, are closed; a session still serving a request is
+    closed once that request finishes. Sessions keep no cookies, since one
+    host can serve many subscribers. State is dropped after a fork so
+    prefork workers never share sockets with their parent.
+    """
+
+    def __init__(self, pool_maxsize=10, max_hosts=100, idle_timeout=60):
+        self.pool_maxsize = pool_maxsize
+        self.max_hosts = max_hosts
+        self.idle_timeout = idle_timeout
+
+        self._sessions = OrderedDict()  # host key -> (session, last_used)
+        self._in_use = {}  # session -> requests in progress
+        self._retired = set()  # evicted sessions waiting for their requests to finish
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._last_sweep = time.monotonic()
+
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.session_hits = 0
+        self.session_misses = 0
+        self.evictions = 0
+        self.requests = 0
+        # Connection counters of pools that have already been closed
+        self._closed_requests = 0
+        self._closed_connections = 0
+
+    @staticmethod
+    def _host_key(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def _new_session(self):
+        session = requests.Session()
+        # Never store or send cookies: a Set-Cookie from one subscriber's endpoint
+        # must not reach other subscriptions on the same host
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def _connection_pools(session):
+        pools = []
+        for adapter in set(session.adapters.values()):
+            manager = getattr(adapter, 'poolmanager', None)
+            if manager is not None:
+                pools.extend(manager.pools.get(key) for key in manager.pools.keys())
+        return pools
+
+    def _retire_session(self, session):
+        """Close an evicted session now, or once the requests using it finish"""
+        if self._in_use.get(session):
+            self._retired.add(session)
+        else:
+            self._close_session(session)
+
+    def _close_session(self, session):
+        for pool in filter(None, self._connection_pools(session)):
+            self._closed_requests += pool.num_requests
+            self._closed_connections += pool.num_connections
+        session.close()
+        self.evictions += 1
+
+    def _check_fork(self):
+        """Forget sessions inherited from a parent process"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._sessions = OrderedDict()
+            self._in_use = {}
+            self._retired = set()
+            self._lock = threading.Lock()
+            self._reset_counters()
+
+    def _evict_idle(self, now):
+        expired = [key for key, (_, last_used) in self._sessions.items()
+                   if now - last_used > self.idle_timeout]
+        for key in expired:
+            session, _ = self._sessions.pop(key)
+            self._retire_session(session)
+        self._last_sweep = now
+
+    def _session_for(self, url, acquire=False):
+        self._check_fork()
+        key = self._host_key(url)
+        now = time.monotonic()
+
+        with self._lock:
+            if now - self._last_sweep > self.idle_timeout:
+                self._evict_idle(now)
+
+            entry = self._sessions.get(key)
+            if entry is not None:
+                session = entry[0]
+                self.session_hits += 1
+            else:
+                session = self._new_session()
+                self.session_misses += 1
+
+            self._sessions[key] = (session, now)
+            self._sessions.move_to_end(key)
+
+            while len(self._sessions) > self.max_hosts:
+                _, (old_session, _) = self._sessions.popitem(last=False)
+                self._retire_session(old_session)
+
+            if acquire:
+                # Held until _release, so eviction cannot close it mid-request
+                self._in_use[session] = self._in_use.get(session, 0) + 1
+            self.requests += 1
+            if self.requests % STATS_LOG_INTERVAL == 0:
+                logger.info(f"Delivery connection pool stats: {self.stats()}")
+
+        return session
+
+    def _release(self, session):
+        with self._lock:
+            remaining = self._in_use.pop(session, 1) - 1
+            if remaining > 0:
+                self._in_use[session] = remaining
+            elif session in self._retired:
+                self._retired.discard(session)
+                self._close_session(session)
+
+    def post(self, url, **kwargs):
+        """POST through the pooled session for the URL's host"""
+        session = self._session_for(url, acquire=True)
+        try:
+            return session.post(url, **kwargs)
+        finally:
+            self._release(session)
+
+    def stats(self):
+        """Return pool usage counters for this process.
+
+        ``pool_misses`` counts new TCP/TLS connections opened and ``pool_hits``
+        counts requests that reused an already open connection.
+        """
+        total_requests = self._closed_requests
+        connections = self._closed_connections
+        for session, _ in list(self._sessions.values()):
+            for pool in filter(None, self._connection_pools(session)):
+                total_requests += pool.num_requests
+                connections += pool.num_connections
+
+        return {
+            'hosts': len(self._sessions),
+            'requests': total_requests,
+            'pool_hits': max(total_requests - connections, 0),
+            'pool_misses': connections,
+            'session_hits': self.session_hits,
+            'session_misses': self.session_misses,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        """Close every pooled connection"""
+        with self._lock:
+            while self._sessions:
+                _, (session, _) = self._sessions.popitem()
+                self._close_session(session)
+            while self._retired:
+                self._close_session(self._retired.pop())
+
+
+delivery_client = DeliveryClient(
+    pool_maxsize=DELIVERY_POOL_MAXSIZE,
+    max_hosts=DELIVERY_POOL_MAX_HOSTS,
+    idle_timeout=DELIVERY_POOL_IDLE_TIMEOUT,
+)
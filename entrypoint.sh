@@ -21,5 +21,11 @@ if [ $RETRY_COUNT -eq $MAX_RETRIES ]; then
   echo "PostgreSQL did not become ready in time, but continuing anyway..."
 fi
 
+# Apply schema migrations once per deploy, from the web container only
+if [ "${RUN_MIGRATIONS:-false}" = "true" ]; then
+  echo "Applying schema migrations..."
+  flask --app app db-upgrade
+fi
+
 # Execute the command passed to docker
 exec "$@"
\ No newline at end of file
@@ -0,0 +1,13 @@
+# Picked up by gunicorn from the working directory for both app:app and worker_app:app
+
+
+def on_starting(server):
+    # Drop metric samples left by a previous run before any worker starts
+    import metrics
+    metrics.reset_multiprocess_dir()
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges from the aggregated metrics
+    import metrics
+    metrics.mark_process_dead(worker.pid)
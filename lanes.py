@@ -0,0 +1,110 @@
+import hashlib
+import uuid
+
+import redis
+
+from config import ORDERED_LANE_COUNT, ORDERED_LANE_LOCK_TTL, REDIS_URL
+from redis_client import RedisClient
+
+# Token returned by LaneLock.acquire while Redis is unavailable
+UNLOCKED = 'unlocked'
+
+# KEYS: lane lock
+# ARGV: token, ttl (ms)
+EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lane lock
+# ARGV: token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def lane_for(subscription_id, lane_count=ORDERED_LANE_COUNT):
+    """Pick a subscription's lane by rendezvous (highest random weight) hashing.
+
+    Every process computes the same lane without coordination, and changing
+    the lane count only moves the subscriptions of the lanes added or removed.
+    """
+    def weight(lane):
+        digest = hashlib.md5(f"{subscription_id}:{lane}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    return max(range(lane_count), key=weight)
+
+
+def lane_queue(lane):
+    """Name of the Celery queue for a lane"""
+    return f"ordered.lane{lane}"
+
+
+def worker_queues(lanes=None, lane_count=ORDERED_LANE_COUNT):
+    """Queues for a worker: the default queue plus the given lanes (all lanes by default)"""
+    if lanes is None:
+        lanes = range(lane_count)
+    return ['celery'] + [lane_queue(lane) for lane in lanes]
+
+
+class LaneLock:
+    """Lease that lets only one worker run a subscription's lane at a time.
+
+    The lease expires after ``ttl`` seconds unless extended, so a lane whose
+    worker crashed is picked up again. When Redis is unavailable the lock is
+    not enforced and every caller gets the ``UNLOCKED`` token; routing each
+    subscription to a single lane queue still keeps one consumer per lane in
+    the usual deployment.
+    """
+
+    def __init__(self, redis_url, ttl=30):
+        self.redis_url = redis_url
+        self.ttl = ttl
+
+        self._redis = RedisClient(redis_url, 'Lane lock unavailable, not locking lanes')
+
+    @staticmethod
+    def _key(subscription_id):
+        return f"lane:{subscription_id}"
+
+    def acquire(self, subscription_id):
+        """Take the subscription's lane; returns a token, or None if another worker holds it"""
+        client = self._redis.get()
+        if client is None:
+            return UNLOCKED
+
+        token = uuid.uuid4().hex
+        try:
+            acquired = client.set(self._key(subscription_id), token, nx=True, px=int(self.ttl * 1000))
+        except redis.RedisError as e:
+            self._redis.failed(e)
+            return UNLOCKED
+        return token if acquired else None
+
+    def extend(self, subscription_id, token):
+        """Renew the lease; returns False if it was lost to another worker"""
+        if token == UNLOCKED or self._redis.get() is None:
+            return True
+        try:
+            return bool(self._redis.script(EXTEND_SCRIPT)(keys=[self._key(subscription_id)],
+                                                          args=[token, int(self.ttl * 1000)]))
+        except redis.RedisError as e:
+            self._redis.failed(e)
+            return True
+
+    def release(self, subscription_id, token):
+        if token == UNLOCKED or self._redis.get() is None:
+            return
+        try:
+            self._redis.script(RELEASE_SCRIPT)(keys=[self._key(subscription_id)], args=[token])
+        except redis.RedisError as e:
+            self._redis.failed(e)
+
+
+lane_lock = LaneLock(REDIS_URL, ttl=ORDERED_LANE_LOCK_TTL)
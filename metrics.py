@@ -0,0 +1,167 @@
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import PROMETHEUS_MULTIPROC_DIR
+
+# prometheus_client picks its multiprocess value store when it is imported,
+# so the directory has to exist first
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = ('delivered', 'failed')
+
+INGEST_LATENCY = Histogram(
+    'webhook_ingest_seconds', 'Time to accept an ingest or publish request', ['endpoint'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+DB_COMMIT_LATENCY = Histogram(
+    'webhook_db_commit_seconds', 'Time spent committing database transactions, including the flush',
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5),
+)
+DELIVERY_LATENCY = Histogram(
+    'webhook_delivery_http_seconds', 'Outbound delivery request latency', ['subscription_id'],
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+QUEUE_WAIT = Histogram(
+    'webhook_delivery_queue_wait_seconds', 'Time from ingest to the first delivery attempt',
+    buckets=(.1, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+ATTEMPTS_PER_DELIVERY = Histogram(
+    'webhook_delivery_attempts', 'Attempts made by deliveries that were delivered or failed',
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10),
+)
+DB_QUERIES = Histogram(
+    'webhook_db_queries', 'SQL statements per request or task (QUERY_STATS_ENABLED)', ['scope'],
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 200, 500),
+)
+DB_QUERY_TIME = Histogram(
+    'webhook_db_query_seconds', 'Database time per request or task (QUERY_STATS_ENABLED)', ['scope'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5),
+)
+IN_FLIGHT = Gauge(
+    'webhook_deliveries_in_flight', 'Outbound delivery requests in progress',
+    multiprocess_mode='livesum',
+)
+
+
+@contextmanager
+def delivery_request(subscription_id):
+    """Count an outbound delivery request as in flight and time it"""
+    IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        IN_FLIGHT.dec()
+        DELIVERY_LATENCY.labels(str(subscription_id)).observe(time.perf_counter() - started)
+
+
+def observe_queue_wait(created_at):
+    """Record how long a delivery waited for its first attempt"""
+    if created_at is not None:
+        QUEUE_WAIT.observe(max((datetime.utcnow() - created_at).total_seconds(), 0))
+
+
+@event.listens_for(Session, 'before_commit')
+def _commit_started(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_commit')
+def _commit_finished(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        DB_COMMIT_LATENCY.observe(time.perf_counter() - started)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _commit_failed(session):
+    session.info.pop('commit_started', None)
+
+
+@event.listens_for(Session, 'before_flush')
+def _observe_finished_deliveries(session, flush_context, instances):
+    """Record the attempt count of deliveries the ORM moves to delivered or failed"""
+    # Import models here to avoid circular imports
+    from models import WebhookDelivery
+
+    for obj in session.dirty:
+        if not isinstance(obj, WebhookDelivery) or obj.status not in FINISHED_STATUSES:
+            continue
+        history = inspect(obj).attrs.status.history
+        if history.added and history.deleted and history.deleted[0] != history.added[0]:
+            ATTEMPTS_PER_DELIVERY.observe(obj.attempt_count or 0)
+
+
+class BacklogCollector:
+    """Delivery backlog gauges, computed from the database at scrape time"""
+
+    def collect(self):
+        # Import here to avoid circular imports
+        from tasks import app_context
+
+        try:
+            with app_context() as db:
+                # Models can only be imported once the app is loaded
+                import stats
+                from models import WebhookDelivery
+
+                summary = stats.summarize()
+                retry_backlog = db.session.query(func.count(WebhookDelivery.id))\
+                    .filter(WebhookDelivery.status == 'processing', WebhookDelivery.attempt_count > 0)\
+                    .scalar()
+        except Exception as e:
+            logger.warning(f"Failed to collect delivery backlog metrics: {str(e)}")
+            return
+
+        backlog = GaugeMetricFamily('webhook_delivery_backlog', 'Unfinished deliveries by status',
+                                    labels=['status'])
+        for status in ('pending', 'processing', 'parked'):
+            backlog.add_metric([status], summary[status])
+        yield backlog
+        yield GaugeMetricFamily('webhook_retry_backlog',
+                                'Unfinished deliveries that failed at least once', value=retry_backlog)
+
+
+backlog_registry = CollectorRegistry()
+backlog_registry.register(BacklogCollector())
+
+
+def render_metrics():
+    """Return ``(body, content type)`` for a /metrics response.
+
+    With PROMETHEUS_MULTIPROC_DIR set, samples written by every gunicorn,
+    Celery and engine process on the host are aggregated; otherwise only
+    this process's metrics are exposed.
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(backlog_registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Drop a finished process's live gauges from the multiprocess aggregate"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def reset_multiprocess_dir():
+    """Remove samples left by a previous run; call once before any worker process starts"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
@@ -0,0 +1,320 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+# Key of the Postgres advisory lock held while migrating, so containers
+# running db-upgrade together do not race each other
+MIGRATION_LOCK_KEY = 72173
+
+PARTITIONED_TABLES = ('webhook_deliveries', 'delivery_attempts')
+
+# Rows updated per statement by data backfills
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _is_postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def _create_tables(connection):
+    """Create every model table; optionally range-partition the delivery tables by created_at"""
+    # Import models here to avoid circular imports
+    from app import db
+    from config import DELIVERY_PARTITIONING
+    import models  # noqa: F401  (registers the tables on db.metadata)
+
+    partitioned = DELIVERY_PARTITIONING and _is_postgres(connection)
+    existing = set(inspect(connection).get_table_names())
+    if partitioned and any(table in existing for table in PARTITIONED_TABLES):
+        logger.warning("Delivery tables already exist unpartitioned; "
+                       "partitioning is only applied to new databases")
+        partitioned = False
+
+    if not partitioned:
+        db.metadata.create_all(connection, checkfirst=True)
+        return
+
+    db.metadata.create_all(connection, checkfirst=True, tables=[
+        table for name, table in db.metadata.tables.items() if name not in PARTITIONED_TABLES
+    ])
+
+    # Partitioned tables need created_at in every unique constraint, so the
+    # primary keys become (id, created_at) and delivery_attempts can no longer
+    # reference webhook_deliveries(id) with a foreign key. Their indexes are
+    # created by the next migration.
+    connection.execute(text("""
+        CREATE TABLE webhook_deliveries (
+            id UUID NOT NULL,
+            subscription_id INTEGER NOT NULL REFERENCES subscriptions (id),
+            payload JSONB NOT NULL,
+            event_type VARCHAR(100),
+            status VARCHAR(20),
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            updated_at TIMESTAMP WITHOUT TIME ZONE,
+            completed_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """))
+    connection.execute(text("""
+        CREATE TABLE delivery_attempts (
+            id UUID NOT NULL,
+            delivery_id UUID NOT NULL,
+            attempt_number INTEGER NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            status_code INTEGER,
+            error_details TEXT,
+            response_body TEXT,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """))
+    ensure_partitions(connection)
+
+
+def _create_index(connection, name, table, columns):
+    """Create an index if it is missing, without blocking writes to the table on Postgres.
+
+    CREATE INDEX CONCURRENTLY cannot run inside a transaction (see
+    NON_TRANSACTIONAL_MIGRATIONS) or on a partitioned table; partitioned tables
+    only exist on new databases, so they are indexed directly. A concurrent
+    build that failed part way leaves an invalid index behind, which is rebuilt.
+    """
+    if not _is_postgres(connection) or table in partitioned_tables(connection):
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+        return
+
+    invalid = connection.execute(text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {'name': name}).first()
+    if invalid:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def _create_delivery_indexes(connection):
+    """Index the columns used by per-subscription listings, attempt counts and retention"""
+    indexes = [
+        ('ix_webhook_deliveries_created_at_id', 'webhook_deliveries', 'created_at, id'),
+        ('ix_webhook_deliveries_subscription_created_at', 'webhook_deliveries', 'subscription_id, created_at, id'),
+        ('ix_webhook_deliveries_status_created_at', 'webhook_deliveries', 'status, created_at, id'),
+        ('ix_delivery_attempts_delivery_id', 'delivery_attempts', 'delivery_id, attempt_number'),
+        ('ix_delivery_attempts_created_at', 'delivery_attempts', 'created_at'),
+    ]
+    for name, table, columns in indexes:
+        _create_index(connection, name, table, columns)
+
+
+def _add_model_columns(connection, table_name, column_names):
+    """Add columns declared on a model to an existing table if they are missing"""
+    # Import models here to avoid circular imports
+    from app import db
+    import models  # noqa: F401  (registers the tables on db.metadata)
+
+    table = db.metadata.tables[table_name]
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    for name in column_names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        ddl = f"ALTER TABLE {table_name} ADD COLUMN {name} {column.type.compile(dialect=connection.dialect)}"
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+        connection.execute(text(ddl))
+
+
+def _add_retry_schedule(connection):
+    """Add next_attempt_at and the index the retry scheduler polls"""
+    _add_model_columns(connection, 'webhook_deliveries', ['next_attempt_at'])
+    _create_index(connection, 'ix_webhook_deliveries_status_next_attempt_at',
+                  'webhook_deliveries', 'status, next_attempt_at')
+
+
+def _add_attempt_count(connection):
+    """Add attempt_count and fill it in from the attempts already recorded.
+
+    The backfill walks the table by id in BACKFILL_BATCH_SIZE chunks; on
+    Postgres each chunk commits on its own, so no lock is held on the whole table.
+    """
+    _add_model_columns(connection, 'webhook_deliveries', ['attempt_count'])
+
+    last_id = None
+    while True:
+        after = "" if last_id is None else "WHERE id > :last_id "
+        ids = connection.execute(text(
+            f"SELECT id FROM webhook_deliveries {after}ORDER BY id LIMIT :limit"
+        ), {'last_id': last_id, 'limit': BACKFILL_BATCH_SIZE}).scalars().all()
+        if not ids:
+            break
+
+        after = "" if last_id is None else "id > :last_id AND "
+        connection.execute(text(
+            "UPDATE webhook_deliveries SET attempt_count = ("
+            "SELECT COUNT(*) FROM delivery_attempts WHERE delivery_attempts.delivery_id = webhook_deliveries.id"
+            f") WHERE {after}id <= :chunk_end AND attempt_count = 0"
+        ), {'last_id': last_id, 'chunk_end': ids[-1]})
+        last_id = ids[-1]
+
+
+# Ordered schema migrations: (version, description, function(connection)).
+# Migrations must be idempotent, because a new database is created from the
+# current models by the first migration before the later ones run.
+MIGRATIONS = [
+    (1, 'create tables', _create_tables),
+    (2, 'delivery indexes', _create_delivery_indexes),
+    (3, 'delivery raw body and signature', lambda connection: _add_model_columns(
+        connection, 'webhook_deliveries', ['raw_body', 'signature', 'signature_key'])),
+    (4, 'parked delivery rollup counter', lambda connection: _add_model_columns(
+        connection, 'delivery_stats_rollups', ['parked'])),
+    (5, 'ordered subscriptions', lambda connection: _add_model_columns(
+        connection, 'subscriptions', ['ordered'])),
+    (6, 'batched delivery settings', lambda connection: _add_model_columns(
+        connection, 'subscriptions', ['batch_max_size', 'batch_window_ms'])),
+    (7, 'delivery retry schedule', _add_retry_schedule),
+    (8, 'delivery attempt count', _add_attempt_count),
+    (9, 'subscription updated_at index', lambda connection: _create_index(
+        connection, 'ix_subscriptions_updated_at', 'subscriptions', 'updated_at')),
+]
+
+# Migrations that build indexes concurrently or backfill in chunks. On Postgres
+# they run on an autocommit connection instead of inside a single transaction.
+NON_TRANSACTIONAL_MIGRATIONS = {2, 7, 8, 9}
+
+
+def _ensure_version_table(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP NOT NULL
+        )
+    """))
+
+
+def applied_versions(connection):
+    """Return the set of migration versions recorded in schema_migrations"""
+    _ensure_version_table(connection)
+    return {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def _record_version(connection, version, description):
+    connection.execute(
+        text("INSERT INTO schema_migrations (version, description, applied_at) "
+             "VALUES (:version, :description, :applied_at)"),
+        {'version': version, 'description': description, 'applied_at': datetime.utcnow()}
+    )
+
+
+def upgrade(engine):
+    """Apply pending migrations in order.
+
+    Run from ``flask db-upgrade`` rather than at import, so serving processes
+    never take migration locks. Each migration runs in its own transaction,
+    except NON_TRANSACTIONAL_MIGRATIONS on Postgres, which are idempotent and
+    are simply re-run if interrupted.
+    """
+    applied = []
+    with engine.connect() as connection:
+        postgres = _is_postgres(connection)
+        if postgres:
+            # Session-level lock, so it is also held across the autocommit migrations
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+        done = applied_versions(connection)
+        connection.commit()
+
+        try:
+            for version, description, migrate in MIGRATIONS:
+                if version in done:
+                    continue
+
+                logger.info(f"Applying schema migration {version}: {description}")
+                if postgres and version in NON_TRANSACTIONAL_MIGRATIONS:
+                    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as autocommit:
+                        migrate(autocommit)
+                    with connection.begin():
+                        _record_version(connection, version, description)
+                else:
+                    with connection.begin():
+                        migrate(connection)
+                        _record_version(connection, version, description)
+                applied.append(version)
+        finally:
+            if postgres:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_LOCK_KEY})
+                connection.commit()
+    return applied
+
+
+# Partition maintenance
+
+def _partition_name(table, day):
+    return f"{table}_p{day:%Y%m%d}"
+
+
+def partitioned_tables(connection):
+    """Return the names of the delivery tables that are range partitioned"""
+    if not _is_postgres(connection):
+        return []
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = ANY(:tables)"
+    ), {'tables': list(PARTITIONED_TABLES)})
+    return [row[0] for row in rows]
+
+
+def ensure_partitions(connection, days_back=None, days_ahead=None, now=None):
+    """Create the daily partitions covering the retention window and the next few days"""
+    from config import DELIVERY_PARTITIONS_AHEAD, LOG_RETENTION_PERIOD
+
+    if days_back is None:
+        days_back = LOG_RETENTION_PERIOD // 24 + 1
+    if days_ahead is None:
+        days_ahead = DELIVERY_PARTITIONS_AHEAD
+    today = (now or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    created = 0
+    for table in partitioned_tables(connection):
+        # Rows outside the pre-created range (old backfills) land in the default partition
+        connection.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+        for offset in range(-days_back, days_ahead + 1):
+            start = today + timedelta(days=offset)
+            end = start + timedelta(days=1)
+            result = connection.execute(text("SELECT to_regclass(:name)"),
+                                        {'name': _partition_name(table, start)})
+            if result.scalar() is not None:
+                continue
+            connection.execute(text(
+                f"CREATE TABLE {_partition_name(table, start)} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+            ))
+            created += 1
+    return created
+
+
+def drop_expired_partitions(connection, cutoff):
+    """Drop daily partitions that only hold rows created before ``cutoff``.
+
+    Returns the dropped partition names.
+    """
+    dropped = []
+    for table in partitioned_tables(connection):
+        rows = connection.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :table ORDER BY c.relname"
+        ), {'table': table})
+        for (name,) in rows.fetchall():
+            try:
+                day = datetime.strptime(name[len(table) + 2:], '%Y%m%d')
+            except ValueError:
+                continue
+            if day + timedelta(days=1) <= cutoff:
+                connection.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+    return dropped
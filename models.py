@@ -3,10 +3,15 @@ from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.dialects.postgresql import UUID, JSONB, ARRAY
 from sqlalchemy.ext.mutable import MutableList
+from sqlalchemy.orm import mapped_column
 from app import db
 
 class Subscription(db.Model):
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        # Routing indexes polling for subscriptions changed by other processes
+        db.Index('ix_subscriptions_updated_at', 'updated_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=True)
@@ -14,12 +19,19 @@ class Subscription(db.Model):
     secret = db.Column(db.String(255), nullable=True)
     event_types = db.Column(MutableList.as_mutable(ARRAY(db.String)), nullable=True)
     status = db.Column(db.String(20), default='active')  # active, inactive
+    # Deliver one at a time in ingest order through an ordered lane
+    ordered = db.Column(db.Boolean, nullable=False, default=False, server_default=db.text('false'))
+    # Coalesce up to batch_max_size deliveries, collected over batch_window_ms, into one POST
+    batch_max_size = db.Column(db.Integer, nullable=True)
+    batch_window_ms = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
     deliveries = db.relationship('WebhookDelivery', backref='subscription', lazy=True,
                                 cascade='all, delete-orphan')
+    stats_rollups = db.relationship('DeliveryStatsRollup', lazy=True,
+                                    cascade='all, delete-orphan', passive_deletes=True)
     
     def to_dict(self):
         return {
@@ -29,6 +41,9 @@ class Subscription(db.Model):
             'secret': '••••••' if self.secret else None,  # Hide actual secret
             'event_types': self.event_types,
             'status': self.status,
+            'ordered': self.ordered,
+            'batch_max_size': self.batch_max_size,
+            'batch_window_ms': self.batch_window_ms,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
@@ -38,40 +53,51 @@ class Subscription(db.Model):
         """Check if the subscription has a secret configured"""
         return bool(self.secret and self.secret.strip())
         
+    @property
+    def batched(self):
+        """Check if deliveries are coalesced into batch POSTs"""
+        return bool(self.batch_max_size and self.batch_max_size > 1)
+        
     @property
     def delivery_stats(self):
         """Get delivery statistics for this subscription"""
-        from sqlalchemy import func
-        
-        # Get total deliveries
-        total_deliveries = db.session.query(func.count(WebhookDelivery.id))\
-            .filter(WebhookDelivery.subscription_id == self.id).scalar() or 0
-            
-        # Get successful deliveries
-        successful_deliveries = db.session.query(func.count(WebhookDelivery.id))\
-            .filter(WebhookDelivery.subscription_id == self.id)\
-            .filter(WebhookDelivery.status == 'delivered').scalar() or 0
-            
-        # Calculate success rate
-        success_rate = (successful_deliveries / total_deliveries * 100) if total_deliveries > 0 else 0
+        from stats import summarize
         
+        summary = summarize(self.id)
         return {
-            'total': total_deliveries,
-            'successful': successful_deliveries,
-            'success_rate': round(success_rate, 1)
+            'total': summary['total'],
+            'successful': summary['delivered'],
+            'success_rate': round(summary['success_rate'], 1)
         }
 
 class WebhookDelivery(db.Model):
     __tablename__ = 'webhook_deliveries'
+    __table_args__ = (
+        # Keyset pagination on (created_at, id), overall and per subscription or status
+        db.Index('ix_webhook_deliveries_created_at_id', 'created_at', 'id'),
+        db.Index('ix_webhook_deliveries_subscription_created_at', 'subscription_id', 'created_at', 'id'),
+        db.Index('ix_webhook_deliveries_status_created_at', 'status', 'created_at', 'id'),
+        # Polling for due retries
+        db.Index('ix_webhook_deliveries_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
     
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     subscription_id = db.Column(db.Integer, db.ForeignKey('subscriptions.id'), nullable=False)
     payload = db.Column(JSONB, nullable=False)
+    # Canonical request body, sent as-is on every attempt, and its signature
+    raw_body = db.Column(db.LargeBinary, nullable=True)
+    signature = db.Column(db.String(71), nullable=True)  # sha256=<hex>
+    signature_key = db.Column(db.String(16), nullable=True)  # fingerprint of the secret that signed it
     event_type = db.Column(db.String(100), nullable=True)
-    status = db.Column(db.String(20), default='pending')  # pending, processing, delivered, failed
+    # Old values are loaded on change so status transitions can update the stats rollups
+    status = mapped_column(db.String(20), default='pending', active_history=True)  # pending, processing, delivered, failed, parked
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     completed_at = db.Column(db.DateTime, nullable=True)
+    # When a failed delivery is retried; while an attempt runs, when it may be claimed again
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    # Attempts made so far, kept here so workers never count delivery_attempts rows
+    attempt_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     # Relationships
     attempts = db.relationship('DeliveryAttempt', backref='delivery', lazy=True,
@@ -83,6 +109,7 @@ class WebhookDelivery(db.Model):
             'subscription_id': self.subscription_id,
             'event_type': self.event_type,
             'status': self.status,
+            'attempt_count': self.attempt_count,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat(),
             'completed_at': self.completed_at.isoformat() if self.completed_at else None
@@ -90,6 +117,10 @@ class WebhookDelivery(db.Model):
 
 class DeliveryAttempt(db.Model):
     __tablename__ = 'delivery_attempts'
+    __table_args__ = (
+        db.Index('ix_delivery_attempts_delivery_id', 'delivery_id', 'attempt_number'),
+        db.Index('ix_delivery_attempts_created_at', 'created_at'),
+    )
     
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     delivery_id = db.Column(UUID(as_uuid=True), db.ForeignKey('webhook_deliveries.id'), nullable=False)
@@ -110,3 +141,16 @@ class DeliveryAttempt(db.Model):
             'error_details': self.error_details,
             'created_at': self.created_at.isoformat()
         }
+
+class DeliveryStatsRollup(db.Model):
+    """Delivery counters per subscription and creation hour, maintained incrementally"""
+    __tablename__ = 'delivery_stats_rollups'
+    
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscriptions.id', ondelete='CASCADE'), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)  # hour the deliveries were created in
+    pending = db.Column(db.Integer, nullable=False, default=0)
+    processing = db.Column(db.Integer, nullable=False, default=0)
+    delivered = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    parked = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,56 @@
+import base64
+import json
+import uuid
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+# Largest page an API client may ask for
+MAX_PAGE_SIZE = 100
+
+
+def page_size(limit, maximum=MAX_PAGE_SIZE):
+    """Clamp a requested page size to 1..``maximum``"""
+    return max(1, min(limit, maximum))
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+def encode_cursor(created_at, row_id):
+    """Encode the (created_at, id) position of a row as an opaque cursor"""
+    raw = json.dumps([created_at.isoformat(), str(row_id)]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor into (created_at, id)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), uuid.UUID(row_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f'Invalid cursor: {cursor}') from e
+
+
+def keyset_page(query, model, cursor=None, limit=20):
+    """Return (items, next_cursor) for a query ordered by (created_at, id) descending.
+
+    Rows are located by seeking past the cursor position instead of using
+    OFFSET, so every page costs the same regardless of depth. One extra row is
+    fetched to tell whether another page exists; no COUNT is issued.
+    """
+    limit = max(limit, 1)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.filter(tuple_(model.created_at, model.id) < tuple_(created_at, row_id))
+
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
+
+    items = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(items[-1].created_at, items[-1].id)
+    return items, next_cursor
@@ -0,0 +1,185 @@
+import cProfile
+import logging
+import os
+import random
+import re
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import PROFILE_DIR, PROFILE_SAMPLE_RATE, PROFILE_SLOW_SECONDS, QUERY_STATS_ENABLED
+
+logger = logging.getLogger(__name__)
+
+# Statement counter of the request or task running in this thread, if any
+_current = ContextVar('query_stats', default=None)
+_listening = False
+
+
+class QueryStats:
+    """SQL statements run and time spent in the database by one request or task"""
+
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = conn.info.get('query_started')
+    if stats is not None and started:
+        stats.count += 1
+        stats.seconds += time.perf_counter() - started.pop()
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+def _listen():
+    """Attach the statement timers to every engine, on first use"""
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _listening = True
+
+
+class Scope:
+    """Instrumentation of one request or task, from ``begin`` to ``finish``"""
+
+    def __init__(self, kind, name, stats, token, profiler):
+        self.kind = kind
+        self.name = name
+        self.stats = stats
+        self.token = token
+        self.profiler = profiler
+        self.started = time.perf_counter()
+
+
+def begin(kind, name, count_queries=QUERY_STATS_ENABLED, sample_rate=PROFILE_SAMPLE_RATE):
+    """Start counting queries and, for a sampled share, profiling; returns None when both are off"""
+    profile = sample_rate > 0 and random.random() < sample_rate
+    if not (count_queries or profile):
+        return None
+
+    stats = token = None
+    if count_queries:
+        _listen()
+        stats = QueryStats()
+        token = _current.set(stats)
+
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            profiler = None
+    return Scope(kind, name, stats, token, profiler)
+
+
+def finish(scope, slow_seconds=PROFILE_SLOW_SECONDS, profile_dir=PROFILE_DIR):
+    """Stop a scope, record its query metrics and save its profile if it was slow; returns its QueryStats"""
+    # Import here so the module can be used before the metrics are needed
+    import metrics
+
+    elapsed = time.perf_counter() - scope.started
+    if scope.profiler is not None:
+        scope.profiler.disable()
+        if elapsed >= slow_seconds:
+            save_profile(scope, elapsed, profile_dir)
+
+    if scope.stats is None:
+        return None
+    _current.reset(scope.token)
+    label = f"{scope.kind}:{scope.name}"
+    metrics.DB_QUERIES.labels(label).observe(scope.stats.count)
+    metrics.DB_QUERY_TIME.labels(label).observe(scope.stats.seconds)
+    return scope.stats
+
+
+def save_profile(scope, elapsed, profile_dir):
+    """Write a scope's cProfile stats (pstats format, for snakeviz or flameprof)"""
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', scope.name)
+    path = os.path.join(profile_dir, f"{scope.kind}-{name}-{int(time.time() * 1000)}-{os.getpid()}.prof")
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        scope.profiler.dump_stats(path)
+    except OSError as e:
+        logger.warning(f"Failed to save profile of {scope.kind} {scope.name}: {str(e)}")
+        return None
+    logger.info(f"Saved profile of slow {scope.kind} {scope.name} ({elapsed:.3f}s) to {path}")
+    return path
+
+
+def init_app(app):
+    """Instrument Flask requests; adds X-DB-Query-Count and X-DB-Time-Ms headers when counting queries"""
+    from flask import g, request
+
+    @app.before_request
+    def begin_request_scope():
+        g.profiling_scope = begin(
+            'request', request.endpoint or 'unmatched',
+            count_queries=app.config.get('QUERY_STATS_ENABLED', False),
+            sample_rate=app.config.get('PROFILE_SAMPLE_RATE', 0),
+        )
+
+    @app.after_request
+    def finish_request_scope(response):
+        scope = g.pop('profiling_scope', None)
+        if scope is not None:
+            stats = finish(scope, slow_seconds=app.config.get('PROFILE_SLOW_SECONDS', PROFILE_SLOW_SECONDS),
+                           profile_dir=app.config.get('PROFILE_DIR', PROFILE_DIR))
+            if stats is not None:
+                response.headers['X-DB-Query-Count'] = str(stats.count)
+                response.headers['X-DB-Time-Ms'] = f"{stats.seconds * 1000:.2f}"
+        return response
+
+    @app.teardown_request
+    def close_request_scope(exception=None):
+        # after_request does not run when the view raised
+        scope = g.pop('profiling_scope', None)
+        if scope is not None:
+            finish(scope)
+
+
+# Scopes of the Celery tasks running in this process, by task id
+_task_scopes = {}
+
+
+def _task_started(task_id=None, task=None, **kwargs):
+    scope = begin('task', task.name if task is not None else 'unknown')
+    if scope is not None:
+        _task_scopes[task_id] = scope
+
+
+def _task_finished(task_id=None, task=None, **kwargs):
+    scope = _task_scopes.pop(task_id, None)
+    if scope is not None:
+        stats = finish(scope)
+        if stats is not None:
+            logger.debug(f"Task {scope.name} ran {stats.count} queries in {stats.seconds * 1000:.2f}ms")
+
+
+def init_celery():
+    """Instrument Celery tasks (process_webhook and the rest) in worker processes"""
+    from celery.signals import task_postrun, task_prerun
+
+    if QUERY_STATS_ENABLED or PROFILE_SAMPLE_RATE > 0:
+        task_prerun.connect(_task_started, weak=False)
+        task_postrun.connect(_task_finished, weak=False)
@@ -0,0 +1,150 @@
+import logging
+import signal
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select, update
+
+from config import (
+    QUEUE_WORKER_BATCH_SIZE,
+    QUEUE_WORKER_POLL_INTERVAL,
+    QUEUE_WORKER_THREADS,
+    RETRY_CLAIM_LEASE,
+)
+from retry_scheduler import celery_only_subscriptions
+from tasks import app_context, deliver_webhook
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def claim_deliveries(session, limit, lease_seconds, now=None):
+    """Claim up to ``limit`` deliveries that are ready for an attempt and return their ids.
+
+    Ready means pending, or processing with an expired next_attempt_at (a due
+    retry, or an attempt whose worker died). Rows are locked with FOR UPDATE
+    SKIP LOCKED so concurrent workers claim disjoint sets, and leased by
+    pushing next_attempt_at ``lease_seconds`` ahead. Ordered and batched
+    subscriptions are left to their Celery tasks. Commits the claim.
+    """
+    # Import models here to avoid circular imports
+    from models import WebhookDelivery
+
+    now = now or datetime.utcnow()
+    deliveries = WebhookDelivery.__table__
+
+    ready = or_(
+        and_(deliveries.c.status == 'pending',
+             or_(deliveries.c.next_attempt_at.is_(None), deliveries.c.next_attempt_at <= now)),
+        and_(deliveries.c.status == 'processing', deliveries.c.next_attempt_at <= now),
+    )
+    ids = session.execute(
+        select(deliveries.c.id)
+        .where(ready, deliveries.c.subscription_id.notin_(celery_only_subscriptions()))
+        .order_by(deliveries.c.created_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if ids:
+        reschedule(session, ids, now + timedelta(seconds=lease_seconds))
+    session.commit()
+    return ids
+
+
+def reschedule(session, delivery_ids, next_attempt_at):
+    """Set next_attempt_at without touching the status, so the stats rollups are unaffected"""
+    # Import models here to avoid circular imports
+    from models import WebhookDelivery
+
+    deliveries = WebhookDelivery.__table__
+    session.execute(
+        update(deliveries)
+        .where(deliveries.c.id.in_(delivery_ids))
+        .values(next_attempt_at=next_attempt_at)
+    )
+
+
+class QueueWorker:
+    """Broker-less delivery worker that uses PostgreSQL as the work queue.
+
+    Each thread claims a small batch of ready deliveries with
+    ``FOR UPDATE SKIP LOCKED`` and attempts them one after another with the
+    same code as the ``process_webhook`` task. Claims are leases stored in
+    next_attempt_at, so deliveries held by a worker that died are claimed
+    again once the lease runs out. Throughput scales with threads and worker
+    processes. Run with ``python queue_worker.py`` and ``DELIVERY_ENGINE=queue``
+    so ingest leaves new deliveries pending for it.
+    """
+
+    def __init__(self, threads=QUEUE_WORKER_THREADS, batch_size=QUEUE_WORKER_BATCH_SIZE,
+                 poll_interval=QUEUE_WORKER_POLL_INTERVAL, lease=RETRY_CLAIM_LEASE):
+        self.threads = threads
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+
+        self._stopping = threading.Event()
+
+    def _claim(self):
+        with app_context() as db:
+            return claim_deliveries(db.session, self.batch_size, self.lease)
+
+    def _deliver_claimed(self, delivery_ids):
+        """Attempt claimed deliveries in order; hand back the rest if stopping"""
+        with app_context() as db:
+            for index, delivery_id in enumerate(delivery_ids):
+                if self._stopping.is_set():
+                    # Make the unattempted deliveries ready for another worker right away
+                    reschedule(db.session, delivery_ids[index:], datetime.utcnow())
+                    db.session.commit()
+                    return
+
+                # A throttled delivery parks itself on next_attempt_at instead of holding the lease
+                try:
+                    deliver_webhook(db, delivery_id)
+                except Exception as e:
+                    logger.error(f"Delivery {delivery_id} crashed: {str(e)}")
+                    db.session.rollback()
+
+    def _run_thread(self):
+        while not self._stopping.is_set():
+            try:
+                delivery_ids = self._claim()
+            except Exception as e:
+                logger.error(f"Failed to claim deliveries: {str(e)}")
+                delivery_ids = []
+
+            if delivery_ids:
+                self._deliver_claimed(delivery_ids)
+
+            # Claim again right away while there is a backlog
+            if len(delivery_ids) < self.batch_size:
+                self._stopping.wait(self.poll_interval)
+
+    def stop(self, *args):
+        self._stopping.set()
+
+    def run(self):
+        """Claim and deliver webhooks until stopped"""
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self.stop)
+
+        logger.info(f"Queue worker started: threads={self.threads}, batch_size={self.batch_size}")
+        workers = [
+            threading.Thread(target=self._run_thread, name=f'queue-worker-{n}', daemon=True)
+            for n in range(self.threads)
+        ]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=1.0)
+        logger.info("Queue worker stopped")
+
+
+def main():
+    QueueWorker().run()
+
+
+if __name__ == '__main__':
+    main()
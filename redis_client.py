@@ -0,0 +1,52 @@
+import logging
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds to stop talking to Redis after a connection failure
+REDIS_RETRY_BACKOFF = 30
+
+
+class RedisClient:
+    """Lazily created Redis connection for a feature that keeps working without Redis.
+
+    ``get`` returns None while Redis is unavailable. Once ``failed`` is called
+    with a Redis error, Redis is left alone for ``backoff`` seconds, so an
+    outage costs one short timeout rather than one per call.
+    """
+
+    def __init__(self, url, unavailable_message, backoff=REDIS_RETRY_BACKOFF, timeout=0.5):
+        self.url = url
+        self.unavailable_message = unavailable_message
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self._client = None
+        self._scripts = {}
+        self._disabled_until = 0
+
+    def get(self):
+        """Return a Redis client, or None while Redis is unavailable"""
+        if not self.url or time.monotonic() < self._disabled_until:
+            return None
+        if self._client is None:
+            self._client = redis.Redis.from_url(
+                self.url,
+                socket_connect_timeout=self.timeout,
+                socket_timeout=self.timeout,
+            )
+        return self._client
+
+    def script(self, source):
+        """Return the Lua script ``source`` registered on the client; call once ``get`` returned one"""
+        script = self._scripts.get(source)
+        if script is None:
+            script = self._scripts[source] = self._client.register_script(source)
+        return script
+
+    def failed(self, error):
+        """Log a Redis error and stop using Redis for ``backoff`` seconds"""
+        logger.warning(f"{self.unavailable_message}: {str(error)}")
+        self._disabled_until = time.monotonic() + self.backoff
@@ -0,0 +1,67 @@
+import random
+
+from config import RESPONSE_CAPTURE_BYTES, RESPONSE_CAPTURE_SUCCESS_RATE
+
+TRUNCATED_MARKER = '... [truncated]'
+
+# Largest single read while capturing a body
+READ_CHUNK_SIZE = 65536
+
+
+def should_store(status_code, success_rate=RESPONSE_CAPTURE_SUCCESS_RATE):
+    """Whether an attempt's response body is kept: always for failures, sampled for successes"""
+    if not 200 <= status_code < 300:
+        return True
+    return success_rate >= 1 or random.random() < success_rate
+
+
+def decode_captured(prefix, truncated, encoding=None):
+    """Decode only the captured bytes, marking bodies that were cut off"""
+    if not prefix and not truncated:
+        return ''
+    text = prefix.decode(encoding or 'utf-8', errors='replace')
+    return text + TRUNCATED_MARKER if truncated else text
+
+
+def capture_response_body(response, max_bytes=RESPONSE_CAPTURE_BYTES, success_rate=RESPONSE_CAPTURE_SUCCESS_RATE):
+    """Read at most ``max_bytes`` of a ``stream=True`` requests response and release it.
+
+    A body that fits is read to the end, so the connection goes back to the
+    pool; a longer one is abandoned and its connection closed instead of
+    downloading the rest. Returns the decoded prefix, or None when the body
+    is not stored.
+    """
+    chunks, size = [], 0
+    try:
+        # Read one byte past the budget to tell a body that fits from a longer one
+        for chunk in response.iter_content(chunk_size=min(max_bytes + 1, READ_CHUNK_SIZE)):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                break
+    finally:
+        # Closes the connection if the body was not read to the end, otherwise returns it to the pool
+        response.close()
+
+    if not should_store(response.status_code, success_rate):
+        return None
+    return decode_captured(b''.join(chunks)[:max_bytes], size > max_bytes, response.encoding)
+
+
+async def capture_response_body_async(response, max_bytes=RESPONSE_CAPTURE_BYTES,
+                                      success_rate=RESPONSE_CAPTURE_SUCCESS_RATE):
+    """aiohttp version of ``capture_response_body``"""
+    chunks, size = [], 0
+    while size <= max_bytes:
+        chunk = await response.content.read(min(max_bytes + 1 - size, READ_CHUNK_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    if size > max_bytes:
+        # Drop the connection rather than drain the rest of the body
+        response.close()
+
+    if not should_store(response.status, success_rate):
+        return None
+    return decode_captured(b''.join(chunks)[:max_bytes], size > max_bytes, response.charset)
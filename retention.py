@@ -0,0 +1,93 @@
+import logging
+import time
+
+from sqlalchemy import delete, select
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Sleep as needed to keep a running row count under ``rows_per_second``"""
+
+    def __init__(self, rows_per_second):
+        self.rows_per_second = rows_per_second
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def consume(self, rows):
+        self.rows += rows
+        if not self.rows_per_second:
+            return
+        ahead = self.rows / self.rows_per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def purge_expired_deliveries(session, cutoff, chunk_size=5000, rows_per_second=0, max_seconds=None):
+    """Delete deliveries created before ``cutoff`` and their attempts.
+
+    Daily partitions that lie entirely before the cutoff are dropped first when
+    the tables are partitioned. Remaining rows are removed oldest first in
+    chunks of at most ``chunk_size`` deliveries, with one set-based DELETE for
+    the chunk's attempts and one for the deliveries, each chunk in its own
+    transaction. ``rows_per_second`` (0 for unlimited) throttles the deletes
+    and ``max_seconds`` stops the run early; the next run picks up the rest.
+
+    Returns a dict of metrics for the run.
+    """
+    # Import models here to avoid circular imports
+    from migrations import drop_expired_partitions
+    from models import WebhookDelivery, DeliveryAttempt
+
+    deliveries = WebhookDelivery.__table__
+    attempts = DeliveryAttempt.__table__
+
+    started = time.monotonic()
+    metrics = {
+        'dropped_partitions': [],
+        'deleted_deliveries': 0,
+        'deleted_attempts': 0,
+        'chunks': 0,
+        'completed': True,
+    }
+
+    metrics['dropped_partitions'] = drop_expired_partitions(session.connection(), cutoff)
+    session.commit()
+
+    limiter = RateLimiter(rows_per_second)
+    while True:
+        if max_seconds is not None and time.monotonic() - started > max_seconds:
+            metrics['completed'] = False
+            break
+
+        ids = session.execute(
+            select(deliveries.c.id)
+            .where(deliveries.c.created_at < cutoff)
+            .order_by(deliveries.c.created_at)
+            .limit(chunk_size)
+        ).scalars().all()
+        if not ids:
+            break
+
+        # Attempts first (foreign key constraint)
+        deleted_attempts = session.execute(
+            delete(attempts).where(attempts.c.delivery_id.in_(ids))
+        ).rowcount
+        deleted_deliveries = session.execute(
+            delete(deliveries).where(deliveries.c.id.in_(ids))
+        ).rowcount
+        session.commit()
+
+        metrics['deleted_attempts'] += deleted_attempts
+        metrics['deleted_deliveries'] += deleted_deliveries
+        metrics['chunks'] += 1
+        limiter.consume(deleted_attempts + deleted_deliveries)
+
+        if len(ids) < chunk_size:
+            break
+
+    elapsed = time.monotonic() - started
+    rows = metrics['deleted_attempts'] + metrics['deleted_deliveries']
+    metrics['elapsed_seconds'] = round(elapsed, 3)
+    metrics['rows_per_second'] = round(rows / elapsed, 1) if elapsed > 0 else 0
+    return metrics
@@ -0,0 +1,113 @@
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_, select, update
+
+from config import RETRY_DELAYS, RETRY_JITTER
+
+
+def retry_delay(attempt_number, delays=RETRY_DELAYS, jitter=RETRY_JITTER):
+    """Seconds to wait after failed attempt ``attempt_number``.
+
+    The RETRY_DELAYS step is scaled by a random factor within ``jitter`` of 1,
+    so deliveries that failed together do not all come back at once.
+    """
+    base = delays[min(attempt_number - 1, len(delays) - 1)]
+    return base * random.uniform(1 - jitter, 1 + jitter)
+
+
+def schedule_retry(delivery, attempt_number, now=None):
+    """Set when a delivery whose attempt failed is retried; returns the delay in seconds"""
+    delay = retry_delay(attempt_number)
+    delivery.next_attempt_at = (now or datetime.utcnow()) + timedelta(seconds=delay)
+    return delay
+
+
+def celery_only_subscriptions(ordered=True, batched=True):
+    """Select the ids of ordered and/or batched subscriptions, which only Celery tasks deliver"""
+    # Import models here to avoid circular imports
+    from models import Subscription
+
+    subscriptions = Subscription.__table__
+    conditions = []
+    if ordered:
+        conditions.append(subscriptions.c.ordered.is_(True))
+    if batched:
+        conditions.append(subscriptions.c.batch_max_size > 1)
+    return select(subscriptions.c.id).where(or_(*conditions))
+
+
+def claim_due_retries(session, limit, lease_seconds, now=None, batched_only=False):
+    """Claim up to ``limit`` deliveries whose retry is due and return their ids.
+
+    Rows are locked with FOR UPDATE SKIP LOCKED, so concurrent schedulers
+    claim disjoint sets, and their next_attempt_at is pushed ``lease_seconds``
+    ahead. A delivery whose worker never reports back is claimed again once
+    the lease runs out. Deliveries still pending ``lease_seconds`` after
+    ingest were never handed to a worker (the broker was unreachable) and are
+    claimed too. Ordered subscriptions are left to their lanes (see
+    due_ordered_lanes); with ``batched_only`` only deliveries of batched
+    subscriptions are claimed. Commits the claim.
+    """
+    # Import models here to avoid circular imports
+    from models import WebhookDelivery
+
+    now = now or datetime.utcnow()
+    deliveries = WebhookDelivery.__table__
+
+    due = [
+        or_(
+            and_(deliveries.c.status == 'processing', deliveries.c.next_attempt_at <= now),
+            and_(deliveries.c.status == 'pending',
+                 deliveries.c.created_at <= now - timedelta(seconds=lease_seconds),
+                 or_(deliveries.c.next_attempt_at.is_(None), deliveries.c.next_attempt_at <= now)),
+        ),
+        deliveries.c.subscription_id.notin_(celery_only_subscriptions(batched=False)),
+    ]
+    if batched_only:
+        due.append(deliveries.c.subscription_id.in_(celery_only_subscriptions(ordered=False)))
+    ids = session.execute(
+        select(deliveries.c.id)
+        .where(*due)
+        .order_by(func.coalesce(deliveries.c.next_attempt_at, deliveries.c.created_at))
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if ids:
+        # The status does not change, so the stats rollups are unaffected
+        session.execute(
+            update(deliveries)
+            .where(deliveries.c.id.in_(ids))
+            .values(next_attempt_at=now + timedelta(seconds=lease_seconds))
+        )
+    session.commit()
+    return ids
+
+
+def due_ordered_lanes(session, limit, stalled_after, now=None):
+    """Ids of ordered subscriptions whose lane should be running but may have lost its message.
+
+    That is, lanes whose held delivery is due (a retry, a throttle or circuit
+    hold, or the lease of a worker that died) or with a delivery still pending
+    ``stalled_after`` seconds after ingest. Nothing is claimed: the lane lock
+    lets only one run through, and the lane moves the delivery on.
+    """
+    # Import models here to avoid circular imports
+    from models import WebhookDelivery
+
+    now = now or datetime.utcnow()
+    deliveries = WebhookDelivery.__table__
+
+    return session.execute(
+        select(deliveries.c.subscription_id)
+        .where(
+            deliveries.c.subscription_id.in_(celery_only_subscriptions(batched=False)),
+            or_(
+                and_(deliveries.c.status == 'processing', deliveries.c.next_attempt_at <= now),
+                and_(deliveries.c.status == 'pending',
+                     deliveries.c.created_at <= now - timedelta(seconds=stalled_after)),
+            )
+        )
+        .distinct()
+        .limit(limit)
+    ).scalars().all()
@@ -0,0 +1,192 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from functools import lru_cache
+
+from config import ROUTING_INDEX_CACHE_SIZE, ROUTING_INDEX_REFRESH
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4096)
+def _compile(pattern):
+    """Compile an event type pattern where ``*`` matches any run of characters"""
+    return re.compile('.*'.join(re.escape(part) for part in pattern.split('*')))
+
+
+def matches_event_type(patterns, event_type):
+    """Check an event type against a list of exact event types and ``*`` wildcard patterns"""
+    if event_type in patterns:
+        return True
+    return any('*' in pattern and _compile(pattern).fullmatch(event_type) for pattern in patterns)
+
+
+class RoutingIndex:
+    """In-process map from event type to the active subscriptions that accept it.
+
+    Subscriptions without event types accept every event. Exact event types
+    are looked up in a dict, patterns ending in their only ``*`` (``order.*``)
+    by the event type's prefixes, and any other pattern with a precompiled
+    regex; results are kept in a small LRU until the index changes.
+
+    The index is loaded on first use and then kept up to date incrementally:
+    subscriptions changed in this process are reloaded on the next lookup
+    (``mark_changed``), and subscriptions updated elsewhere are picked up by
+    polling ``updated_at`` every ``refresh_interval`` seconds.
+    """
+
+    def __init__(self, loader, refresh_interval=5, cache_size=1024):
+        # loader(ids=None, updated_since=None) -> rows of (id, status, event_types, updated_at)
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._refreshed_at = 0
+        self._high_water = None
+        self._changed = set()
+        self._reset()
+
+    def _reset(self):
+        self._routes = {}
+        self._catch_all = set()
+        self._exact = {}
+        self._prefixes = {}
+        self._patterns = {}
+        self._results = OrderedDict()
+
+    def _buckets(self, pattern):
+        """Return the id set a pattern is indexed under, creating it if needed"""
+        if '*' not in pattern:
+            return self._exact.setdefault(pattern, set())
+        if pattern.index('*') == len(pattern) - 1:
+            return self._prefixes.setdefault(pattern[:-1], set())
+        return self._patterns.setdefault(pattern, (_compile(pattern), set()))[1]
+
+    def _remove(self, subscription_id):
+        patterns = self._routes.pop(subscription_id, None)
+        if patterns is None:
+            return
+        if not patterns:
+            self._catch_all.discard(subscription_id)
+        for pattern in patterns:
+            ids = self._buckets(pattern)
+            ids.discard(subscription_id)
+            if not ids:
+                # Drop empty buckets so lookups never scan dead patterns
+                if '*' not in pattern:
+                    del self._exact[pattern]
+                elif pattern.index('*') == len(pattern) - 1:
+                    del self._prefixes[pattern[:-1]]
+                else:
+                    del self._patterns[pattern]
+
+    def _apply(self, rows):
+        """Replace the routes of every subscription in ``rows``; returns the ids seen"""
+        seen = set()
+        for subscription_id, status, event_types, updated_at in rows:
+            seen.add(subscription_id)
+            self._remove(subscription_id)
+            if updated_at is not None and (self._high_water is None or updated_at > self._high_water):
+                self._high_water = updated_at
+            if status != 'active':
+                continue
+            patterns = tuple(set(event_types or ()))
+            self._routes[subscription_id] = patterns
+            if not patterns:
+                self._catch_all.add(subscription_id)
+            for pattern in patterns:
+                self._buckets(pattern).add(subscription_id)
+        self._results.clear()
+        return seen
+
+    def _sync(self):
+        """Load the index or apply pending changes; call with the lock held"""
+        now = time.monotonic()
+        if not self._loaded:
+            self._reset()
+            self._changed.clear()
+            self._apply(self.loader())
+            self._loaded = True
+            self._refreshed_at = now
+            logger.info(f"Loaded routing index for {len(self._routes)} subscriptions")
+            return
+
+        if self._changed:
+            changed, self._changed = self._changed, set()
+            # Ids that no longer load were deleted
+            for subscription_id in changed - self._apply(self.loader(ids=changed)):
+                self._remove(subscription_id)
+            self._results.clear()
+
+        if now - self._refreshed_at >= self.refresh_interval:
+            # Look back a little so updates from processes with a slower clock are not missed
+            since = self._high_water - timedelta(seconds=self.refresh_interval) if self._high_water else None
+            rows = list(self.loader(updated_since=since))
+            if rows:
+                self._apply(rows)
+            self._refreshed_at = now
+
+    def lookup(self, event_type):
+        """Return the sorted ids of active subscriptions that accept ``event_type``"""
+        with self._lock:
+            self._sync()
+
+            ids = self._results.get(event_type)
+            if ids is not None:
+                self._results.move_to_end(event_type)
+                return ids
+
+            matched = set(self._catch_all)
+            matched |= self._exact.get(event_type, set())
+            for length in range(len(event_type) + 1):
+                matched |= self._prefixes.get(event_type[:length], set())
+            for regex, pattern_ids in self._patterns.values():
+                if regex.fullmatch(event_type):
+                    matched |= pattern_ids
+
+            ids = sorted(matched)
+            self._results[event_type] = ids
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+            return ids
+
+    def mark_changed(self, subscription_id):
+        """Reload a subscription's routes on the next lookup after it was created, updated or deleted"""
+        with self._lock:
+            self._changed.add(subscription_id)
+
+    def clear(self):
+        """Drop the index; it is loaded again on the next lookup"""
+        with self._lock:
+            self._loaded = False
+            self._high_water = None
+            self._reset()
+
+
+def _load_routes(ids=None, updated_since=None):
+    # Import models here to avoid circular imports
+    from models import Subscription
+    query = Subscription.query.with_entities(
+        Subscription.id, Subscription.status, Subscription.event_types, Subscription.updated_at)
+    if ids is not None:
+        query = query.filter(Subscription.id.in_(ids))
+    if updated_since is not None:
+        query = query.filter(Subscription.updated_at >= updated_since)
+    return query.all()
+
+
+routing_index = RoutingIndex(
+    _load_routes,
+    refresh_interval=ROUTING_INDEX_REFRESH,
+    cache_size=ROUTING_INDEX_CACHE_SIZE,
+)
+
+
+def subscriptions_for_event(event_type):
+    """Ids of the active subscriptions an event of this type is published to"""
+    return routing_index.lookup(event_type)
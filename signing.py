@@ -0,0 +1,67 @@
+import hashlib
+import hmac
+import json
+
+
+def canonical_body(payload):
+    """Serialize a payload into the bytes that are stored, signed and delivered"""
+    return json.dumps(payload).encode('utf-8')
+
+
+def compute_signature(secret, payload_bytes):
+    """Compute the X-Hub-Signature-256 value for a payload"""
+    return 'sha256=' + hmac.new(
+        secret.encode('utf-8'),
+        payload_bytes,
+        hashlib.sha256
+    ).hexdigest()
+
+
+def read_signed_body(stream, secret=None, chunk_size=65536):
+    """Read a raw body stream, computing its signature incrementally as it is read.
+
+    Returns ``(body, signature)``; ``body`` is a bytearray and ``signature`` is
+    None when no secret is given.
+    """
+    mac = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256) if secret else None
+    body = bytearray()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if mac is not None:
+            mac.update(chunk)
+        body += chunk
+    return body, ('sha256=' + mac.hexdigest() if mac is not None else None)
+
+
+def secret_fingerprint(secret):
+    """Short, non-reversible identifier of the secret a signature was made with"""
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()[:16]
+
+
+def delivery_body(delivery):
+    """Return the exact bytes to send for a delivery"""
+    if delivery.raw_body is not None:
+        return bytes(delivery.raw_body)
+    # Deliveries ingested before raw bodies were stored
+    return canonical_body(delivery.payload)
+
+
+def delivery_signature(delivery, subscription, body):
+    """Return the delivery's signature, signing only if the subscription's secret changed.
+
+    A new signature is stored on the delivery so it is persisted with the
+    caller's next commit.
+    """
+    if not subscription.secret:
+        return None
+
+    fingerprint = secret_fingerprint(subscription.secret)
+    if delivery.signature and delivery.signature_key == fingerprint:
+        return delivery.signature
+
+    signature = compute_signature(subscription.secret, body)
+    delivery.signature = signature
+    delivery.signature_key = fingerprint
+    return signature
@@ -0,0 +1,252 @@
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('pending', 'processing', 'delivered', 'failed', 'parked')
+COUNTERS = STATUSES + ('attempts',)
+
+
+def hour_bucket(timestamp):
+    """Truncate a timestamp to the start of its hour"""
+    return (timestamp or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+
+
+def apply_deltas(connection, deltas):
+    """Add counter deltas to the rollup rows with one multi-row upsert.
+
+    ``deltas`` maps ``(subscription_id, bucket)`` to a Counter of COUNTERS.
+    """
+    # Import models here to avoid circular imports
+    from models import DeliveryStatsRollup
+
+    rows = [
+        {'subscription_id': subscription_id, 'bucket': bucket,
+         **{counter: counts.get(counter, 0) for counter in COUNTERS}}
+        for (subscription_id, bucket), counts in sorted(deltas.items(), key=lambda item: (item[0][0] or 0, item[0][1]))
+        if subscription_id is not None and any(counts.values())
+    ]
+    if None in {subscription_id for subscription_id, _ in deltas}:
+        # A delivery with no subscription at all; `flask rebuild-stats` restores it
+        logger.warning("Skipped stats rollup deltas for a delivery without a subscription")
+    if not rows:
+        return
+
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    table = DeliveryStatsRollup.__table__
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['subscription_id', 'bucket'],
+        set_={counter: table.c[counter] + stmt.excluded[counter] for counter in COUNTERS}
+    )
+    connection.execute(stmt, rows)
+
+
+def record_created(session, rows):
+    """Count delivery rows inserted without the ORM (bulk insert, COPY) as pending"""
+    deltas = defaultdict(Counter)
+    for row in rows:
+        deltas[(row['subscription_id'], hour_bucket(row['created_at']))]['pending'] += 1
+    apply_deltas(session.connection(), deltas)
+
+
+def _rollup_key(delivery):
+    """Return the (subscription_id, bucket) rollup key of a delivery, even before it is flushed.
+
+    A subscription that is itself not flushed yet has no id, so the
+    Subscription object stands in for it until after the flush.
+    """
+    subscription_id = delivery.subscription_id
+    if subscription_id is None:
+        subscription = delivery.__dict__.get('subscription')
+        if subscription is not None:
+            subscription_id = subscription.id if subscription.id is not None else subscription
+    return (subscription_id, hour_bucket(delivery.created_at))
+
+
+@event.listens_for(Session, 'before_flush')
+def track_delivery_changes(session, flush_context, instances):
+    """Update the rollups for ORM status transitions and new attempts in the same transaction"""
+    # Import models here to avoid circular imports
+    from models import Subscription, WebhookDelivery, DeliveryAttempt
+
+    deltas = defaultdict(Counter)
+    attempts = Counter()
+    attached_attempts = []
+
+    for obj in session.new:
+        if isinstance(obj, WebhookDelivery):
+            if obj.created_at is None:
+                obj.created_at = datetime.utcnow()
+            if obj.status is None:
+                obj.status = 'pending'
+            deltas[_rollup_key(obj)][obj.status] += 1
+        elif isinstance(obj, DeliveryAttempt):
+            # Attempts appended to delivery.attempts have no delivery_id until the flush
+            delivery = obj.__dict__.get('delivery')
+            if delivery is not None:
+                attached_attempts.append(delivery)
+            else:
+                attempts[obj.delivery_id] += 1
+
+    for obj in session.dirty:
+        if not isinstance(obj, WebhookDelivery):
+            continue
+        history = inspect(obj).attrs.status.history
+        if not history.deleted or not history.added:
+            continue
+        old_status, new_status = history.deleted[0], history.added[0]
+        if old_status != new_status:
+            key = _rollup_key(obj)
+            deltas[key][old_status] -= 1
+            deltas[key][new_status] += 1
+
+    for delivery in attached_attempts:
+        deltas[_rollup_key(delivery)]['attempts'] += 1
+
+    if attempts:
+        # Find each attempt's delivery, preferring objects already in the session
+        missing = []
+        for delivery_id, count in attempts.items():
+            delivery = session.identity_map.get(identity_key(WebhookDelivery, delivery_id))
+            if delivery is not None:
+                deltas[_rollup_key(delivery)]['attempts'] += count
+            else:
+                missing.append(delivery_id)
+        if missing:
+            table = WebhookDelivery.__table__
+            rows = session.connection().execute(
+                select(table.c.id, table.c.subscription_id, table.c.created_at)
+                .where(table.c.id.in_(missing))
+            )
+            for delivery_id, subscription_id, created_at in rows:
+                deltas[(subscription_id, hour_bucket(created_at))]['attempts'] += attempts[delivery_id]
+
+    # Deltas of subscriptions inserted by this flush are applied once they have an id
+    session.info['unflushed_rollup_deltas'] = {
+        key: deltas.pop(key) for key in list(deltas) if isinstance(key[0], Subscription)
+    }
+
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_new_subscription_deliveries(session, flush_context):
+    """Apply the rollup deltas of deliveries flushed together with their new subscription"""
+    unflushed = session.info.pop('unflushed_rollup_deltas', None)
+    if not unflushed:
+        return
+
+    deltas = defaultdict(Counter)
+    for (subscription, bucket), counts in unflushed.items():
+        deltas[(subscription.id, bucket)].update(counts)
+    apply_deltas(session.connection(), deltas)
+
+
+def _with_totals(summary):
+    """Add total, success rate and average attempts to a dict of counters"""
+    total = sum(summary[status] for status in STATUSES)
+    summary['total'] = total
+    summary['success_rate'] = (summary['delivered'] / total * 100) if total > 0 else 0
+    summary['avg_attempts'] = (summary['attempts'] / total) if total > 0 else 0
+    return summary
+
+
+def summarize(subscription_id=None):
+    """Return delivery totals from the rollups with a single query"""
+    # Import models here to avoid circular imports
+    from app import db
+    from models import DeliveryStatsRollup
+
+    query = db.session.query(*(
+        func.coalesce(func.sum(getattr(DeliveryStatsRollup, counter)), 0) for counter in COUNTERS
+    ))
+    if subscription_id is not None:
+        query = query.filter(DeliveryStatsRollup.subscription_id == subscription_id)
+
+    return _with_totals(dict(zip(COUNTERS, (int(value) for value in query.one()))))
+
+
+def summarize_many(subscription_ids):
+    """Return delivery totals for several subscriptions with one grouped query"""
+    # Import models here to avoid circular imports
+    from app import db
+    from models import DeliveryStatsRollup
+
+    rows = db.session.query(
+        DeliveryStatsRollup.subscription_id,
+        *(func.sum(getattr(DeliveryStatsRollup, counter)) for counter in COUNTERS)
+    ).filter(DeliveryStatsRollup.subscription_id.in_(list(subscription_ids)))\
+     .group_by(DeliveryStatsRollup.subscription_id)\
+     .all()
+    counts = {row[0]: dict(zip(COUNTERS, (int(value or 0) for value in row[1:]))) for row in rows}
+
+    summaries = {}
+    for subscription_id in subscription_ids:
+        summaries[subscription_id] = _with_totals(counts.get(subscription_id, dict.fromkeys(COUNTERS, 0)))
+    return summaries
+
+
+def rebuild_rollups():
+    """Recompute every rollup row from webhook_deliveries and delivery_attempts"""
+    # Import models here to avoid circular imports
+    from app import db
+    from models import WebhookDelivery, DeliveryAttempt, DeliveryStatsRollup
+
+    deltas = defaultdict(Counter)
+
+    attempt_counts = db.session.query(
+        DeliveryAttempt.delivery_id.label('delivery_id'),
+        func.count(DeliveryAttempt.id).label('attempts')
+    ).group_by(DeliveryAttempt.delivery_id).subquery()
+
+    rows = db.session.query(
+        WebhookDelivery.subscription_id,
+        WebhookDelivery.created_at,
+        WebhookDelivery.status,
+        func.coalesce(attempt_counts.c.attempts, 0)
+    ).outerjoin(attempt_counts, attempt_counts.c.delivery_id == WebhookDelivery.id)\
+     .yield_per(10000)
+
+    for subscription_id, created_at, status, attempts in rows:
+        key = (subscription_id, hour_bucket(created_at))
+        deltas[key][status or 'pending'] += 1
+        deltas[key]['attempts'] += attempts
+
+    DeliveryStatsRollup.query.delete()
+    apply_deltas(db.session.connection(), deltas)
+    db.session.commit()
+
+    logger.info(f"Rebuilt {len(deltas)} delivery stats rollup rows")
+    return len(deltas)
+
+
+def prune_rollups(cutoff):
+    """Drop rollup buckets that lie entirely before the retention cutoff and hold no deliveries.
+
+    A retention run can stop before reaching the cutoff. A delivery still
+    stored in a dropped bucket would re-create it with negative counters on
+    its next status change, so buckets from the oldest remaining delivery's
+    hour onwards are kept until retention has deleted it.
+    """
+    # Import models here to avoid circular imports
+    from app import db
+    from models import DeliveryStatsRollup, WebhookDelivery
+
+    keep_from = hour_bucket(cutoff)
+    oldest = db.session.query(func.min(WebhookDelivery.created_at)).scalar()
+    if oldest is not None:
+        keep_from = min(keep_from, hour_bucket(oldest))
+
+    return DeliveryStatsRollup.query.filter(DeliveryStatsRollup.bucket < keep_from)\
+        .delete(synchronize_session=False)
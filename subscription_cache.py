@@ -0,0 +1,257 @@
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import redis
+
+from config import (
+    REDIS_CACHE_URL,
+    SUBSCRIPTION_CACHE_ENABLED,
+    SUBSCRIPTION_CACHE_LOCAL_SIZE,
+    SUBSCRIPTION_CACHE_LOCAL_TTL,
+    SUBSCRIPTION_CACHE_REDIS_SECRETS,
+    SUBSCRIPTION_CACHE_REDIS_TTL,
+)
+from redis_client import RedisClient
+
+# Cache key of the subscription id/name index used by dropdowns
+INDEX_KEY = 'index'
+
+# Lightweight subscription entry for dropdowns and filters
+SubscriptionIndexEntry = namedtuple('SubscriptionIndexEntry', ['id', 'name', 'target_url'])
+
+
+class CachedSubscription:
+    """Detached, read-only snapshot of a Subscription row"""
+
+    FIELDS = ('id', 'name', 'target_url', 'secret', 'event_types', 'status', 'ordered',
+              'batch_max_size', 'batch_window_ms')
+
+    __slots__ = FIELDS
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def from_model(cls, subscription):
+        values = {field: getattr(subscription, field) for field in cls.FIELDS}
+        if values['event_types'] is not None:
+            values['event_types'] = list(values['event_types'])
+        return cls(**values)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @property
+    def has_secret(self):
+        """Check if the subscription has a secret configured"""
+        return bool(self.secret and self.secret.strip())
+
+    @property
+    def batched(self):
+        """Check if deliveries are coalesced into batch POSTs"""
+        return bool(self.batch_max_size and self.batch_max_size > 1)
+
+    def __repr__(self):
+        return f"<CachedSubscription {self.id}>"
+
+
+class SubscriptionCache:
+    """Read-through subscription cache: in-process LRU with TTL in front of Redis.
+
+    Every subscription has a version counter in Redis that is bumped on
+    invalidation. Redis entries carry the version they were loaded under, so an
+    entry written by a loader that raced with an update is ignored on the next
+    read. Local entries are only trusted for ``local_ttl`` seconds, which bounds
+    how long other processes can serve a subscription after it changed.
+
+    Redis entries include the subscription's secret in plain JSON; with
+    ``redis_secrets=False`` subscriptions that have one are only cached
+    in-process.
+    """
+
+    def __init__(self, redis_url, local_size=1024, local_ttl=5, redis_ttl=300, enabled=True, redis_secrets=True):
+        self.redis_url = redis_url
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self.enabled = enabled
+        self.redis_secrets = redis_secrets
+
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = RedisClient(redis_url, 'Subscription cache Redis tier unavailable')
+
+        self.stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _data_key(key):
+        return f"subscription:{key}"
+
+    @staticmethod
+    def _version_key(key):
+        return f"subscription:{key}:version"
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            snapshot, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return snapshot
+
+    def _set_local(self, key, snapshot):
+        with self._lock:
+            self._local[key] = (snapshot, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def _read_through(self, key, load, encode, decode):
+        """Look ``key`` up in the local tier, then Redis, then call ``load()``.
+
+        ``encode``/``decode`` convert values to and from their JSON form in Redis;
+        values ``encode`` returns None for are kept out of Redis.
+        """
+        value = self._get_local(key)
+        if value is not None:
+            self.stats['local_hits'] += 1
+            return value
+
+        version = None
+        client = self._redis.get()
+        if client is not None:
+            try:
+                raw_version, raw_data = client.mget(self._version_key(key), self._data_key(key))
+                version = int(raw_version or 0)
+                if raw_data:
+                    data = json.loads(raw_data)
+                    if data.get('version') == version:
+                        value = decode(data['value'])
+                        self._set_local(key, value)
+                        self.stats['redis_hits'] += 1
+                        return value
+            except redis.RedisError as e:
+                self._redis.failed(e)
+                version = None
+
+        self.stats['misses'] += 1
+        value = load()
+        if value is None:
+            return None
+
+        self._set_local(key, value)
+
+        encoded = encode(value) if version is not None else None
+        if encoded is not None:
+            try:
+                client.set(
+                    self._data_key(key),
+                    json.dumps({'version': version, 'value': encoded}),
+                    ex=self.redis_ttl,
+                )
+            except redis.RedisError as e:
+                self._redis.failed(e)
+
+        return value
+
+    def get(self, subscription_id, loader):
+        """Return a CachedSubscription, calling ``loader(subscription_id)`` on a miss"""
+        def load():
+            subscription = loader(subscription_id)
+            return CachedSubscription.from_model(subscription) if subscription else None
+
+        def encode(snapshot):
+            if snapshot.secret and not self.redis_secrets:
+                return None
+            return snapshot.to_dict()
+
+        if not self.enabled:
+            return load()
+        return self._read_through(
+            subscription_id, load,
+            encode=encode,
+            decode=lambda values: CachedSubscription(**values),
+        )
+
+    def get_index(self, loader):
+        """Return the list of SubscriptionIndexEntry, calling ``loader()`` on a miss"""
+        if not self.enabled:
+            return loader()
+        return self._read_through(
+            INDEX_KEY, loader,
+            encode=lambda entries: [list(entry) for entry in entries],
+            decode=lambda entries: [SubscriptionIndexEntry(*entry) for entry in entries],
+        )
+
+    def invalidate(self, subscription_id):
+        """Drop a subscription from both tiers and bump its version"""
+        with self._lock:
+            self._local.pop(subscription_id, None)
+
+        client = self._redis.get()
+        if client is None:
+            return
+        try:
+            pipe = client.pipeline()
+            pipe.incr(self._version_key(subscription_id))
+            pipe.delete(self._data_key(subscription_id))
+            pipe.execute()
+        except redis.RedisError as e:
+            self._redis.failed(e)
+
+    def clear(self):
+        """Drop every entry from the in-process tier"""
+        with self._lock:
+            self._local.clear()
+
+
+subscription_cache = SubscriptionCache(
+    REDIS_CACHE_URL,
+    local_size=SUBSCRIPTION_CACHE_LOCAL_SIZE,
+    local_ttl=SUBSCRIPTION_CACHE_LOCAL_TTL,
+    redis_ttl=SUBSCRIPTION_CACHE_REDIS_TTL,
+    enabled=SUBSCRIPTION_CACHE_ENABLED,
+    redis_secrets=SUBSCRIPTION_CACHE_REDIS_SECRETS,
+)
+
+
+def _load_subscription(subscription_id):
+    # Import models here to avoid circular imports
+    from models import Subscription
+    return Subscription.query.get(subscription_id)
+
+
+def get_subscription(subscription_id):
+    """Get a subscription snapshot, hitting the database only on a cache miss"""
+    return subscription_cache.get(subscription_id, _load_subscription)
+
+
+def invalidate_subscription(subscription_id):
+    """Invalidate a cached subscription after it was updated or deleted"""
+    subscription_cache.invalidate(subscription_id)
+    subscription_cache.invalidate(INDEX_KEY)
+
+
+def _load_subscription_index():
+    # Import models here to avoid circular imports
+    from models import Subscription
+    rows = Subscription.query.with_entities(Subscription.id, Subscription.name, Subscription.target_url)\
+        .order_by(Subscription.id).all()
+    return [SubscriptionIndexEntry(*row) for row in rows]
+
+
+def get_subscription_index():
+    """Get (id, name, target_url) entries for every subscription, for dropdowns"""
+    return subscription_cache.get_index(_load_subscription_index)
+
+
+def invalidate_subscription_index():
+    """Invalidate the subscription index after a subscription was created"""
+    subscription_cache.invalidate(INDEX_KEY)
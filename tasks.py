@@ -6,10 +6,21 @@ import os
 import sys
 import hmac
 import hashlib
+import uuid
 from datetime import datetime, timedelta
 from flask import current_app
 from contextlib import contextmanager
+from batching import batch_body, batch_window
 from celery_app import celery_app
+from circuit_breaker import OPEN, circuit_breaker, is_failure
+from delivery_client import delivery_client
+from lanes import lane_for, lane_lock, lane_queue
+from metrics import delivery_request, observe_queue_wait
+from response_capture import capture_response_body
+from retry_scheduler import claim_due_retries, due_ordered_lanes, retry_delay, schedule_retry
+from signing import compute_signature, delivery_body, delivery_signature
+from subscription_cache import get_subscription
+from throttle import delivery_throttle, is_overloaded
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -25,66 +36,586 @@ def app_context():
     with app.app_context():
         yield db
 
-@celery_app.task(bind=True, max_retries=None)
-def process_webhook(self, delivery_id):
+# Delivery engines whose workers claim pending deliveries from the database
+# instead of receiving them through the Celery broker
+DATABASE_QUEUE_ENGINES = ('async', 'queue')
+
+@celery_app.task
+def process_webhook(delivery_id):
     """Process a webhook delivery with retries"""
     with app_context() as db:
-        logger.info(f"Processing webhook delivery: {delivery_id}")
+        return deliver_webhook(db, delivery_id)
+
+def deliver_webhook(db, delivery_id):
+    """Make the next attempt for a delivery and record its outcome.
+    
+    Shared by the process_webhook task and the Postgres queue worker. A
+    throttled delivery is not attempted; it is parked on next_attempt_at for
+    ``retry_in`` seconds and handed out again by dispatch_due_retries (or
+    claimed again by the queue worker), so deferrals never go back through
+    the broker.
+    """
+    logger.info(f"Processing webhook delivery: {delivery_id}")
+    
+    # Import models here to avoid circular imports
+    from models import WebhookDelivery
+    
+    delivery = WebhookDelivery.query.get(delivery_id)
+    if not delivery:
+        logger.error(f"Delivery not found: {delivery_id}")
+        return {"error": "Delivery not found"}
+    
+    # A retry can be handed out twice if its claim lease ran out while it was queued
+    if delivery.status in ('delivered', 'failed'):
+        logger.info(f"Delivery {delivery_id} is already {delivery.status}")
+        return {"status": delivery.status}
+    
+    # Get subscription from the cache, falling back to the database
+    subscription = get_subscription(delivery.subscription_id)
+    if not subscription:
+        logger.error(f"Subscription not found: {delivery.subscription_id}")
+        delivery.status = 'failed'
+        db.session.commit()
+        return {"error": "Subscription not found"}
+    
+    # Ordered subscriptions are only delivered by their lane
+    if subscription.ordered:
+        schedule_ordered_lane(subscription.id)
+        return {"status": "queued_in_lane"}
+    
+    # Batched subscriptions are delivered by deliver_batch
+    if subscription.batched:
+        schedule_batch_delivery(subscription)
+        return {"status": "queued_in_batch"}
+    
+    # Get the current attempt number
+    current_attempt = delivery.attempt_count + 1
+    
+    # Get config from app
+    from app import app
+    max_retries = app.config.get('MAX_RETRY_ATTEMPTS', 5)
+    
+    # Check if maximum retries reached
+    if current_attempt > max_retries:
+        logger.warning(f"Maximum retry attempts reached for delivery: {delivery_id}")
+        delivery.status = 'failed'
+        delivery.completed_at = datetime.utcnow()
+        delivery.next_attempt_at = None
+        db.session.commit()
+        return {"status": "failed", "reason": "Maximum retry attempts reached"}
+    
+    # Park instead of calling an endpoint whose circuit is open
+    if circuit_breaker.allow(subscription.id) == OPEN:
+        logger.info(f"Parking delivery {delivery_id}: circuit for subscription {subscription.id} is open")
+        delivery.status = 'parked'
+        delivery.next_attempt_at = None
+        db.session.commit()
+        return {"status": "parked"}
+    
+    # Respect the subscription's rate and concurrency limits; deferring does not use an attempt
+    decision = delivery_throttle.acquire(subscription.id, delivery.id)
+    if not decision.allowed:
+        logger.info(f"Deferring delivery {delivery_id} for {decision.retry_after:.1f} seconds: "
+                    f"subscription {subscription.id} is throttled")
+        delivery.status = 'processing'
+        delivery.next_attempt_at = datetime.utcnow() + timedelta(seconds=decision.retry_after)
+        db.session.commit()
+        return {"status": "deferred", "retry_in": decision.retry_after}
+    
+    # Update status to processing; if this worker dies mid-attempt the
+    # retry scheduler hands the delivery out again once the lease expires
+    delivery.status = 'processing'
+    delivery.next_attempt_at = datetime.utcnow() + timedelta(seconds=app.config.get('RETRY_CLAIM_LEASE', 600))
+    db.session.commit()
+    
+    # Attempt delivery
+    started = time.monotonic()
+    attempt_result = attempt_delivery(delivery, subscription, current_attempt, db)
+    no_response = attempt_result.get('reason') in ('timeout', 'connection_error')
+    overloaded = is_overloaded(attempt_result.get('status_code'), no_response=no_response)
+    delivery_throttle.release(decision.lease, time.monotonic() - started, overloaded)
+    
+    # Once a failing endpoint answers again, release the deliveries parked while it was down
+    if circuit_breaker.record(subscription.id, not is_failure(attempt_result.get('status_code'), no_response)):
+        if app.config.get('DELIVERY_ENGINE') == 'queue':
+            drain_parked_deliveries(subscription.id)
+        else:
+            drain_parked_deliveries.delay(subscription.id)
+    
+    # If success, update delivery status; the attempt row is saved in the same commit
+    if attempt_result['status'] == 'success':
+        delivery.status = 'delivered'
+        delivery.completed_at = datetime.utcnow()
+        delivery.next_attempt_at = None
+        db.session.commit()
+        return {"status": "delivered"}
+    
+    # If failure, store when to retry with jittered exponential backoff;
+    # dispatch_due_retries or the queue worker picks the delivery up once it is due
+    delay = schedule_retry(delivery, current_attempt)
+    db.session.commit()
+    
+    logger.info(f"Scheduling retry {current_attempt + 1} for delivery {delivery_id} in {delay:.0f} seconds")
+    return {"status": "retry_scheduled", "attempt": current_attempt, "next_retry_in": delay}
+
+@celery_app.task
+def dispatch_due_retries():
+    """Queue deliveries whose retry is due, claiming them in batches"""
+    with app_context() as db:
+        from app import app
         
-        # Import models here to avoid circular imports
-        from models import Subscription, WebhookDelivery, DeliveryAttempt
+        # The async and queue engines claim due retries themselves, except
+        # those of batched subscriptions, which Celery delivers
+        batched_only = app.config.get('DELIVERY_ENGINE') in DATABASE_QUEUE_ENGINES
+        
+        batch_size = app.config.get('RETRY_SCHEDULER_BATCH_SIZE', 500)
+        lease = app.config.get('RETRY_CLAIM_LEASE', 600)
+        
+        # Ordered deliveries are retried by their lane; restart lanes that are
+        # due, in case the message that would have resumed them was lost
+        lanes = due_ordered_lanes(db.session, batch_size, lease)
+        for subscription_id in lanes:
+            schedule_ordered_lane(subscription_id)
         
-        delivery = WebhookDelivery.query.get(delivery_id)
-        if not delivery:
-            logger.error(f"Delivery not found: {delivery_id}")
-            return {"error": "Delivery not found"}
+        dispatched = 0
+        for _ in range(app.config.get('RETRY_SCHEDULER_MAX_BATCHES', 20)):
+            delivery_ids = claim_due_retries(db.session, batch_size, lease, batched_only=batched_only)
+            if not delivery_ids:
+                break
+            dispatch_claimed_retries(db, delivery_ids)
+            dispatched += len(delivery_ids)
+            if len(delivery_ids) < batch_size:
+                break
         
-        # Update status to processing
+        if dispatched or lanes:
+            logger.info(f"Dispatched {dispatched} due retries and restarted {len(lanes)} ordered lanes")
+        return {"status": "success", "dispatched_count": dispatched, "restarted_lanes": len(lanes)}
+
+def dispatch_claimed_retries(db, delivery_ids):
+    """Queue claimed retries: batched subscriptions' deliveries go back to deliver_batch, the rest to process_webhook"""
+    # Import models here to avoid circular imports
+    from app import app
+    from models import Subscription, WebhookDelivery
+    
+    rows = db.session.query(WebhookDelivery.id, Subscription.id, Subscription.batch_max_size)\
+        .join(Subscription, Subscription.id == WebhookDelivery.subscription_id)\
+        .filter(WebhookDelivery.id.in_(delivery_ids))\
+        .order_by(WebhookDelivery.created_at)\
+        .all()
+    
+    single, batched = [], {}
+    for delivery_id, subscription_id, batch_max_size in rows:
+        if batch_max_size and batch_max_size > 1:
+            batched.setdefault((subscription_id, batch_max_size), []).append(str(delivery_id))
+        else:
+            single.append(str(delivery_id))
+    
+    if single:
+        process_webhook_batch.delay(single)
+    max_batch = app.config.get('DELIVERY_BATCH_MAX_SIZE', 500)
+    for (subscription_id, batch_max_size), ids in batched.items():
+        size = min(batch_max_size, max_batch)
+        for start in range(0, len(ids), size):
+            deliver_batch.delay(subscription_id, ids[start:start + size])
+
+@celery_app.task
+def process_webhook_batch(delivery_ids):
+    """Fan a batch of ingested deliveries out to individual process_webhook tasks"""
+    for delivery_id in delivery_ids:
+        process_webhook.delay(delivery_id)
+    
+    return {"status": "queued", "count": len(delivery_ids)}
+
+def schedule_ordered_lane(subscription_id):
+    """Queue a run of a subscription's ordered lane on the lane's Celery queue"""
+    process_ordered_lane.apply_async(
+        args=[subscription_id],
+        queue=lane_queue(lane_for(subscription_id))
+    )
+
+def run_ordered_lane(db, subscription_id, token):
+    """Deliver a subscription's outstanding deliveries one at a time, oldest first.
+    
+    Stops at the first delivery that cannot be sent yet, so later deliveries
+    never overtake it, and stores when it is due in its next_attempt_at so
+    dispatch_due_retries restarts the lane then. Returns the number of
+    seconds after which the lane should run again (0 to continue right
+    away), or None once it is idle.
+    """
+    # Import models here to avoid circular imports
+    from app import app
+    from models import WebhookDelivery
+    
+    subscription = get_subscription(subscription_id)
+    if not subscription:
+        logger.error(f"Subscription not found: {subscription_id}")
+        return None
+    
+    max_retries = app.config.get('MAX_RETRY_ATTEMPTS', 5)
+    lease = app.config.get('RETRY_CLAIM_LEASE', 600)
+    batch_size = app.config.get('ORDERED_LANE_BATCH_SIZE', 100)
+    
+    # Deliveries left 'processing' are waiting for a retry or were interrupted
+    deliveries = WebhookDelivery.query\
+        .filter(WebhookDelivery.subscription_id == subscription_id,
+                WebhookDelivery.status.in_(('pending', 'processing')))\
+        .order_by(WebhookDelivery.created_at, WebhookDelivery.id)\
+        .limit(batch_size)\
+        .all()
+    
+    for delivery in deliveries:
+        if not lane_lock.extend(subscription_id, token):
+            logger.warning(f"Lost the ordered lane for subscription {subscription_id}")
+            return None
+        
+        attempt_count = delivery.attempt_count
+        if attempt_count >= max_retries:
+            logger.warning(f"Maximum retry attempts reached for delivery: {delivery.id}")
+            delivery.status = 'failed'
+            delivery.completed_at = datetime.utcnow()
+            delivery.next_attempt_at = None
+            db.session.commit()
+            continue
+        
+        # Hold the lane until the head delivery's retry (or a lost worker's lease) is due
+        if delivery.next_attempt_at is not None:
+            wait = (delivery.next_attempt_at - datetime.utcnow()).total_seconds()
+            if wait > 0:
+                return wait
+        
+        # Ordered deliveries wait in the lane instead of being parked
+        if circuit_breaker.allow(subscription_id) == OPEN:
+            return hold_ordered_lane(db, delivery, app.config.get('CIRCUIT_OPEN_SECONDS', 60))
+        
+        decision = delivery_throttle.acquire(subscription_id, delivery.id)
+        if not decision.allowed:
+            return hold_ordered_lane(db, delivery, decision.retry_after)
+        
+        # If this worker dies mid-attempt the lane is restarted once the lease expires
         delivery.status = 'processing'
+        delivery.next_attempt_at = datetime.utcnow() + timedelta(seconds=lease)
         db.session.commit()
         
-        # Get subscription from database
-        subscription = Subscription.query.get(delivery.subscription_id)
-        if not subscription:
-            logger.error(f"Subscription not found: {delivery.subscription_id}")
-            delivery.status = 'failed'
+        started = time.monotonic()
+        attempt_result = attempt_delivery(delivery, subscription, attempt_count + 1, db)
+        no_response = attempt_result.get('reason') in ('timeout', 'connection_error')
+        overloaded = is_overloaded(attempt_result.get('status_code'), no_response=no_response)
+        delivery_throttle.release(decision.lease, time.monotonic() - started, overloaded)
+        circuit_breaker.record(subscription_id, not is_failure(attempt_result.get('status_code'), no_response))
+        
+        if attempt_result['status'] != 'success':
+            delay = schedule_retry(delivery, attempt_count + 1)
             db.session.commit()
-            return {"error": "Subscription not found"}
+            logger.info(f"Holding ordered lane for subscription {subscription_id} for {delay:.0f} seconds "
+                        f"until delivery {delivery.id} is retried")
+            return delay
+        
+        delivery.status = 'delivered'
+        delivery.completed_at = datetime.utcnow()
+        delivery.next_attempt_at = None
+        db.session.commit()
+    
+    # A full batch means there may be more; run again to let other lanes' subscriptions in between
+    return 0 if len(deliveries) == batch_size else None
+
+def hold_ordered_lane(db, delivery, seconds):
+    """Hold an ordered lane at ``delivery`` for ``seconds``, recording when it is due; returns ``seconds``"""
+    delivery.status = 'processing'
+    delivery.next_attempt_at = datetime.utcnow() + timedelta(seconds=seconds)
+    db.session.commit()
+    return seconds
+
+@celery_app.task
+def process_ordered_lane(subscription_id):
+    """Run an ordered subscription's lane if no other worker is running it"""
+    token = lane_lock.acquire(subscription_id)
+    if token is None:
+        # The worker holding the lane picks up deliveries queued while it runs
+        return {"status": "busy"}
+    
+    with app_context() as db:
+        # Import models here to avoid circular imports
+        from models import WebhookDelivery
+        
+        try:
+            countdown = run_ordered_lane(db, subscription_id, token)
+        finally:
+            db.session.rollback()
+            lane_lock.release(subscription_id, token)
         
-        # Get the current attempt number
-        current_attempt = DeliveryAttempt.query.filter_by(delivery_id=delivery_id).count() + 1
+        # A delivery ingested just before the lock was released may have found
+        # the lane busy, so check again before going idle
+        if countdown is None and WebhookDelivery.query.filter_by(
+                subscription_id=subscription_id, status='pending').first() is not None:
+            countdown = 0
         
-        # Get config from app
+        if countdown == 0:
+            schedule_ordered_lane(subscription_id)
+            return {"status": "scheduled", "next_run_in": 0}
+        # A held lane is not queued with a countdown; its head delivery's
+        # next_attempt_at is stored and dispatch_due_retries restarts it once due
+        if countdown is not None:
+            return {"status": "waiting", "next_run_in": countdown}
+        return {"status": "idle"}
+
+def schedule_batch_delivery(subscription):
+    """Schedule a batch send if no send is already waiting for the subscription's window to close"""
+    from app import app
+    window_ms = subscription.batch_window_ms or app.config.get('DELIVERY_BATCH_WINDOW_MS', 1000)
+    if batch_window.open(subscription.id, window_ms):
+        deliver_batch.apply_async(args=[subscription.id], countdown=window_ms / 1000)
+
+def post_batch(subscription, deliveries, attempt_number):
+    """POST deliveries as one JSON array.
+    
+    Returns ``(fields, no_response)``: the attempt columns to record for each
+    delivery, and whether the request timed out or could not connect.
+    """
+    from app import app
+    
+    fields = {'status': 'failed'}
+    no_response = False
+    try:
+        body = batch_body([delivery_body(delivery) for delivery in deliveries])
+        headers = build_delivery_headers(
+            uuid.uuid4(), None, attempt_number,
+            compute_signature(subscription.secret, body) if subscription.secret else None
+        )
+        headers['X-Webhook-Batch-Size'] = str(len(deliveries))
+        headers['X-Webhook-IDs'] = ','.join(str(delivery.id) for delivery in deliveries)
+        
+        timeout = app.config.get('DELIVERY_TIMEOUT', 10)
+        for delivery in deliveries:
+            if not delivery.attempt_count:
+                observe_queue_wait(delivery.created_at)
+        with delivery_request(subscription.id):
+            response = delivery_client.post(
+                subscription.target_url,
+                data=body,
+                headers=headers,
+                timeout=timeout,
+                stream=True
+            )
+        
+        fields['status_code'] = response.status_code
+        fields['response_body'] = capture_response_body(response)
+        if 200 <= response.status_code < 300:
+            fields['status'] = 'success'
+        else:
+            fields['error_details'] = f"HTTP error: {response.status_code}"
+    
+    except requests.Timeout:
+        fields['error_details'] = f"Request timed out after {timeout} seconds"
+        no_response = True
+    
+    except requests.ConnectionError as e:
+        fields['error_details'] = f"Connection error: {str(e)}"
+        no_response = True
+    
+    except Exception as e:
+        fields['error_details'] = f"Unexpected error: {str(e)}"
+    
+    return fields, no_response
+
+@celery_app.task
+def deliver_batch(subscription_id, retry_ids=None):
+    """Send a batched subscription's deliveries, oldest first, as one JSON array POST.
+    
+    Sent deliveries are leased through next_attempt_at. A failed or throttled
+    batch stays 'processing' with next_attempt_at set to when it is due, and
+    dispatch_due_retries passes its deliveries back in ``retry_ids`` to be sent
+    again together, topped up with newly pending deliveries.
+    """
+    with app_context() as db:
+        # Import models here to avoid circular imports
         from app import app
+        from models import WebhookDelivery, DeliveryAttempt
+        
+        subscription = get_subscription(subscription_id)
+        if not subscription:
+            logger.error(f"Subscription not found: {subscription_id}")
+            return {"error": "Subscription not found"}
+        
+        max_size = min(subscription.batch_max_size or 1, app.config.get('DELIVERY_BATCH_MAX_SIZE', 500))
         max_retries = app.config.get('MAX_RETRY_ATTEMPTS', 5)
-        retry_delays = app.config.get('RETRY_DELAYS', [10, 30, 60, 300, 900])
+        lease = app.config.get('RETRY_CLAIM_LEASE', 600)
         
-        # Check if maximum retries reached
-        if current_attempt > max_retries:
-            logger.warning(f"Maximum retry attempts reached for delivery: {delivery_id}")
-            delivery.status = 'failed'
-            delivery.completed_at = datetime.utcnow()
+        deliveries = []
+        if retry_ids:
+            deliveries = WebhookDelivery.query\
+                .filter(WebhookDelivery.id.in_(retry_ids), WebhookDelivery.status == 'processing')\
+                .order_by(WebhookDelivery.created_at)\
+                .with_for_update(skip_locked=True)\
+                .all()
+        pending = []
+        pending_limit = max_size - len(deliveries)
+        if pending_limit > 0:
+            pending = WebhookDelivery.query.filter_by(subscription_id=subscription_id, status='pending')\
+                .order_by(WebhookDelivery.created_at)\
+                .limit(pending_limit)\
+                .with_for_update(skip_locked=True)\
+                .all()
+            deliveries += pending
+        if not deliveries:
+            db.session.rollback()
+            return {"status": "idle"}
+        
+        batch = []
+        for delivery in deliveries:
+            if delivery.attempt_count >= max_retries:
+                logger.warning(f"Maximum retry attempts reached for delivery: {delivery.id}")
+                delivery.status = 'failed'
+                delivery.completed_at = datetime.utcnow()
+                delivery.next_attempt_at = None
+            else:
+                batch.append(delivery)
+        
+        # Park instead of calling an endpoint whose circuit is open
+        if batch and circuit_breaker.allow(subscription_id) == OPEN:
+            logger.info(f"Parking {len(batch)} deliveries: circuit for subscription {subscription_id} is open")
+            for delivery in batch:
+                delivery.status = 'parked'
+                delivery.next_attempt_at = None
             db.session.commit()
-            return {"status": "failed", "reason": "Maximum retry attempts reached"}
+            return {"status": "parked", "count": len(batch)}
         
-        # Attempt delivery
-        attempt_result = attempt_delivery(delivery, subscription, current_attempt, db)
+        # Leased, so the retry scheduler sends the batch again if this worker dies mid-attempt
+        lease_until = datetime.utcnow() + timedelta(seconds=lease)
+        for delivery in batch:
+            delivery.status = 'processing'
+            delivery.next_attempt_at = lease_until
+        db.session.commit()
+        if not batch:
+            return {"status": "failed", "count": len(deliveries)}
         
-        # If success, update delivery status
-        if attempt_result['status'] == 'success':
-            delivery.status = 'delivered'
-            delivery.completed_at = datetime.utcnow()
+        decision = delivery_throttle.acquire(subscription_id)
+        if not decision.allowed:
+            # Wait in the database; dispatch_due_retries sends the batch once it is due
+            due = datetime.utcnow() + timedelta(seconds=decision.retry_after)
+            for delivery in batch:
+                delivery.next_attempt_at = due
             db.session.commit()
-            return {"status": "delivered"}
+            return {"status": "deferred", "retry_in": decision.retry_after}
+        
+        # The batch backs off by its most retried delivery
+        attempt_number = max(delivery.attempt_count for delivery in batch) + 1
+        logger.info(f"Attempt {attempt_number} for a batch of {len(batch)} deliveries to subscription {subscription_id}")
+        
+        started = time.monotonic()
+        fields, no_response = post_batch(subscription, batch, attempt_number)
+        overloaded = is_overloaded(fields.get('status_code'), no_response=no_response)
+        delivery_throttle.release(decision.lease, time.monotonic() - started, overloaded)
+        if circuit_breaker.record(subscription_id, not is_failure(fields.get('status_code'), no_response)):
+            drain_parked_deliveries.delay(subscription_id)
         
-        # If failure, schedule retry with exponential backoff
-        retry_index = min(current_attempt - 1, len(retry_delays) - 1)
-        retry_delay = retry_delays[retry_index]
+        # One attempt row per delivery, inserted together
+        for delivery in batch:
+            delivery.attempt_count += 1
+        db.session.add_all([
+            DeliveryAttempt(delivery_id=delivery.id, attempt_number=delivery.attempt_count, **fields)
+            for delivery in batch
+        ])
+        now = datetime.utcnow()
+        if fields['status'] == 'success':
+            for delivery in batch:
+                delivery.status = 'delivered'
+                delivery.completed_at = now
+                delivery.next_attempt_at = None
+        else:
+            # One jittered delay for the whole batch, so its deliveries come due together
+            delay = retry_delay(attempt_number)
+            for delivery in batch:
+                delivery.next_attempt_at = now + timedelta(seconds=delay)
+        db.session.commit()
         
-        logger.info(f"Scheduling retry {current_attempt + 1} for delivery {delivery_id} in {retry_delay} seconds")
-        self.retry(countdown=retry_delay)
+        if fields['status'] != 'success':
+            logger.info(f"Scheduling retry of a batch of {len(batch)} deliveries in {delay:.0f} seconds")
+            return {"status": "retry_scheduled", "count": len(batch), "next_retry_in": delay}
         
-        return {"status": "retry_scheduled", "attempt": current_attempt, "next_retry_in": retry_delay}
+        # A full batch may have left more pending deliveries behind
+        if pending and len(pending) == pending_limit:
+            deliver_batch.delay(subscription_id)
+        return {"status": "delivered", "count": len(batch)}
+
+def unpark_deliveries(db, subscription_id, limit):
+    """Move up to ``limit`` of a subscription's parked deliveries back to pending, oldest first"""
+    # Import models here to avoid circular imports
+    from models import WebhookDelivery
+    
+    deliveries = WebhookDelivery.query.filter_by(subscription_id=subscription_id, status='parked')\
+        .order_by(WebhookDelivery.created_at)\
+        .limit(limit)\
+        .all()
+    for delivery in deliveries:
+        delivery.status = 'pending'
+    db.session.commit()
+    return [str(delivery.id) for delivery in deliveries]
+
+def queue_unparked(delivery_ids):
+    """Queue unparked deliveries; the async and queue engines pick pending deliveries up by themselves"""
+    from app import app
+    if delivery_ids and app.config.get('DELIVERY_ENGINE') not in DATABASE_QUEUE_ENGINES:
+        process_webhook_batch.delay(delivery_ids)
+
+@celery_app.task
+def drain_parked_deliveries(subscription_id):
+    """Re-queue a subscription's parked deliveries in batches after its circuit closed"""
+    with app_context() as db:
+        from app import app
+        batch_size = app.config.get('CIRCUIT_DRAIN_BATCH_SIZE', 500)
+        
+        drained = 0
+        # Stop if the endpoint fails again while draining
+        while circuit_breaker.state(subscription_id)[0] == 'closed':
+            delivery_ids = unpark_deliveries(db, subscription_id, batch_size)
+            if not delivery_ids:
+                break
+            queue_unparked(delivery_ids)
+            drained += len(delivery_ids)
+        
+        logger.info(f"Drained {drained} parked deliveries for subscription {subscription_id}")
+        return {"status": "success", "drained_count": drained}
+
+@celery_app.task
+def probe_parked_deliveries():
+    """Send one probe for each open circuit that is due one, and drain circuits that closed"""
+    with app_context() as db:
+        # Import models here to avoid circular imports
+        from models import WebhookDelivery
+        
+        subscription_ids = [row[0] for row in db.session.query(WebhookDelivery.subscription_id)
+                            .filter_by(status='parked').distinct()]
+        
+        probes = 0
+        for subscription_id in subscription_ids:
+            state, probe_due = circuit_breaker.state(subscription_id)
+            if state == 'closed':
+                drain_parked_deliveries.delay(subscription_id)
+            elif probe_due:
+                # The oldest parked delivery is the probe; process_webhook claims the probe slot
+                queue_unparked(unpark_deliveries(db, subscription_id, 1))
+                probes += 1
+        
+        return {"status": "success", "parked_subscriptions": len(subscription_ids), "probes": probes}
+
+def build_delivery_headers(delivery_id, event_type, attempt_number, signature=None):
+    """Build the outbound headers for a delivery attempt"""
+    headers = {
+        'Content-Type': 'application/json',
+        'User-Agent': 'Webhook-Delivery-Service/1.0',
+        'X-Webhook-ID': str(delivery_id),
+        'X-Webhook-Attempt': str(attempt_number)
+    }
+    
+    # Add event type if available
+    if event_type:
+        headers['X-Event-Type'] = event_type
+    
+    # Add signature if secret is configured
+    if signature:
+        headers['X-Hub-Signature-256'] = signature
+    
+    return headers
 
 def attempt_delivery(delivery, subscription, attempt_number, db):
     """Attempt to deliver a webhook to its target URL"""
@@ -102,46 +633,29 @@ def attempt_delivery(delivery, subscription, attempt_number, db):
     )
     
     try:
-        # Get the payload and prepare headers
-        payload = delivery.payload
-        headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': 'Webhook-Delivery-Service/1.0',
-            'X-Webhook-ID': str(delivery.id),
-            'X-Webhook-Attempt': str(attempt_number)
-        }
-        
-        # Add event type if available
-        if delivery.event_type:
-            headers['X-Event-Type'] = delivery.event_type
-        
-        # Add signature if secret is configured
-        if subscription.secret:
-            payload_bytes = json.dumps(payload).encode('utf-8')
-            signature = hmac.new(
-                subscription.secret.encode('utf-8'),
-                payload_bytes,
-                hashlib.sha256
-            ).hexdigest()
-            headers['X-Hub-Signature-256'] = f"sha256={signature}"
+        # Send the stored body bytes, reusing their signature while the secret is unchanged
+        body = delivery_body(delivery)
+        headers = build_delivery_headers(
+            delivery.id, delivery.event_type, attempt_number,
+            delivery_signature(delivery, subscription, body)
+        )
         
         # Make the POST request with timeout
         timeout = app.config.get('DELIVERY_TIMEOUT', 10)
-        response = requests.post(
-            subscription.target_url,
-            json=payload,
-            headers=headers,
-            timeout=timeout
-        )
+        if attempt_number == 1:
+            observe_queue_wait(delivery.created_at)
+        with delivery_request(subscription.id):
+            response = delivery_client.post(
+                subscription.target_url,
+                data=body,
+                headers=headers,
+                timeout=timeout,
+                stream=True
+            )
         
         # Record the response details
         attempt.status_code = response.status_code
-        
-        # Limit response body size to avoid storing very large responses
-        response_body = response.text[:1000]
-        if len(response.text) > 1000:
-            response_body += '... [truncated]'
-        attempt.response_body = response_body
+        attempt.response_body = capture_response_body(response)
         
         # Check if successful (2xx response)
         if 200 <= response.status_code < 300:
@@ -179,9 +693,9 @@ def attempt_delivery(delivery, subscription, attempt_number, db):
             'reason': 'unexpected_error'
         }
     
-    # Save the attempt
+    # Add the attempt; the caller commits it together with the delivery's new status
     db.session.add(attempt)
-    db.session.commit()
+    delivery.attempt_count = attempt_number
     
     return result
 
@@ -189,36 +703,43 @@ def attempt_delivery(delivery, subscription, attempt_number, db):
 def cleanup_old_delivery_logs():
     """Clean up delivery logs older than the retention period"""
     with app_context() as db:
-        # Import models here to avoid circular imports
+        # Import app here to avoid circular imports
         from app import app
-        from models import WebhookDelivery, DeliveryAttempt
+        from retention import purge_expired_deliveries
         
         retention_hours = app.config.get('LOG_RETENTION_PERIOD', 72)
         cutoff_date = datetime.utcnow() - timedelta(hours=retention_hours)
         
         logger.info(f"Cleaning up delivery logs older than {cutoff_date}")
         
-        # Find old deliveries
-        old_deliveries = WebhookDelivery.query.filter(
-            WebhookDelivery.created_at < cutoff_date
-        ).all()
-        
-        count = 0
-        for delivery in old_deliveries:
-            # Delete related attempts first (foreign key constraint)
-            DeliveryAttempt.query.filter_by(delivery_id=delivery.id).delete()
-            
-            # Delete the delivery
-            db.session.delete(delivery)
-            count += 1
-            
-            # Commit in batches to avoid long transactions
-            if count % 100 == 0:
-                db.session.commit()
-        
-        # Final commit
+        metrics = purge_expired_deliveries(
+            db.session,
+            cutoff_date,
+            chunk_size=app.config.get('RETENTION_CHUNK_SIZE', 5000),
+            rows_per_second=app.config.get('RETENTION_MAX_ROWS_PER_SECOND', 0),
+            max_seconds=app.config.get('RETENTION_MAX_SECONDS')
+        )
+        count = metrics['deleted_deliveries']
+        
+        # Drop stats rollup buckets that only covered deleted deliveries
+        from stats import prune_rollups
+        prune_rollups(cutoff_date)
         db.session.commit()
         
-        logger.info(f"Cleaned up {count} old delivery logs")
+        logger.info(f"Cleaned up {count} old delivery logs: {metrics}")
+        
+        return {"status": "success", "deleted_count": count, "metrics": metrics}
+
+@celery_app.task
+def maintain_delivery_partitions():
+    """Create upcoming daily partitions for the delivery tables when they are partitioned"""
+    with app_context() as db:
+        from migrations import ensure_partitions
+        
+        with db.engine.begin() as connection:
+            created = ensure_partitions(connection)
+        
+        if created:
+            logger.info(f"Created {created} delivery table partitions")
         
-        return {"status": "success", "deleted_count": count}
\ No newline at end of file
+        return {"status": "success", "created_count": created}
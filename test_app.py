@@ -4,9 +4,11 @@ import uuid
 from unittest.mock import patch, MagicMock
 from datetime import datetime, timedelta
 
-from app import app, db
+from app import app, db, direct_executor
 from models import Subscription, WebhookDelivery, DeliveryAttempt
 from tasks import cleanup_old_delivery_logs, attempt_delivery
+from subscription_cache import subscription_cache, get_subscription
+from delivery_client import DeliveryClient
 
 class WebhookDeliveryServiceTestCase(unittest.TestCase):
     def setUp(self):
@@ -14,12 +16,15 @@ class WebhookDeliveryServiceTestCase(unittest.TestCase):
         app.config['TESTING'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.app = app.test_client()
+        subscription_cache.clear()
         
         with app.app_context():
             db.create_all()
     
     def tearDown(self):
         """Clean up after tests"""
+        # Let background direct deliveries finish before their tables are dropped
+        direct_executor.join(timeout=10)
         with app.app_context():
             db.session.remove()
             db.drop_all()
@@ -57,6 +62,181 @@ class WebhookDeliveryServiceTestCase(unittest.TestCase):
         response = self.app.get(f'/api/subscriptions/{subscription_id}')
         self.assertEqual(response.status_code, 404)
     
+    def test_subscription_cache_invalidation(self):
+        """Test cached subscriptions are refreshed after an update"""
+        response = self.app.post('/api/subscriptions',
+                              json={'target_url': 'https://example.com/webhook'})
+        subscription_id = json.loads(response.data)['subscription']['id']
+        
+        with app.app_context():
+            cached = get_subscription(subscription_id)
+            self.assertEqual(cached.target_url, 'https://example.com/webhook')
+            
+            # Served from the cache without touching the database
+            with patch('subscription_cache._load_subscription') as mock_loader:
+                self.assertIs(get_subscription(subscription_id), cached)
+                mock_loader.assert_not_called()
+        
+        # Updating the subscription invalidates the cached snapshot
+        self.app.put(f'/api/subscriptions/{subscription_id}',
+                  json={'target_url': 'https://example.com/updated'})
+        with app.app_context():
+            self.assertEqual(get_subscription(subscription_id).target_url,
+                             'https://example.com/updated')
+        
+        # Deleted subscriptions are no longer served
+        self.app.delete(f'/api/subscriptions/{subscription_id}')
+        with app.app_context():
+            self.assertIsNone(get_subscription(subscription_id))
+    
+    def test_subscription_cache_keeps_secrets_out_of_redis(self):
+        """Test subscriptions with a secret are only cached in-process when Redis secrets are disabled"""
+        from subscription_cache import SubscriptionCache
+        
+        cache = SubscriptionCache('redis://localhost:6379/1', redis_secrets=False)
+        client = MagicMock()
+        client.mget.return_value = [None, None]
+        cache._redis.get = MagicMock(return_value=client)
+        
+        with app.app_context():
+            signed = Subscription(target_url='https://example.com/signed', secret='s3cret')
+            unsigned = Subscription(target_url='https://example.com/unsigned')
+            db.session.add_all([signed, unsigned])
+            db.session.commit()
+            
+            self.assertEqual(cache.get(signed.id, lambda _: signed).secret, 's3cret')
+            client.set.assert_not_called()
+            
+            cache.get(unsigned.id, lambda _: unsigned)
+            client.set.assert_called_once()
+    
+    def test_subscription_pages_use_cached_index(self):
+        """Test pages render from the cached subscription index and paginated stats"""
+        for n in range(3):
+            self.app.post('/api/subscriptions',
+                       json={'name': f'Sub {n}', 'target_url': f'https://example.com/{n}'})
+        
+        from subscription_cache import _load_subscription_index
+        with patch('subscription_cache._load_subscription_index',
+                   side_effect=_load_subscription_index) as mock_loader:
+            # The test webhook modal on every page loads its subscriptions from the API when opened
+            response = self.app.get('/')
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(b'https://example.com/0', response.data)
+            self.assertIn(b'/api/subscriptions?page=1&per_page=100', response.data)
+            mock_loader.assert_not_called()
+            
+            self.assertEqual(self.app.get('/deliveries').status_code, 200)
+            response = self.app.get('/deliveries')
+            self.assertIn(b'Sub 2', response.data)
+            mock_loader.assert_called_once()
+        
+        response = self.app.get('/subscriptions?page=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'https://example.com/0', response.data)
+        
+        response = self.app.get('/api/subscriptions?page=1&per_page=2')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['subscriptions']), 2)
+        self.assertEqual(data['total'], 3)
+        self.assertTrue(data['has_next'])
+    
+    def test_delivery_cursor_pagination(self):
+        """Test delivery listings page through rows with a (created_at, id) cursor"""
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+            # Two rows share a timestamp so the id breaks the tie
+            now = datetime.utcnow()
+            deliveries = [WebhookDelivery(
+                subscription_id=subscription_id,
+                payload={'n': n},
+                created_at=now - timedelta(minutes=min(n, 3)),
+                status='failed' if n == 4 else 'pending'
+            ) for n in range(5)]
+            db.session.add_all(deliveries)
+            db.session.commit()
+            ids = [str(delivery.id) for delivery in deliveries]
+        
+        seen = []
+        cursor = None
+        while True:
+            url = f'/api/subscriptions/{subscription_id}/deliveries?limit=2'
+            if cursor:
+                url += f'&cursor={cursor}'
+            data = json.loads(self.app.get(url).data)
+            seen.extend(delivery['id'] for delivery in data['deliveries'])
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(sorted(seen), sorted(ids))
+        self.assertEqual(seen[0], ids[0])
+        # The two oldest share a timestamp and are ordered by id
+        self.assertEqual(sorted(seen[-2:]), sorted(ids[3:]))
+        
+        data = json.loads(self.app.get('/api/deliveries?status=failed').data)
+        self.assertEqual([delivery['id'] for delivery in data['deliveries']], [ids[4]])
+        self.assertIsNone(data['next_cursor'])
+        
+        response = self.app.get('/api/deliveries?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.app.get('/deliveries').status_code, 200)
+        
+        # Limits below one are raised to a single delivery per page
+        for limit in (0, -1):
+            for url in (f'/api/deliveries?limit={limit}',
+                        f'/api/subscriptions/{subscription_id}/deliveries?limit={limit}'):
+                response = self.app.get(url)
+                self.assertEqual(response.status_code, 200, url)
+                data = json.loads(response.data)
+                self.assertEqual([delivery['id'] for delivery in data['deliveries']], [ids[0]])
+                self.assertIsNotNone(data['next_cursor'])
+        
+    def test_schema_migrations(self):
+        """Test migrations are recorded once, create the delivery indexes and backfill in chunks"""
+        import migrations
+        from sqlalchemy import inspect, text
+        
+        with app.app_context():
+            engine = db.engine
+            
+            def drop_schema_migrations():
+                with engine.begin() as connection:
+                    connection.execute(text("DROP TABLE IF EXISTS schema_migrations"))
+            self.addCleanup(drop_schema_migrations)
+            
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            deliveries = [WebhookDelivery(subscription_id=subscription.id, payload={'n': n}) for n in range(5)]
+            for n, delivery in enumerate(deliveries):
+                delivery.attempts.extend(DeliveryAttempt(attempt_number=i + 1, status='failed') for i in range(n))
+            db.session.add_all(deliveries)
+            db.session.commit()
+            # Rows written before the attempt_count column existed
+            db.session.execute(WebhookDelivery.__table__.update().values(attempt_count=0))
+            db.session.commit()
+            
+            with patch.object(migrations, 'BACKFILL_BATCH_SIZE', 2):
+                applied = migrations.upgrade(db.engine)
+            self.assertEqual(applied, [version for version, _, _ in migrations.MIGRATIONS])
+            self.assertEqual(migrations.upgrade(db.engine), [])
+            db.session.expire_all()
+            self.assertEqual(sorted(db.session.get(WebhookDelivery, delivery.id).attempt_count
+                                    for delivery in deliveries), [0, 1, 2, 3, 4])
+            
+            with db.engine.connect() as connection:
+                versions = migrations.applied_versions(connection)
+            self.assertEqual(versions, {version for version, _, _ in migrations.MIGRATIONS})
+            
+            indexes = {index['name'] for index in inspect(db.engine).get_indexes('delivery_attempts')}
+            self.assertIn('ix_delivery_attempts_delivery_id', indexes)
+            indexes = {index['name'] for index in inspect(db.engine).get_indexes('webhook_deliveries')}
+            self.assertIn('ix_webhook_deliveries_subscription_created_at', indexes)
+    
     def test_webhook_ingestion(self):
         """Test webhook ingestion"""
         # Create a subscription first
@@ -80,9 +260,189 @@ class WebhookDeliveryServiceTestCase(unittest.TestCase):
             self.assertEqual(delivery.subscription_id, subscription_id)
             self.assertEqual(delivery.payload, {'event': 'test', 'data': 'test_data'})
     
-    @patch('tasks.requests.post')
+    @patch('tasks.process_webhook_batch.delay')
+    def test_batch_webhook_ingestion(self, mock_delay):
+        """Test batch ingestion from a JSON array and from NDJSON"""
+        with app.app_context():
+            subscription = Subscription(
+                target_url='https://example.com/webhook',
+                event_types=['order.created']
+            )
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+        response = self.app.post(f'/api/ingest/{subscription_id}/batch', json=[
+            {'payload': {'order': 1}, 'event_type': 'order.created'},
+            {'payload': {'order': 2}, 'event_type': 'order.deleted'},
+            {'event_type': 'order.created'},
+            {'payload': {'order': 3}, 'event_type': 'order.created'}
+        ])
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        self.assertEqual(data['accepted'], 2)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['accepted', 'rejected', 'invalid', 'accepted'])
+        
+        # All accepted deliveries are queued with a single broker message
+        mock_delay.assert_called_once_with(
+            [data['results'][0]['delivery_id'], data['results'][3]['delivery_id']]
+        )
+        
+        ndjson = '{"payload": {"order": 4}, "event_type": "order.created"}\nnot json\n'
+        response = self.app.post(f'/api/ingest/{subscription_id}/batch', data=ndjson,
+                              content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        self.assertEqual([r['status'] for r in data['results']], ['accepted', 'invalid'])
+        
+        with app.app_context():
+            self.assertEqual(WebhookDelivery.query.filter_by(subscription_id=subscription_id).count(), 3)
+    
+    @patch('tasks.process_webhook_batch.delay')
+    def test_streaming_webhook_ingestion(self, mock_delay):
+        """Test streaming NDJSON ingestion flushes in batches and reports line errors"""
+        app.config['INGEST_STREAM_BATCH_SIZE'] = 2
+        self.addCleanup(app.config.__setitem__, 'INGEST_STREAM_BATCH_SIZE', 1000)
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+        lines = [json.dumps({'payload': {'n': n}}) for n in range(6)]
+        lines.insert(2, '{broken')
+        response = self.app.post(f'/api/ingest/{subscription_id}/stream',
+                              data='\n'.join(lines) + '\n',
+                              content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        self.assertEqual(data['progress']['accepted'], 6)
+        self.assertEqual(data['progress']['invalid'], 1)
+        self.assertEqual(data['progress']['batches'], 3)
+        self.assertEqual(data['errors'][0]['line'], 3)
+        self.assertEqual(mock_delay.call_count, 3)
+        
+        with app.app_context():
+            self.assertEqual(WebhookDelivery.query.filter_by(subscription_id=subscription_id).count(), 6)
+    
+    @patch('tasks.delivery_client.post')
+    def test_streamed_deliveries_survive_broker_outage(self, mock_post):
+        """Test streamed deliveries left pending by a broker outage are sent by the retry scheduler"""
+        from tasks import dispatch_due_retries, process_webhook
+        
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.text = 'OK'
+        mock_post.return_value = mock_response
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+        lines = [json.dumps({'payload': {'n': n}}) for n in range(2)]
+        with patch('tasks.process_webhook_batch.delay', side_effect=ConnectionError('broker down')):
+            response = self.app.post(f'/api/ingest/{subscription_id}/stream',
+                                  data='\n'.join(lines) + '\n',
+                                  content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 202)
+        mock_post.assert_not_called()
+        
+        with app.app_context():
+            statuses = [d.status for d in WebhookDelivery.query.filter_by(subscription_id=subscription_id)]
+            self.assertEqual(statuses, ['pending', 'pending'])
+        
+        # Recent pending deliveries may still be on their way through the broker
+        with patch('tasks.process_webhook_batch.delay') as mock_delay:
+            self.assertEqual(dispatch_due_retries()['dispatched_count'], 0)
+            mock_delay.assert_not_called()
+        
+        # Once they have been pending for a claim lease the scheduler sends them
+        app.config['RETRY_CLAIM_LEASE'] = 0
+        self.addCleanup(app.config.__setitem__, 'RETRY_CLAIM_LEASE', 600)
+        with patch('tasks.process_webhook_batch.delay',
+                   side_effect=lambda ids: [process_webhook(uuid.UUID(delivery_id)) for delivery_id in ids]):
+            self.assertEqual(dispatch_due_retries()['dispatched_count'], 2)
+        self.assertEqual(mock_post.call_count, 2)
+        
+        with app.app_context():
+            statuses = [d.status for d in WebhookDelivery.query.filter_by(subscription_id=subscription_id)]
+            self.assertEqual(statuses, ['delivered', 'delivered'])
+    
+    @patch('tasks.process_webhook_batch.delay')
+    def test_publish_fans_out_through_routing_index(self, mock_delay):
+        """Test a published event is delivered to every active subscription whose event types match"""
+        from routing import routing_index
+        from signing import compute_signature
+        routing_index.clear()
+        
+        def create(**fields):
+            response = self.app.post('/api/subscriptions', json={'target_url': 'https://example.com/webhook', **fields})
+            return json.loads(response.data)['subscription']['id']
+        
+        exact = create(event_types=['order.created'])
+        prefix = create(event_types=['order.*'])
+        catch_all = create()
+        other = create(event_types=['invoice.*'])
+        create(event_types=['order.created'], status='inactive')
+        signed = create(event_types=['*.created'], secret='s3cret')
+        
+        body = json.dumps({'order': 1}).encode()
+        
+        def publish(event_type='order.created', signature=compute_signature('publish-secret', body)):
+            headers = {'X-Event-Type': event_type, 'Content-Type': 'application/json'}
+            if signature:
+                headers['X-Hub-Signature-256'] = signature
+            return self.app.post('/api/publish', data=body, headers=headers)
+        
+        def published_to(event_type='order.created'):
+            response = publish(event_type)
+            self.assertEqual(response.status_code, 202)
+            return {d['subscription_id']: d['delivery_id'] for d in json.loads(response.data)['deliveries']}
+        
+        # Disabled until a publish secret is configured
+        self.assertEqual(publish().status_code, 503)
+        app.config['PUBLISH_SECRET'] = 'publish-secret'
+        self.addCleanup(app.config.update, PUBLISH_SECRET=None)
+        
+        # Unsigned and wrongly signed events are rejected
+        self.assertEqual(publish(signature=None).status_code, 401)
+        self.assertEqual(publish(signature=compute_signature('wrong', body)).status_code, 401)
+        mock_delay.assert_not_called()
+        
+        published = published_to()
+        self.assertEqual(sorted(published), sorted([exact, prefix, catch_all, signed]))
+        # All the fan-out's deliveries are queued with a single broker message
+        mock_delay.assert_called_once()
+        self.assertEqual(sorted(mock_delay.call_args[0][0]), sorted(published.values()))
+        self.assertEqual(sorted(published_to('order.deleted')), sorted([prefix, catch_all]))
+        
+        with app.app_context():
+            delivery = WebhookDelivery.query.get(uuid.UUID(published[signed]))
+            self.assertEqual(delivery.event_type, 'order.created')
+            self.assertEqual(delivery.signature, compute_signature('s3cret', bytes(delivery.raw_body)))
+        
+        # Changes made through the API are applied to the index incrementally
+        self.app.put(f'/api/subscriptions/{other}', json={'event_types': ['order.created']})
+        self.app.delete(f'/api/subscriptions/{exact}')
+        self.assertEqual(sorted(published_to()), sorted([prefix, catch_all, other, signed]))
+        
+        # Subscriptions changed by other processes are picked up by polling
+        with app.app_context():
+            db.session.add(Subscription(target_url='https://example.com/new', event_types=['order.created']))
+            db.session.commit()
+        with patch.object(routing_index, 'refresh_interval', 0):
+            self.assertEqual(len(published_to()), 5)
+        
+        self.assertEqual(publish(event_type='').status_code, 400)
+    
+    @patch('tasks.delivery_client.post')
     def test_webhook_delivery(self, mock_post):
         """Test webhook delivery process"""
+        import stats
+        
         # Mock the request response
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -105,17 +465,694 @@ class WebhookDeliveryServiceTestCase(unittest.TestCase):
             db.session.commit()
             
             # Attempt delivery
-            result = attempt_delivery(delivery, subscription, 1)
+            result = attempt_delivery(delivery, subscription, 1, db)
             
             # Verify success
             self.assertEqual(result['status'], 'success')
             
-            # Verify attempt was recorded
+            # The attempt is only added to the session; the caller commits it with the new status
+            self.assertEqual([type(instance) for instance in db.session.new], [DeliveryAttempt])
+            self.assertEqual(delivery.attempt_count, 1)
+            delivery.status = 'delivered'
+            db.session.commit()
+            
+            # Verify attempt was recorded along with the attempt count and the rollup
+            db.session.expire_all()
+            self.assertEqual(db.session.get(WebhookDelivery, delivery.id).attempt_count, 1)
+            summary = stats.summarize(subscription.id)
+            self.assertEqual((summary['delivered'], summary['pending'], summary['attempts']), (1, 0, 1))
             attempt = DeliveryAttempt.query.filter_by(delivery_id=delivery.id).first()
             self.assertIsNotNone(attempt)
             self.assertEqual(attempt.status, 'success')
             self.assertEqual(attempt.status_code, 200)
     
+    @patch('app.dispatch_deliveries')
+    def test_ingest_verifies_raw_body_signature(self, mock_dispatch):
+        """Test ingest signatures are checked against the raw body bytes as sent"""
+        from signing import compute_signature
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook', secret='s3cret')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+        # Key order and spacing differ from what json.dumps would produce
+        body = b'{"z": 1,  "a": {"nested": [1, 2]}}'
+        response = self.app.post(f'/api/ingest/{subscription_id}', data=body,
+                              content_type='application/json',
+                              headers={'X-Hub-Signature-256': compute_signature('s3cret', body)})
+        self.assertEqual(response.status_code, 202)
+        delivery_id = uuid.UUID(json.loads(response.data)['delivery_id'])
+        
+        with app.app_context():
+            delivery = WebhookDelivery.query.get(delivery_id)
+            self.assertEqual(bytes(delivery.raw_body), body)
+            self.assertEqual(delivery.payload, {'z': 1, 'a': {'nested': [1, 2]}})
+        
+        response = self.app.post(f'/api/ingest/{subscription_id}', data=body + b' ',
+                              content_type='application/json',
+                              headers={'X-Hub-Signature-256': compute_signature('s3cret', body)})
+        self.assertEqual(response.status_code, 401)
+        
+        response = self.app.post(f'/api/ingest/{subscription_id}', data=b'{not json',
+                              content_type='application/json',
+                              headers={'X-Hub-Signature-256': compute_signature('s3cret', b'{not json')})
+        self.assertEqual(response.status_code, 400)
+        mock_dispatch.assert_called_once()
+    
+    @patch('tasks.delivery_client.post')
+    def test_delivery_sends_signed_ingest_bytes(self, mock_post):
+        """Test deliveries send the stored body bytes with the signature made at ingest"""
+        from signing import canonical_body, compute_signature
+        
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.text = 'OK'
+        mock_post.return_value = mock_response
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook', secret='s3cret')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+        payload = {'items': ['a', 'b'], 'order': 1}
+        signature = compute_signature('s3cret', canonical_body(payload))
+        with patch('app.dispatch_deliveries'):
+            response = self.app.post(f'/api/ingest/{subscription_id}', json=payload,
+                                  headers={'X-Hub-Signature-256': signature})
+        self.assertEqual(response.status_code, 202)
+        delivery_id = uuid.UUID(json.loads(response.data)['delivery_id'])
+        
+        with app.app_context():
+            delivery = WebhookDelivery.query.get(delivery_id)
+            self.assertEqual(bytes(delivery.raw_body), canonical_body(payload))
+            self.assertEqual(delivery.signature, signature)
+            
+            subscription = get_subscription(subscription_id)
+            with patch('signing.compute_signature') as mock_sign:
+                attempt_delivery(delivery, subscription, 1, db)
+                mock_sign.assert_not_called()
+            _, kwargs = mock_post.call_args
+            self.assertEqual(kwargs['data'], canonical_body(payload))
+            self.assertEqual(kwargs['headers']['X-Hub-Signature-256'], signature)
+            
+            # A rotated secret is signed once and then reused
+            Subscription.query.get(subscription_id).secret = 'rotated'
+            db.session.commit()
+            subscription_cache.clear()
+            attempt_delivery(delivery, get_subscription(subscription_id), 2, db)
+            rotated = compute_signature('rotated', canonical_body(payload))
+            self.assertEqual(mock_post.call_args[1]['headers']['X-Hub-Signature-256'], rotated)
+            self.assertEqual(WebhookDelivery.query.get(delivery_id).signature, rotated)
+    
+    @patch('tasks.delivery_client.post')
+    def test_throttled_delivery_is_deferred(self, mock_post):
+        """Test throttled deliveries are parked for the retry scheduler without making or recording an attempt"""
+        from tasks import process_webhook
+        from throttle import ThrottleDecision, is_overloaded
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            delivery = WebhookDelivery(subscription_id=subscription.id, payload={'event': 'test'})
+            db.session.add(delivery)
+            db.session.commit()
+            delivery_id = delivery.id
+            subscription_id = subscription.id
+        
+        with patch('tasks.delivery_throttle.acquire', return_value=ThrottleDecision(False, 120.0, None)) as acquire:
+            self.assertEqual(process_webhook(delivery_id)['status'], 'deferred')
+        mock_post.assert_not_called()
+        # The delivery id is passed so it keeps the token it reserved
+        acquire.assert_called_once_with(subscription_id, delivery_id)
+        
+        with app.app_context():
+            delivery = WebhookDelivery.query.get(delivery_id)
+            self.assertEqual(delivery.status, 'processing')
+            self.assertEqual(delivery.attempt_count, 0)
+            self.assertGreater(delivery.next_attempt_at, datetime.utcnow() + timedelta(seconds=100))
+            self.assertEqual(DeliveryAttempt.query.filter_by(delivery_id=delivery_id).count(), 0)
+        
+        self.assertTrue(is_overloaded(503))
+        self.assertTrue(is_overloaded(429))
+        self.assertTrue(is_overloaded(no_response=True))
+        self.assertFalse(is_overloaded(404))
+    
+    @patch('tasks.process_webhook_batch.delay')
+    @patch('tasks.delivery_client.post')
+    def test_open_circuit_parks_and_drains(self, mock_post, mock_batch_delay):
+        """Test deliveries are parked while a circuit is open and re-queued once it closes"""
+        import stats
+        from circuit_breaker import OPEN
+        from tasks import process_webhook, drain_parked_deliveries
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+            deliveries = [WebhookDelivery(subscription_id=subscription_id, payload={'n': n}) for n in range(3)]
+            db.session.add_all(deliveries)
+            db.session.commit()
+            delivery_ids = [delivery.id for delivery in deliveries]
+        
+        with patch('tasks.circuit_breaker.allow', return_value=OPEN):
+            for delivery_id in delivery_ids:
+                self.assertEqual(process_webhook(delivery_id), {'status': 'parked'})
+        mock_post.assert_not_called()
+        
+        with app.app_context():
+            self.assertEqual(DeliveryAttempt.query.count(), 0)
+            self.assertEqual(stats.summarize(subscription_id)['parked'], 3)
+        
+        app.config['CIRCUIT_DRAIN_BATCH_SIZE'] = 2
+        self.addCleanup(app.config.__setitem__, 'CIRCUIT_DRAIN_BATCH_SIZE', 500)
+        with patch('tasks.circuit_breaker.state', return_value=('closed', False)):
+            self.assertEqual(drain_parked_deliveries(subscription_id)['drained_count'], 3)
+        self.assertEqual(mock_batch_delay.call_count, 2)
+        
+        with app.app_context():
+            summary = stats.summarize(subscription_id)
+            self.assertEqual(summary['parked'], 0)
+            self.assertEqual(summary['pending'], 3)
+    
+    @patch('tasks.circuit_breaker.record', return_value=False)
+    @patch('tasks.delivery_client.post')
+    def test_client_errors_count_against_circuit(self, mock_post, mock_record):
+        """Test 4xx responses are recorded as circuit failures though they do not slow the throttle"""
+        from circuit_breaker import is_failure
+        from tasks import process_webhook
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+            deliveries = [WebhookDelivery(subscription_id=subscription_id, payload={'n': n}) for n in range(2)]
+            db.session.add_all(deliveries)
+            db.session.commit()
+            delivery_ids = [delivery.id for delivery in deliveries]
+        
+        for delivery_id, status_code in zip(delivery_ids, (410, 200)):
+            response = MagicMock()
+            response.status_code, response.text = status_code, 'Gone' if status_code == 410 else 'OK'
+            mock_post.return_value = response
+            process_webhook(delivery_id)
+        
+        self.assertEqual([call.args for call in mock_record.call_args_list],
+                         [(subscription_id, False), (subscription_id, True)])
+        
+        for status_code in (401, 404, 410, 429, 503):
+            self.assertTrue(is_failure(status_code))
+        self.assertTrue(is_failure(no_response=True))
+        self.assertFalse(is_failure(204))
+    
+    @patch('tasks.process_ordered_lane.apply_async')
+    @patch('tasks.delivery_client.post')
+    def test_ordered_lane_holds_back_later_deliveries(self, mock_post, mock_apply_async):
+        """Test an ordered subscription's lane delivers oldest first and waits on a failing delivery"""
+        from lanes import lane_for, lane_queue
+        from tasks import dispatch_due_retries, process_ordered_lane
+        
+        ok_response, error_response = MagicMock(), MagicMock()
+        ok_response.status_code, ok_response.text = 200, 'OK'
+        error_response.status_code, error_response.text = 500, 'Error'
+        mock_post.side_effect = [ok_response, error_response]
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook', ordered=True)
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+            
+            now = datetime.utcnow()
+            deliveries = [
+                WebhookDelivery(subscription_id=subscription_id, payload={'n': n},
+                                created_at=now + timedelta(seconds=n))
+                for n in range(3)
+            ]
+            db.session.add_all(deliveries)
+            db.session.commit()
+            delivery_ids = [delivery.id for delivery in deliveries]
+        
+        before = datetime.utcnow()
+        result = process_ordered_lane(subscription_id)
+        self.assertEqual(result['status'], 'waiting')
+        # RETRY_DELAYS[0] is 10 seconds, jittered by up to 20%
+        self.assertTrue(8 <= result['next_run_in'] <= 12, result)
+        
+        # Sent oldest first, and the third delivery waits behind the failed second one;
+        # the lane is not queued with a countdown but left to the retry scheduler
+        sent = [call[1]['headers']['X-Webhook-ID'] for call in mock_post.call_args_list]
+        self.assertEqual(sent, [str(delivery_ids[0]), str(delivery_ids[1])])
+        mock_apply_async.assert_not_called()
+        
+        with app.app_context():
+            statuses = [db.session.get(WebhookDelivery, delivery_id).status for delivery_id in delivery_ids]
+            self.assertEqual(statuses, ['delivered', 'processing', 'pending'])
+            # The retry is stored, so the lane can be restarted if its message is lost
+            retried = db.session.get(WebhookDelivery, delivery_ids[1])
+            delay = (retried.next_attempt_at - before).total_seconds()
+            self.assertTrue(8 <= delay <= 12.5, delay)
+        
+        # The lane does not send anything before the retry is due
+        mock_post.reset_mock()
+        process_ordered_lane(subscription_id)
+        mock_post.assert_not_called()
+        
+        # Nor does the retry scheduler restart it, or claim the delivery away from the lane
+        self.assertEqual(dispatch_due_retries(), {'status': 'success', 'dispatched_count': 0, 'restarted_lanes': 0})
+        mock_apply_async.assert_not_called()
+        
+        # Once the retry is due the scheduler restarts the lane, which retries the delivery
+        with app.app_context():
+            retried = db.session.get(WebhookDelivery, delivery_ids[1])
+            retried.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+            db.session.commit()
+        self.assertEqual(dispatch_due_retries(), {'status': 'success', 'dispatched_count': 0, 'restarted_lanes': 1})
+        mock_apply_async.assert_called_once_with(
+            args=[subscription_id], queue=lane_queue(lane_for(subscription_id)))
+    
+    @patch('tasks.deliver_batch.apply_async')
+    @patch('tasks.deliver_batch.delay')
+    @patch('tasks.delivery_client.post')
+    def test_batched_delivery_coalesces_deliveries(self, mock_post, mock_delay, mock_apply_async):
+        """Test a batched subscription's deliveries are sent as one signed JSON array POST"""
+        from signing import compute_signature
+        from tasks import deliver_batch, dispatch_due_retries
+        
+        ok_response, error_response = MagicMock(), MagicMock()
+        ok_response.status_code, ok_response.text = 200, 'OK'
+        error_response.status_code, error_response.text = 503, 'Unavailable'
+        mock_post.side_effect = [ok_response, error_response]
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook', secret='batch-secret',
+                                        batch_max_size=2)
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+            
+            now = datetime.utcnow()
+            deliveries = [
+                WebhookDelivery(subscription_id=subscription_id, payload={'n': n},
+                                created_at=now + timedelta(seconds=n))
+                for n in range(3)
+            ]
+            db.session.add_all(deliveries)
+            db.session.commit()
+            delivery_ids = [delivery.id for delivery in deliveries]
+        
+        # The first full batch is sent and another send is queued for the rest
+        self.assertEqual(deliver_batch(subscription_id), {'status': 'delivered', 'count': 2})
+        mock_delay.assert_called_once_with(subscription_id)
+        
+        _, kwargs = mock_post.call_args
+        self.assertEqual(kwargs['data'], b'[{"n": 0},{"n": 1}]')
+        self.assertEqual(kwargs['headers']['X-Hub-Signature-256'],
+                         compute_signature('batch-secret', kwargs['data']))
+        self.assertEqual(kwargs['headers']['X-Webhook-IDs'], f"{delivery_ids[0]},{delivery_ids[1]}")
+        
+        # A failed batch records an attempt for each delivery and waits in the database for its retry
+        before = datetime.utcnow()
+        result = deliver_batch(subscription_id)
+        self.assertEqual(result['status'], 'retry_scheduled')
+        mock_apply_async.assert_not_called()
+        
+        with app.app_context():
+            statuses = [db.session.get(WebhookDelivery, delivery_id).status for delivery_id in delivery_ids]
+            self.assertEqual(statuses, ['delivered', 'delivered', 'processing'])
+            self.assertEqual(DeliveryAttempt.query.count(), 3)
+            failed = DeliveryAttempt.query.filter_by(delivery_id=delivery_ids[2]).one()
+            self.assertEqual((failed.status, failed.status_code), ('failed', 503))
+            # RETRY_DELAYS[0] is 10 seconds, jittered by up to 20%
+            retried = db.session.get(WebhookDelivery, delivery_ids[2])
+            delay = (retried.next_attempt_at - before).total_seconds()
+            self.assertTrue(8 <= delay <= 12.5, delay)
+            retried.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+            db.session.commit()
+        
+        # The retry scheduler hands the due batch back to deliver_batch, including with a database engine
+        app.config['DELIVERY_ENGINE'] = 'queue'
+        self.addCleanup(app.config.__setitem__, 'DELIVERY_ENGINE', 'celery')
+        mock_delay.reset_mock()
+        self.assertEqual(dispatch_due_retries()['dispatched_count'], 1)
+        mock_delay.assert_called_once_with(subscription_id, [str(delivery_ids[2])])
+    
+    @patch('tasks.process_webhook_batch.delay')
+    @patch('tasks.delivery_client.post')
+    def test_failed_delivery_retry_is_scheduled_in_database(self, mock_post, mock_batch_delay):
+        """Test a failed attempt stores a jittered next_attempt_at that the retry scheduler dispatches"""
+        from tasks import process_webhook, dispatch_due_retries
+        
+        mock_response = MagicMock()
+        mock_response.status_code = 500
+        mock_response.text = 'Error'
+        mock_post.return_value = mock_response
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            delivery = WebhookDelivery(subscription_id=subscription.id, payload={'event': 'test'})
+            db.session.add(delivery)
+            db.session.commit()
+            delivery_id = delivery.id
+        
+        before = datetime.utcnow()
+        result = process_webhook(delivery_id)
+        self.assertEqual(result['status'], 'retry_scheduled')
+        
+        with app.app_context():
+            delivery = db.session.get(WebhookDelivery, delivery_id)
+            self.assertEqual(delivery.status, 'processing')
+            self.assertEqual(delivery.attempt_count, 1)
+            # RETRY_DELAYS[0] is 10 seconds, jittered by up to 20%
+            delay = (delivery.next_attempt_at - before).total_seconds()
+            self.assertTrue(8 <= delay <= 12.5, delay)
+        
+        # Nothing is dispatched before the retry is due
+        self.assertEqual(dispatch_due_retries()['dispatched_count'], 0)
+        
+        with app.app_context():
+            delivery = db.session.get(WebhookDelivery, delivery_id)
+            delivery.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+            db.session.commit()
+        
+        self.assertEqual(dispatch_due_retries()['dispatched_count'], 1)
+        mock_batch_delay.assert_called_once_with([str(delivery_id)])
+        
+        # The claim is leased, so the next poll does not hand it out again
+        self.assertEqual(dispatch_due_retries()['dispatched_count'], 0)
+    
+    @patch('tasks.process_webhook.delay')
+    @patch('tasks.delivery_client.post')
+    def test_queue_engine_claims_pending_deliveries(self, mock_post, mock_delay):
+        """Test the queue engine leaves ingested deliveries pending and workers claim them with leases"""
+        from queue_worker import QueueWorker, claim_deliveries
+        
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.text = 'OK'
+        mock_post.return_value = mock_response
+        
+        app.config['DELIVERY_ENGINE'] = 'queue'
+        self.addCleanup(app.config.__setitem__, 'DELIVERY_ENGINE', 'celery')
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+        response = self.app.post(f'/api/ingest/{subscription_id}', json={'event': 'test'})
+        self.assertEqual(response.status_code, 202)
+        delivery_id = uuid.UUID(json.loads(response.data)['delivery_id'])
+        mock_delay.assert_not_called()
+        mock_post.assert_not_called()
+        
+        with app.app_context():
+            self.assertEqual(claim_deliveries(db.session, 10, 600), [delivery_id])
+            # The claim is leased, so no other worker can take it
+            self.assertEqual(claim_deliveries(db.session, 10, 600), [])
+        
+        QueueWorker()._deliver_claimed([delivery_id])
+        mock_post.assert_called_once()
+        
+        with app.app_context():
+            delivery = db.session.get(WebhookDelivery, delivery_id)
+            self.assertEqual(delivery.status, 'delivered')
+            self.assertIsNone(delivery.next_attempt_at)
+    
+    @patch('tasks.delivery_client.post')
+    def test_metrics_endpoint(self, mock_post):
+        """Test /metrics exposes ingest, delivery and backlog metrics"""
+        from tasks import process_webhook
+        
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.text = 'OK'
+        mock_post.return_value = mock_response
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+        with patch('app.dispatch_deliveries'):
+            response = self.app.post(f'/api/ingest/{subscription_id}', json={'event': 'test'})
+            self.app.post(f'/api/ingest/{subscription_id}', json={'event': 'waiting'})
+        delivery_id = uuid.UUID(json.loads(response.data)['delivery_id'])
+        self.assertEqual(process_webhook(delivery_id)['status'], 'delivered')
+        
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.get_data(as_text=True)
+        self.assertIn('webhook_ingest_seconds_count{endpoint="ingest_webhook"}', body)
+        self.assertIn(f'webhook_delivery_http_seconds_count{{subscription_id="{subscription_id}"}}', body)
+        self.assertIn('webhook_delivery_queue_wait_seconds_count', body)
+        self.assertIn('webhook_delivery_attempts_bucket{le="1.0"}', body)
+        self.assertIn('webhook_db_commit_seconds_count', body)
+        self.assertIn('webhook_deliveries_in_flight 0.0', body)
+        self.assertIn('webhook_delivery_backlog{status="pending"} 1.0', body)
+        self.assertIn('webhook_retry_backlog 0.0', body)
+    
+    def test_query_counting_and_profiling(self):
+        """Test opt-in query count headers, query metrics and profiles of slow requests"""
+        import os
+        import pstats
+        import tempfile
+        
+        with app.app_context():
+            db.session.add(Subscription(target_url='https://example.com/webhook'))
+            db.session.commit()
+        
+        # Off by default
+        response = self.app.get('/api/subscriptions')
+        self.assertNotIn('X-DB-Query-Count', response.headers)
+        
+        profile_dir = tempfile.mkdtemp()
+        app.config.update(QUERY_STATS_ENABLED=True, PROFILE_SAMPLE_RATE=1.0,
+                          PROFILE_SLOW_SECONDS=0, PROFILE_DIR=profile_dir)
+        try:
+            response = self.app.get('/api/subscriptions')
+        finally:
+            app.config.update(QUERY_STATS_ENABLED=False, PROFILE_SAMPLE_RATE=0)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(int(response.headers['X-DB-Query-Count']), 1)
+        self.assertGreaterEqual(float(response.headers['X-DB-Time-Ms']), 0)
+        
+        profiles = os.listdir(profile_dir)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('request-api_list_subscriptions-'))
+        pstats.Stats(os.path.join(profile_dir, profiles[0]))
+        
+        body = self.app.get('/metrics').get_data(as_text=True)
+        self.assertIn('webhook_db_queries_count{scope="request:api_list_subscriptions"}', body)
+    
+    @patch('app.delivery_client.post')
+    def test_direct_delivery_runs_outside_request(self, mock_post):
+        """Test fallback deliveries are made on background threads and ingest sheds load when they back up"""
+        import threading
+        from app import direct_executor
+        
+        released = threading.Event()
+        
+        def slow_post(*args, **kwargs):
+            released.wait(5)
+            response = MagicMock()
+            response.status_code = 200
+            response.text = 'OK'
+            return response
+        mock_post.side_effect = slow_post
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            subscription_id = subscription.id
+        
+        with patch.dict('os.environ', {'RENDER': 'true'}):
+            # The request returns while the endpoint is still answering
+            response = self.app.post(f'/api/ingest/{subscription_id}', json={'event': 'test'})
+            self.assertEqual(response.status_code, 202)
+            delivery_id = uuid.UUID(json.loads(response.data)['delivery_id'])
+            with app.app_context():
+                self.assertNotEqual(db.session.get(WebhookDelivery, delivery_id).status, 'delivered')
+            
+            released.set()
+            self.assertTrue(direct_executor.join(timeout=5))
+        
+        with app.app_context():
+            self.assertEqual(db.session.get(WebhookDelivery, delivery_id).status, 'delivered')
+        
+        with patch.object(direct_executor, 'saturated', return_value=True):
+            response = self.app.post(f'/api/ingest/{subscription_id}', json={'event': 'test'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        
+        # A queue that fills up after the first check still rejects the webhook before it is stored
+        held = direct_executor.reserve(direct_executor.max_queue)
+        self.addCleanup(held.release)
+        with patch.object(direct_executor, 'saturated', return_value=False):
+            response = self.app.post(f'/api/ingest/{subscription_id}', json={'event': 'test'})
+            self.assertEqual(response.status_code, 503)
+        with app.app_context():
+            self.assertEqual(WebhookDelivery.query.count(), 1)
+        
+        # Room that was reserved but not needed is given back
+        held.release()
+        with patch('tasks.process_webhook.delay'):
+            response = self.app.post(f'/api/ingest/{subscription_id}', json={'event': 'test'})
+            self.assertEqual(response.status_code, 202)
+        self.assertFalse(direct_executor.saturated())
+        reservation = direct_executor.reserve(direct_executor.max_queue)
+        self.assertIsNotNone(reservation)
+        reservation.release()
+    
+    def test_delivery_client_host_pools(self):
+        """Test sessions are reused per host and bounded in number"""
+        client = DeliveryClient(pool_maxsize=2, max_hosts=2, idle_timeout=60)
+        
+        first = client._session_for('https://a.example.com/hook')
+        self.assertIs(client._session_for('https://A.example.com/other'), first)
+        client._session_for('https://b.example.com/hook')
+        client._session_for('https://c.example.com/hook')
+        
+        stats = client.stats()
+        self.assertEqual(stats['hosts'], 2)
+        self.assertEqual(stats['session_hits'], 1)
+        self.assertEqual(stats['session_misses'], 3)
+        self.assertEqual(stats['evictions'], 1)
+        
+        # The least recently used host was closed
+        self.assertIsNot(client._session_for('https://a.example.com/hook'), first)
+        client.close()
+        
+        # Cookies set by one subscriber's endpoint are never stored or sent
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        received_cookies = []
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received_cookies.append(self.headers.get('Cookie'))
+                self.send_response(200)
+                self.send_header('Set-Cookie', 'tenant=a; Path=/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            
+            def log_message(self, format, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for path in ('a', 'b'):
+                client.post(f'http://127.0.0.1:{server.server_address[1]}/{path}', data=b'{}', timeout=5)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(received_cookies, [None, None])
+        
+        # A session evicted while a request is using it is closed once the request finishes
+        client.close()
+        client = DeliveryClient(pool_maxsize=2, max_hosts=1, idle_timeout=60)
+        busy = client._session_for('https://a.example.com/hook', acquire=True)
+        with patch.object(busy, 'close') as mock_close:
+            client._session_for('https://b.example.com/hook')
+            mock_close.assert_not_called()
+            client._release(busy)
+            mock_close.assert_called_once()
+        client.close()
+    
+    def test_benchmark_receiver_and_comparison(self):
+        """Test the benchmark receiver records arrivals and runs are compared to a baseline"""
+        import requests
+        from benchmarks.receiver import FakeReceiver
+        from benchmarks.run import compare, percentiles
+        
+        receiver = FakeReceiver(error_rate=0.5, seed=1).start()
+        try:
+            codes = [
+                requests.post(receiver.url, json={}, headers={'X-Webhook-ID': f'delivery-{i}'}, timeout=5).status_code
+                for i in range(20)
+            ]
+            requests.post(receiver.url, json=[], headers={'X-Webhook-IDs': 'batch-1,batch-2'}, timeout=5)
+        finally:
+            receiver.stop()
+        
+        # Failed requests are not counted as arrivals; both batched ids are
+        arrivals = receiver.arrival_times()
+        self.assertIn(500, codes)
+        self.assertEqual(receiver.counts['requests'], 21)
+        self.assertEqual(receiver.counts['error'], codes.count(500) + (0 if 'batch-1' in arrivals else 1))
+        self.assertEqual(len([key for key in arrivals if key.startswith('delivery-')]), codes.count(200))
+        
+        self.assertEqual(percentiles(range(1, 101)), {'p50': 50, 'p95': 95, 'p99': 99})
+        baseline = {'ingest': {'requests_per_second': 100}, 'delivery': {'latency_ms': {'p99': 200}}}
+        result = {'ingest': {'requests_per_second': 95}, 'delivery': {'latency_ms': {'p99': 300}}}
+        regressions = compare(result, baseline, tolerance=0.1)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('delivery.latency_ms.p99'))
+    
+    def test_response_body_capture_is_bounded(self):
+        """Test receiver responses are read up to the byte budget and successes can be skipped"""
+        import asyncio
+        import threading
+        import aiohttp
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from response_capture import TRUNCATED_MARKER, capture_response_body, capture_response_body_async
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                large = self.path == '/large'
+                body = 'é' * 5_000_000 if large else 'OK'
+                self.send_response(500 if large else 200)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body.encode())))
+                self.end_headers()
+                try:
+                    self.wfile.write(body.encode())
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            
+            def log_message(self, format, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_address[1]}'
+        client = DeliveryClient()
+        try:
+            response = client.post(f'{base_url}/large', data=b'{}', timeout=10, stream=True)
+            body = capture_response_body(response, max_bytes=1000)
+            self.assertTrue(body.endswith(TRUNCATED_MARKER))
+            self.assertEqual(body[:-len(TRUNCATED_MARKER)], 'é' * 500)
+            
+            # Small bodies are read to the end; successful ones are only kept when sampled
+            response = client.post(f'{base_url}/small', data=b'{}', timeout=10, stream=True)
+            self.assertEqual(capture_response_body(response, max_bytes=1000), 'OK')
+            response = client.post(f'{base_url}/small', data=b'{}', timeout=10, stream=True)
+            self.assertIsNone(capture_response_body(response, max_bytes=1000, success_rate=0))
+            
+            async def capture_async():
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(f'{base_url}/large', data=b'{}') as response:
+                        return await capture_response_body_async(response, max_bytes=10)
+            self.assertEqual(asyncio.run(capture_async()), 'é' * 5 + TRUNCATED_MARKER)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+    
     def test_event_type_filtering(self):
         """Test event type filtering"""
         # Create a subscription with event type filtering
@@ -140,6 +1177,176 @@ class WebhookDeliveryServiceTestCase(unittest.TestCase):
                               headers={'X-Event-Type': 'order.deleted'})
         self.assertEqual(response.status_code, 202)  # Still accepted but won't be processed
     
+    def test_stats_rollups(self):
+        """Test dashboard stats follow status transitions through the rollups"""
+        import stats
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            
+            deliveries = [WebhookDelivery(subscription_id=subscription.id, payload={'n': n})
+                          for n in range(3)]
+            db.session.add_all(deliveries)
+            db.session.commit()
+            
+            summary = stats.summarize(subscription.id)
+            self.assertEqual(summary['total'], 3)
+            self.assertEqual(summary['pending'], 3)
+            
+            # Deliver one webhook on the second attempt and fail another
+            deliveries[0].status = 'processing'
+            db.session.commit()
+            for attempt_number, status in ((1, 'failed'), (2, 'success')):
+                db.session.add(DeliveryAttempt(delivery_id=deliveries[0].id,
+                                               attempt_number=attempt_number, status=status))
+            deliveries[0].status = 'delivered'
+            deliveries[1].status = 'failed'
+            db.session.commit()
+            
+            summary = stats.summarize(subscription.id)
+            self.assertEqual(summary['total'], 3)
+            self.assertEqual(summary['pending'], 1)
+            self.assertEqual(summary['processing'], 0)
+            self.assertEqual(summary['delivered'], 1)
+            self.assertEqual(summary['failed'], 1)
+            self.assertEqual(summary['attempts'], 2)
+            
+            # Rebuilding from the base tables gives the same counters
+            stats.rebuild_rollups()
+            self.assertEqual(stats.summarize(subscription.id), summary)
+        
+        response = self.app.get('/')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_stats_rollups_count_delivery_added_with_its_subscription(self):
+        """Test a subscription and its first delivery created in one commit are counted"""
+        import stats
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            delivery = WebhookDelivery(subscription=subscription, payload={'event': 'test'})
+            delivery.attempts.append(DeliveryAttempt(attempt_number=1, status='failed'))
+            db.session.add_all([subscription, delivery])
+            db.session.commit()
+            
+            summary = stats.summarize(subscription.id)
+            self.assertEqual((summary['total'], summary['pending'], summary['attempts']), (1, 1, 1))
+            
+            stats.rebuild_rollups()
+            self.assertEqual(stats.summarize(subscription.id), summary)
+    
+    def test_attempt_results_are_written_together(self):
+        """Test grouped attempt results update statuses, attempt counts and rollups in one write"""
+        import stats
+        from attempt_results import AttemptResult, write_attempt_results
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            deliveries = [WebhookDelivery(subscription_id=subscription.id, payload={'n': n},
+                                          status='processing', attempt_count=n)
+                          for n in range(3)]
+            db.session.add_all(deliveries)
+            db.session.commit()
+            
+            # The third delivery was handed to another worker after its lease ran out
+            deliveries[2].status = 'pending'
+            db.session.commit()
+            
+            retry_at = datetime.utcnow() + timedelta(seconds=30)
+            results = [
+                AttemptResult(delivery.id, subscription.id, delivery.created_at, delivery.attempt_count + 1,
+                              fields, status, next_attempt_at)
+                for delivery, fields, status, next_attempt_at in (
+                    (deliveries[0], {'status': 'success', 'status_code': 200}, 'delivered', None),
+                    (deliveries[1], {'status': 'failed', 'status_code': 503}, 'processing', retry_at),
+                    (deliveries[2], {'status': 'failed', 'error_details': 'timeout'}, 'failed', None),
+                )
+            ]
+            self.assertEqual(write_attempt_results(db.session, results), 2)
+            db.session.commit()
+            db.session.expire_all()
+            
+            delivered, retrying, reclaimed = [db.session.get(WebhookDelivery, delivery.id)
+                                              for delivery in deliveries]
+            self.assertEqual((delivered.status, delivered.attempt_count), ('delivered', 1))
+            self.assertIsNotNone(delivered.completed_at)
+            self.assertEqual((retrying.status, retrying.attempt_count), ('processing', 2))
+            self.assertEqual(retrying.next_attempt_at, retry_at)
+            self.assertEqual((reclaimed.status, reclaimed.attempt_count), ('pending', 2))
+            self.assertEqual(DeliveryAttempt.query.count(), 3)
+            self.assertEqual(DeliveryAttempt.query.filter_by(delivery_id=retrying.id).one().attempt_number, 2)
+            
+            summary = stats.summarize(subscription.id)
+            self.assertEqual((summary['delivered'], summary['processing'], summary['pending']), (1, 1, 1))
+            self.assertEqual(summary['attempts'], 3)
+    
+    def test_retention_purges_in_chunks(self):
+        """Test expired deliveries and their attempts are deleted in bounded chunks"""
+        from retention import purge_expired_deliveries
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            
+            old = datetime.utcnow() - timedelta(hours=100)
+            for n in range(5):
+                delivery = WebhookDelivery(subscription_id=subscription.id, payload={'n': n},
+                                           created_at=old + timedelta(minutes=n))
+                delivery.attempts.append(DeliveryAttempt(attempt_number=1, status='failed'))
+                db.session.add(delivery)
+            db.session.add(WebhookDelivery(subscription_id=subscription.id, payload={'n': 5}))
+            db.session.commit()
+            
+            metrics = purge_expired_deliveries(db.session, datetime.utcnow() - timedelta(hours=72),
+                                               chunk_size=2)
+            self.assertEqual(metrics['deleted_deliveries'], 5)
+            self.assertEqual(metrics['deleted_attempts'], 5)
+            self.assertEqual(metrics['chunks'], 3)
+            self.assertTrue(metrics['completed'])
+            
+            self.assertEqual(WebhookDelivery.query.count(), 1)
+            self.assertEqual(DeliveryAttempt.query.count(), 0)
+    
+    def test_prune_rollups_waits_for_retention(self):
+        """Test rollup buckets are only pruned once retention has deleted their deliveries"""
+        import stats
+        from models import DeliveryStatsRollup
+        
+        with app.app_context():
+            subscription = Subscription(target_url='https://example.com/webhook')
+            db.session.add(subscription)
+            db.session.commit()
+            
+            now = datetime.utcnow()
+            cutoff = now - timedelta(hours=72)
+            deliveries = [WebhookDelivery(subscription_id=subscription.id, payload={'n': hours},
+                                          created_at=now - timedelta(hours=hours))
+                          for hours in (100, 90, 24)]
+            db.session.add_all(deliveries)
+            db.session.commit()
+            
+            # A retention run that stopped after deleting the oldest delivery
+            db.session.execute(WebhookDelivery.__table__.delete().where(
+                WebhookDelivery.__table__.c.id == deliveries[0].id))
+            db.session.commit()
+            
+            self.assertEqual(stats.prune_rollups(cutoff), 1)
+            db.session.commit()
+            buckets = {rollup.bucket for rollup in DeliveryStatsRollup.query.all()}
+            self.assertEqual(buckets, {stats.hour_bucket(deliveries[1].created_at),
+                                       stats.hour_bucket(deliveries[2].created_at)})
+            
+            # The expired delivery still updates its own bucket rather than a re-created partial one
+            deliveries[1].status = 'delivered'
+            db.session.commit()
+            rollup = DeliveryStatsRollup.query.filter_by(bucket=stats.hour_bucket(deliveries[1].created_at)).one()
+            self.assertEqual((rollup.pending, rollup.delivered), (0, 1))
+    
     def test_log_cleanup(self):
         """Test log cleanup functionality"""
         # Create test data with old and new logs
@@ -0,0 +1,224 @@
+import random
+import uuid
+from collections import namedtuple
+
+import redis
+
+from config import (
+    DELIVERY_CONCURRENCY_DECREASE_COOLDOWN,
+    DELIVERY_CONCURRENCY_INITIAL,
+    DELIVERY_CONCURRENCY_MAX,
+    DELIVERY_CONCURRENCY_MIN,
+    DELIVERY_LATENCY_TARGET,
+    DELIVERY_RATE_BURST,
+    DELIVERY_RATE_LIMIT,
+    DELIVERY_THROTTLE_ENABLED,
+    DELIVERY_THROTTLE_LEASE_TTL,
+    DELIVERY_THROTTLE_RETRY_DELAY,
+    REDIS_URL,
+)
+from redis_client import RedisClient
+
+# Idle throttle state expires after a day
+STATE_TTL = 86400
+
+# Outcome of DeliveryThrottle.acquire; ``lease`` is passed back to release()
+ThrottleDecision = namedtuple('ThrottleDecision', ['allowed', 'retry_after', 'lease'])
+Lease = namedtuple('Lease', ['subscription_id', 'lease_id'])
+
+# Reserved tokens of deferred deliveries that never came back are dropped after this long
+RESERVATION_TTL = 3600
+
+# KEYS: state hash, in-flight lease zset, reservation zset
+# ARGV: rate (0 for no rate limit), burst, initial limit, lease id, lease ttl (ms), retry delay (ms),
+#       delivery id ('' for none), reservation ttl (ms)
+# Returns {allowed, retry after in ms}
+ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local rate = tonumber(ARGV[1]) / 1000
+local burst = tonumber(ARGV[2])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - tonumber(ARGV[8]))
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'limit')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+local limit = tonumber(state[3]) or tonumber(ARGV[3])
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+
+-- A deferred delivery already paid for its token when it was deferred
+local reserved = false
+if ARGV[7] ~= '' then
+    reserved = redis.call('ZSCORE', KEYS[3], ARGV[7])
+end
+
+local allowed = 0
+local retry_after = 0
+if redis.call('ZCARD', KEYS[2]) >= math.floor(limit) then
+    retry_after = tonumber(ARGV[6])
+elseif reserved and tonumber(reserved) > now then
+    retry_after = tonumber(reserved) - now
+elseif not reserved and rate > 0 and tokens < 1 then
+    -- Reserve the next free token: the bucket goes negative, so each deferral
+    -- waits behind the ones before it and the backlog drains at the rate limit
+    retry_after = math.ceil((1 - tokens) / rate)
+    if ARGV[7] ~= '' then
+        tokens = tokens - 1
+        redis.call('ZADD', KEYS[3], now + retry_after, ARGV[7])
+    end
+else
+    if reserved then
+        redis.call('ZREM', KEYS[3], ARGV[7])
+    elseif rate > 0 then
+        tokens = tokens - 1
+    end
+    allowed = 1
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ARGV[4])
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now, 'limit', tostring(limit))
+redis.call('EXPIRE', KEYS[1], %(state_ttl)d)
+redis.call('EXPIRE', KEYS[2], %(state_ttl)d)
+redis.call('EXPIRE', KEYS[3], %(state_ttl)d)
+return {allowed, retry_after}
+""" % {'state_ttl': STATE_TTL}
+
+# KEYS: state hash, in-flight lease zset
+# ARGV: lease id, overloaded (0/1), initial, min and max limit, decrease cooldown (ms)
+# Returns the new concurrency limit
+RELEASE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+
+redis.call('ZREM', KEYS[2], ARGV[1])
+
+local state = redis.call('HMGET', KEYS[1], 'limit', 'decreased_at')
+local limit = tonumber(state[1]) or tonumber(ARGV[3])
+local decreased_at = tonumber(state[2]) or 0
+
+if ARGV[2] == '1' then
+    -- Multiplicative decrease, at most once per cooldown so one burst of
+    -- failures from requests already in flight only halves the limit once
+    if now - decreased_at >= tonumber(ARGV[6]) then
+        limit = math.max(tonumber(ARGV[4]), limit / 2)
+        redis.call('HSET', KEYS[1], 'decreased_at', now)
+    end
+else
+    -- Additive increase of about one slot per limit's worth of healthy responses
+    limit = math.min(tonumber(ARGV[5]), limit + 1 / limit)
+end
+
+redis.call('HSET', KEYS[1], 'limit', tostring(limit))
+return tostring(limit)
+"""
+
+
+def is_overloaded(status_code=None, no_response=False):
+    """Whether an attempt outcome (a timeout, connection error, 429 or 5xx) indicates overload"""
+    if no_response:
+        return True
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+class DeliveryThrottle:
+    """Per-subscription rate and concurrency limits shared by every worker through Redis.
+
+    A token bucket caps how many requests per second a subscription's endpoint
+    receives. Separately, the number of requests in flight is capped by an
+    AIMD limit that grows slowly while responses are fast and successful, and
+    halves on timeouts, connection errors, 429s, 5xx and responses slower than
+    ``latency_target``. In-flight slots are leases that expire, so a crashed
+    worker cannot hold a slot forever. When Redis is unavailable deliveries are
+    not throttled.
+
+    A delivery deferred for lack of tokens reserves the next free one, so a
+    backlog is spread over the time it takes to drain at the rate limit
+    instead of every deferred delivery coming back at once. Deferrals are
+    never shorter than ``retry_delay``.
+    """
+
+    def __init__(self, redis_url, rate=20.0, burst=40, initial_limit=4, min_limit=1, max_limit=50,
+                 latency_target=2.0, decrease_cooldown=1.0, retry_delay=1.0, lease_ttl=30, enabled=True):
+        self.redis_url = redis_url
+        self.rate = rate
+        self.burst = burst
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_cooldown = decrease_cooldown
+        self.retry_delay = retry_delay
+        self.lease_ttl = lease_ttl
+        self.enabled = enabled
+
+        self._redis = RedisClient(redis_url, 'Delivery throttle unavailable, not throttling')
+
+    @staticmethod
+    def _keys(subscription_id):
+        return [f"throttle:{subscription_id}", f"throttle:{subscription_id}:inflight",
+                f"throttle:{subscription_id}:reserved"]
+
+    def acquire(self, subscription_id, delivery_id=None):
+        """Take a token and an in-flight slot for one delivery attempt.
+
+        Pass the ``delivery_id`` so a deferred delivery keeps the token it
+        reserved for when it comes back.
+        """
+        if not self.enabled or self._redis.get() is None:
+            return ThrottleDecision(True, 0, None)
+
+        lease_id = uuid.uuid4().hex
+        try:
+            allowed, retry_after_ms = self._redis.script(ACQUIRE_SCRIPT)(
+                keys=self._keys(subscription_id),
+                args=[self.rate, self.burst, self.initial_limit, lease_id,
+                      int(self.lease_ttl * 1000), int(self.retry_delay * 1000),
+                      str(delivery_id or ''), RESERVATION_TTL * 1000]
+            )
+        except redis.RedisError as e:
+            self._redis.failed(e)
+            return ThrottleDecision(True, 0, None)
+
+        if allowed:
+            return ThrottleDecision(True, 0, Lease(subscription_id, lease_id))
+
+        # Reserved tokens already spread a backlog out; jitter the short waits for
+        # a concurrency slot so those deliveries do not all come back at once
+        retry_after = max(retry_after_ms / 1000, self.retry_delay)
+        if retry_after_ms / 1000 <= self.retry_delay:
+            retry_after += random.uniform(0, self.retry_delay / 2)
+        return ThrottleDecision(False, retry_after, None)
+
+    def release(self, lease, latency, overloaded):
+        """Return an in-flight slot and adjust the concurrency limit from the outcome"""
+        if lease is None or self._redis.get() is None:
+            return None
+
+        overloaded = overloaded or latency > self.latency_target
+        try:
+            limit = self._redis.script(RELEASE_SCRIPT)(
+                keys=self._keys(lease.subscription_id),
+                args=[lease.lease_id, int(overloaded), self.initial_limit, self.min_limit,
+                      self.max_limit, int(self.decrease_cooldown * 1000)]
+            )
+        except redis.RedisError as e:
+            self._redis.failed(e)
+            return None
+        return float(limit)
+
+
+delivery_throttle = DeliveryThrottle(
+    REDIS_URL,
+    rate=DELIVERY_RATE_LIMIT,
+    burst=DELIVERY_RATE_BURST,
+    initial_limit=DELIVERY_CONCURRENCY_INITIAL,
+    min_limit=DELIVERY_CONCURRENCY_MIN,
+    max_limit=DELIVERY_CONCURRENCY_MAX,
+    latency_target=DELIVERY_LATENCY_TARGET,
+    decrease_cooldown=DELIVERY_CONCURRENCY_DECREASE_COOLDOWN,
+    retry_delay=DELIVERY_THROTTLE_RETRY_DELAY,
+    lease_ttl=DELIVERY_THROTTLE_LEASE_TTL,
+    enabled=DELIVERY_THROTTLE_ENABLED,
+)
@@ -0,0 +1,43 @@
+import os
+import subprocess
+from flask import Flask
+
+app = Flask(__name__)
+
+@app.route("/")
+def root():
+    return "OK"
+
+@app.route("/health")
+def health():
+    return "OK"
+
+@app.route("/disable-health-check")
+def disable_health_check():
+    return "OK"
+
+@app.route("/metrics")
+def prometheus_metrics():
+    # Samples from the Celery and engine processes started below, when
+    # PROMETHEUS_MULTIPROC_DIR is set
+    import metrics
+    body, content_type = metrics.render_metrics()
+    return body, 200, {"Content-Type": content_type}
+
+def run_worker():
+    # The Celery worker always runs so periodic tasks (log cleanup) are processed.
+    # WORKER_LANES (e.g. "0,1,2,3") limits which ordered lanes this node consumes.
+    from lanes import worker_queues
+    lanes = os.environ.get("WORKER_LANES")
+    queues = worker_queues([int(lane) for lane in lanes.split(",")] if lanes else None)
+    subprocess.Popen(["celery", "-A", "celery_app", "worker", "--loglevel=info", "-Q", ",".join(queues)])
+    
+    # The async or queue engine takes over webhook delivery when selected
+    engine = os.environ.get("DELIVERY_ENGINE", "celery").lower()
+    if engine == "async":
+        subprocess.Popen(["python", "async_worker.py"])
+    elif engine == "queue":
+        subprocess.Popen(["python", "queue_worker.py"])
+
+# Start the worker in the background
+run_worker()